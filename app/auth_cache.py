@@ -0,0 +1,116 @@
+# app/auth_cache.py
+# Keeps the authenticated read path off the database: a bounded TTL/LRU cache of
+# decoded tokens and one of "principals" (the few user fields auth needs).
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# How long a cached principal is trusted before it is reloaded from the database
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+# Max number of cached principals / decoded tokens
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+
+
+class TTLCache:
+    # LRU-ordered dict whose entries also expire. Not thread-safe, meant to be
+    # used from the event loop only.
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # { key: (expires_at, value) }, least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        return None if entry is None else entry[1]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Principal:
+    # What the routes need to know about the authenticated user. Mirrors the User
+    # columns it copies, so it can be returned as a schemas.UserResponse.
+    __slots__ = ("id", "username", "email", "is_active", "is_admin")
+
+    def __init__(self, id: int, username: str, email: str, is_active: bool, is_admin: bool):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.is_active = is_active
+        self.is_admin = is_admin
+
+    @classmethod
+    def from_user(cls, user) -> "Principal":
+        return cls(user.id, user.username, user.email, user.is_active, user.is_admin)
+
+
+class AuthCache:
+    def __init__(self, maxsize: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL_SECONDS):
+        # { username: Principal }
+        self.principals = TTLCache(maxsize, ttl)
+        # { token: username }, so the same JWT signature isn't verified over and over
+        self.tokens = TTLCache(maxsize, ttl)
+        # { user_id: username }, for invalidation by id
+        self.usernames_by_id: Dict[int, str] = {}
+
+    def get_token_subject(self, token: str) -> Optional[str]:
+        return self.tokens.get(token)
+
+    def remember_token(self, token: str, username: str, expires_at: Optional[float]):
+        # Never keep a token past its own "exp"
+        ttl = None if expires_at is None else expires_at - time.time()
+        if ttl is not None and ttl <= 0:
+            return
+        self.tokens.set(token, username, ttl)
+
+    def get_principal(self, username: str) -> Optional[Principal]:
+        return self.principals.get(username)
+
+    def remember_user(self, user) -> Principal:
+        principal = Principal.from_user(user)
+        self.principals.set(principal.username, principal)
+        self.usernames_by_id[principal.id] = principal.username
+        if len(self.usernames_by_id) > 2 * self.principals.maxsize:
+            # Drop ids whose principal was evicted
+            self.usernames_by_id = {p.id: p.username for _, p in self.principals.entries.values()}
+        return principal
+
+    def invalidate_user(self, user_id: int):
+        # Called by crud whenever a user's auth-relevant fields change
+        username = self.usernames_by_id.pop(user_id, None)
+        if username is not None:
+            self.principals.pop(username)
+
+    def clear(self):
+        self.principals.entries.clear()
+        self.tokens.entries.clear()
+        self.usernames_by_id.clear()
+
+
+# Instantiate the cache
+auth_cache = AuthCache()
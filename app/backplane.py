@@ -0,0 +1,247 @@
+# app/backplane.py
+import asyncio
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+# Each worker process gets its own random id, so it can recognise (and skip)
+# events that it published itself.
+WORKER_ID = uuid.uuid4().hex[:12]
+
+# Which backplane to use: "memory" (single worker, the default) or "postgres"
+CHAT_BACKPLANE = os.getenv("CHAT_BACKPLANE", "memory")
+
+# Handler called for every event coming from another worker:
+# handler(room_id, origin_worker_id, kind, body)
+EventHandler = Callable[[int, str, str, str], Awaitable[None]]
+
+
+class Backplane:
+    # Base class / interface. A backplane only moves opaque string events between
+    # workers; ConnectionManager decides what the events mean.
+    def __init__(self, worker_id: Optional[str] = None):
+        self.worker_id = worker_id or WORKER_ID
+        self.handler: Optional[EventHandler] = None
+        # True when other workers may write to the same rooms, so what this worker
+        # keeps about a room goes stale once it stops following it
+        self.cross_worker = False
+
+    async def start(self, handler: EventHandler):
+        self.handler = handler
+
+    async def stop(self):
+        self.handler = None
+
+    async def subscribe(self, room_id: int):
+        pass
+
+    async def unsubscribe(self, room_id: int):
+        pass
+
+    async def publish(self, room_id: int, kind: str, body: str):
+        pass
+
+
+class InProcessBackplane(Backplane):
+    # Default backplane. With a single ConnectionManager it does nothing at all;
+    # several managers sharing the same hub (e.g. in tests) see each other's events.
+    def __init__(self, hub: Optional[Dict[int, Set["InProcessBackplane"]]] = None, worker_id: Optional[str] = None):
+        super().__init__(worker_id)
+        self.cross_worker = hub is not None
+        self.hub = hub if hub is not None else {}
+
+    async def subscribe(self, room_id: int):
+        self.hub.setdefault(room_id, set()).add(self)
+
+    async def unsubscribe(self, room_id: int):
+        peers = self.hub.get(room_id)
+        if peers is not None:
+            peers.discard(self)
+            if not peers:
+                del self.hub[room_id]
+
+    async def stop(self):
+        for room_id in [room_id for room_id, peers in self.hub.items() if self in peers]:
+            await self.unsubscribe(room_id)
+        await super().stop()
+
+    async def publish(self, room_id: int, kind: str, body: str):
+        for peer in list(self.hub.get(room_id, ())):
+            if peer is not self and peer.handler is not None:
+                await peer.handler(room_id, self.worker_id, kind, body)
+
+
+class PostgresBackplane(Backplane):
+    # Fan-out through PostgreSQL LISTEN/NOTIFY, one channel per room.
+    # A worker only LISTENs on rooms that currently have local sockets.
+    CHANNEL_PREFIX = "chat_room_"
+    # NOTIFY payloads are limited to 8000 bytes by the server. Larger bodies are
+    # stored in the backplane_payloads table and the NOTIFY only carries the row id
+    # ("<origin>:ref:<kind>:<id>"); rows older than PAYLOAD_TTL_SECONDS are pruned.
+    MAX_PAYLOAD_BYTES = 7999
+    PAYLOAD_TTL_SECONDS = 60
+
+    def __init__(self, dsn: str, worker_id: Optional[str] = None):
+        super().__init__(worker_id)
+        self.cross_worker = True
+        self.dsn = dsn
+        self.listen_conn = None
+        self.notify_conn = None
+        self.rooms: Set[int] = set()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.inbox: "asyncio.Queue[tuple]" = asyncio.Queue()
+        self.dispatcher: Optional[asyncio.Task] = None
+        # All blocking calls go through one thread, so LISTEN / UNLISTEN / NOTIFY
+        # reach the server in the order they were called: with a pool, a quick
+        # leave-then-join of a room could run its UNLISTEN after the new LISTEN
+        self.executor: Optional[ThreadPoolExecutor] = None
+        # Held while LISTEN / UNLISTEN runs (see _listen)
+        self.listen_lock = asyncio.Lock()
+        # Next time (monotonic) old backplane_payloads rows are deleted
+        self.next_prune = 0.0
+
+    def _connect(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        conn = psycopg2.connect(self.dsn)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def _execute(self, conn, sql: str, params: tuple = ()):
+        with conn.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def _store_payload(self, conn, body: str) -> int:
+        with conn.cursor() as cursor:
+            cursor.execute("INSERT INTO backplane_payloads (body) VALUES (%s) RETURNING id", (body,))
+            payload_id = cursor.fetchone()[0]
+            if time.monotonic() >= self.next_prune:
+                self.next_prune = time.monotonic() + self.PAYLOAD_TTL_SECONDS
+                cursor.execute("DELETE FROM backplane_payloads WHERE created_at < now() - make_interval(secs => %s)",
+                               (self.PAYLOAD_TTL_SECONDS,))
+        return payload_id
+
+    def _load_payload(self, conn, payload_id: int) -> Optional[str]:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT body FROM backplane_payloads WHERE id = %s", (payload_id,))
+            row = cursor.fetchone()
+        return row[0] if row is not None else None
+
+    def _run(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    async def _listen(self, sql: str):
+        # The reader is paused meanwhile: _on_readable polling the connection from
+        # the loop thread would take the command's reply and leave it waiting.
+        # Notifications that came in with the reply are read right after.
+        async with self.listen_lock:
+            if self.listen_conn is None:
+                return
+            fd = self.listen_conn.fileno()
+            self.loop.remove_reader(fd)
+            try:
+                await self._run(self._execute, self.listen_conn, sql)
+            finally:
+                if self.listen_conn is not None:
+                    self.loop.add_reader(fd, self._on_readable)
+                    self._on_readable()
+
+    async def start(self, handler: EventHandler):
+        await super().start(handler)
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backplane")
+        self.listen_conn = await self._run(self._connect)
+        self.notify_conn = await self._run(self._connect)
+        self.dispatcher = self.loop.create_task(self._dispatch())
+        self.loop.add_reader(self.listen_conn.fileno(), self._on_readable)
+
+    async def stop(self):
+        # No new commands from here on; a LISTEN still running won't resume the reader
+        listen_conn, notify_conn = self.listen_conn, self.notify_conn
+        self.listen_conn = self.notify_conn = None
+        if listen_conn is not None:
+            async with self.listen_lock:
+                self.loop.remove_reader(listen_conn.fileno())
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            self.dispatcher = None
+        if self.executor is not None:
+            # Let queued commands finish before their connections are closed
+            await self.loop.run_in_executor(None, self.executor.shutdown)
+            self.executor = None
+        for conn in (listen_conn, notify_conn):
+            if conn is not None:
+                conn.close()
+        self.rooms.clear()
+        await super().stop()
+
+    async def subscribe(self, room_id: int):
+        if room_id in self.rooms or self.listen_conn is None:
+            return
+        self.rooms.add(room_id)
+        await self._listen(f"LISTEN {self.CHANNEL_PREFIX}{int(room_id)}")
+
+    async def unsubscribe(self, room_id: int):
+        if room_id not in self.rooms or self.listen_conn is None:
+            return
+        self.rooms.discard(room_id)
+        await self._listen(f"UNLISTEN {self.CHANNEL_PREFIX}{int(room_id)}")
+
+    async def publish(self, room_id: int, kind: str, body: str):
+        if self.notify_conn is None:
+            return
+        # Envelope: "<origin>:<kind>:<body>", so bodies are never re-encoded
+        payload = f"{self.worker_id}:{kind}:{body}"
+        if len(payload.encode("utf-8")) > self.MAX_PAYLOAD_BYTES:
+            try:
+                payload_id = await self._run(self._store_payload, self.notify_conn, body)
+            except Exception as e:
+                print(f"Backplane: dropping oversized {kind} event for room {room_id} ({len(payload)} chars): {e}")
+                return
+            payload = f"{self.worker_id}:ref:{kind}:{payload_id}"
+        await self._run(
+            self._execute, self.notify_conn,
+            "SELECT pg_notify(%s, %s)", (f"{self.CHANNEL_PREFIX}{int(room_id)}", payload),
+        )
+
+    def _on_readable(self):
+        # Called by the event loop when the LISTEN connection has data
+        self.listen_conn.poll()
+        while self.listen_conn.notifies:
+            notify = self.listen_conn.notifies.pop(0)
+            if not notify.channel.startswith(self.CHANNEL_PREFIX):
+                continue
+            origin, kind, body = notify.payload.split(":", 2)
+            if origin == self.worker_id:
+                continue  # Our own event, already delivered locally
+            self.inbox.put_nowait((int(notify.channel[len(self.CHANNEL_PREFIX):]), origin, kind, body))
+
+    async def _dispatch(self):
+        # Single consumer keeps events of a room in NOTIFY order
+        while True:
+            room_id, origin, kind, body = await self.inbox.get()
+            try:
+                if kind == "ref":
+                    # Oversized event: fetched here, so it keeps its place in the room's order
+                    kind, payload_id = body.split(":", 1)
+                    body = await self._run(self._load_payload, self.notify_conn, int(payload_id))
+                    if body is None:
+                        print(f"Backplane: {kind} event {payload_id} for room {room_id} is gone, skipped")
+                        continue
+                if self.handler is not None:
+                    await self.handler(room_id, origin, kind, body)
+            except Exception as e:
+                print(f"Backplane: error handling {kind} event for room {room_id}: {e}")
+
+
+def create_backplane() -> Backplane:
+    if CHAT_BACKPLANE == "postgres":
+        from sqlalchemy.engine import make_url
+        from .database import DATABASE_URL
+        # psycopg2 wants a plain libpq URL, without SQLAlchemy's "+driver" suffix
+        dsn = make_url(DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+        return PostgresBackplane(dsn)
+    return InProcessBackplane()
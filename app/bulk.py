@@ -0,0 +1,253 @@
+# app/bulk.py
+# Streaming export and bulk import of chat history, for backups and for moving
+# rooms between databases. Used by the /admin/export and /admin/import endpoints
+# and from the command line:
+#   python -m app.bulk export [--room ID] [--format ndjson|csv] [--output FILE]
+#   python -m app.bulk import FILE [--room ID] [--format ndjson|csv]
+#
+# Export reads through a server-side cursor (yield_per), so memory stays flat
+# however many messages there are. Files carry usernames and room names, not ids:
+# on import, senders are matched by username (unknown ones become None) and
+# rooms by name (missing ones are created), unless everything goes into one
+# --room. Message ids and seqs are not kept; the target database assigns new ones
+# (imported messages are numbered after the room's existing ones).
+import argparse
+import asyncio
+import csv
+import gzip
+import io
+import sys
+import zlib
+from datetime import datetime
+from typing import AsyncIterator, Dict, IO, Iterable, Iterator, List, Optional
+
+from sqlalchemy import insert, select
+
+from . import crud, protocol, search
+from .database import AsyncSessionLocal, Message, Room, User, dispose_async_engine
+from .replicas import replicas
+from .room_directory import room_directory
+
+# --- Configuration ---
+EXPORT_BATCH_SIZE = 1000 # Rows fetched per round trip from the server-side cursor
+IMPORT_BATCH_SIZE = 1000 # Rows per COPY / multi-row INSERT
+
+FORMATS = ("ndjson", "csv")
+# Columns of an export, in CSV order
+EXPORT_COLUMNS = ("id", "room_id", "room_name", "sender_id", "sender_username", "text", "timestamp")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "application/gzip"}
+EXTENSIONS = {"ndjson": "ndjson", "csv": "csv.gz"}
+
+
+# --- Export ---
+
+def export_query(room_id: Optional[int] = None):
+    query = (
+        select(Message.id, Message.room_id, Room.name, Message.sender_id, User.username, Message.text, Message.timestamp)
+        .outerjoin(Room, Message.room_id == Room.id)
+        .outerjoin(User, Message.sender_id == User.id)
+    )
+    if room_id is not None:
+        query = query.filter(Message.room_id == room_id)
+    # Oldest first, along ix_messages_(room_id_)timestamp_id: no sort step
+    return query.order_by(Message.timestamp, Message.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+
+def _ndjson_chunk(rows) -> bytes:
+    return b"".join(
+        protocol.encode({
+            "id": row[0], "room_id": row[1], "room_name": row[2], "sender_id": row[3],
+            "sender_username": row[4], "text": row[5], "timestamp": row[6].isoformat(),
+        }).data + b"\n"
+        for row in rows
+    )
+
+
+def _csv_chunk(rows, header: bool) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    writer.writerows(row[:6] + (row[6].isoformat(),) for row in rows)
+    return buffer.getvalue().encode("utf-8")
+
+
+async def export_messages(room_id: Optional[int] = None, format: str = "ndjson") -> AsyncIterator[bytes]:
+    # Yields the export in chunks of about EXPORT_BATCH_SIZE rows. The session lives
+    # inside the generator, so it stays open exactly as long as the stream does.
+    compressor = zlib.compressobj(wbits=31) if format == "csv" else None # 31: gzip container
+    first = True
+    async with replicas.read_session() as db: # A replica when there is one: exports are long reads
+        result = await db.stream(export_query(room_id))
+        async for rows in result.partitions():
+            if compressor is None:
+                yield _ndjson_chunk(rows)
+            else:
+                chunk = compressor.compress(_csv_chunk(rows, header=first))
+                if chunk:
+                    yield chunk
+            first = False
+    if compressor is not None:
+        if first:
+            # Nothing exported: still a valid file with the header
+            yield compressor.compress(_csv_chunk([], header=True))
+        yield compressor.flush()
+
+
+# --- Import ---
+
+def read_rows(file: IO[bytes], format: str) -> Iterator[dict]:
+    # Rows from an export file, gzip'd or not (detected from the first bytes)
+    stream = io.BufferedReader(file) if not hasattr(file, "peek") else file
+    if stream.peek(2)[:2] == b"\x1f\x8b":
+        stream = gzip.GzipFile(fileobj=stream, mode="rb")
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    if format == "csv":
+        yield from csv.DictReader(text)
+        return
+    for line in text:
+        if line.strip():
+            yield protocol.loads(line)
+
+
+def _batches(rows: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Importer:
+    def __init__(self, room_id: Optional[int] = None, batch_size: int = IMPORT_BATCH_SIZE):
+        self.room_id = room_id
+        self.batch_size = batch_size
+        # Name -> id lookups, cached across batches
+        self.user_ids: Dict[str, Optional[int]] = {}
+        self.room_ids: Dict[str, int] = {}
+        self.imported = 0
+        self.rooms_created = 0
+        self.touched_rooms = set()
+
+    async def run(self, rows: Iterable[dict]) -> dict:
+        for batch in _batches(rows, self.batch_size):
+            async with AsyncSessionLocal() as db:
+                records = await self._records(db, batch)
+                await self._write(db, records)
+                await db.commit()
+            self.imported += len(records)
+        if self.rooms_created:
+            room_directory.invalidate()
+        return {"imported": self.imported, "rooms_created": self.rooms_created, "rooms": sorted(self.touched_rooms)}
+
+    async def _records(self, db, batch: List[dict]) -> List[tuple]:
+        # (text, timestamp, room_id, sender_id, seq) per row: messages COPY column order
+        usernames = {row.get("sender_username") for row in batch} - self.user_ids.keys() - {None, ""}
+        if usernames:
+            result = await db.execute(select(User.username, User.id).filter(User.username.in_(usernames)))
+            found = {username: user_id for username, user_id in result.tuples()}
+            for username in usernames:
+                self.user_ids[username] = found.get(username)
+        records = []
+        for row in batch:
+            room_id = self.room_id if self.room_id is not None else await self._room_id(db, row.get("room_name"))
+            timestamp = row["timestamp"]
+            if isinstance(timestamp, str):
+                timestamp = datetime.fromisoformat(timestamp)
+            records.append((row["text"], timestamp, room_id, self.user_ids.get(row.get("sender_username"))))
+            self.touched_rooms.add(room_id)
+        # Sequence numbers in file order, per room
+        next_seq = await crud.allocate_seqs_for(db, [record[2] for record in records])
+        numbered = []
+        for record in records:
+            numbered.append(record + (next_seq[record[2]],))
+            next_seq[record[2]] += 1
+        return numbered
+
+    async def _room_id(self, db, name: Optional[str]) -> int:
+        if not name:
+            raise ValueError("Row without room_name; import it into a room with --room")
+        room_id = self.room_ids.get(name)
+        if room_id is None:
+            room_id = (await db.execute(select(Room.id).filter(Room.name == name))).scalar()
+            if room_id is None:
+                room_id = (await db.execute(insert(Room).values(name=name).returning(Room.id))).scalar()
+                self.rooms_created += 1
+            self.room_ids[name] = room_id
+        return room_id
+
+    async def _write(self, db, records: List[tuple]):
+        if not records:
+            return
+        connection = await db.connection()
+        if connection.dialect.name == "postgresql":
+            # COPY FROM STDIN (binary) through asyncpg, in the session's transaction.
+            # Routed to the right monthly partition by Postgres.
+            raw = await connection.get_raw_connection()
+            await raw.driver_connection.copy_records_to_table(
+                Message.__tablename__, records=records, columns=["text", "timestamp", "room_id", "sender_id", "seq"],
+            )
+            return
+        # Elsewhere: one multi-row INSERT, plus the search token index
+        result = await db.execute(
+            insert(Message).returning(Message.id, sort_by_parameter_order=True),
+            [{"text": text, "timestamp": timestamp, "room_id": room_id, "sender_id": sender_id, "seq": seq}
+             for text, timestamp, room_id, sender_id, seq in records],
+        )
+        ids = result.scalars().all()
+        await search.index_messages(db, [(id, record[2], record[0]) for id, record in zip(ids, records)])
+
+
+async def import_messages(file: IO[bytes], format: str = "ndjson", room_id: Optional[int] = None) -> dict:
+    return await Importer(room_id=room_id).run(read_rows(file, format))
+
+
+# --- Command line ---
+
+async def _export_to(output: IO[bytes], room_id: Optional[int], format: str):
+    async for chunk in export_messages(room_id, format):
+        output.write(chunk)
+
+def _run(coroutine):
+    # Close the pool before the loop goes away (aiosqlite's thread would keep the process alive)
+    async def run_and_dispose():
+        await replicas.start() # Exports read from a replica when there is one
+        try:
+            return await coroutine
+        finally:
+            await dispose_async_engine()
+            await replicas.stop()
+    return asyncio.run(run_and_dispose())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.bulk")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="stream messages to a file or stdout")
+    export.add_argument("--room", type=int, help="only this room id (default: all rooms)")
+    export.add_argument("--format", choices=FORMATS, default="ndjson")
+    export.add_argument("--output", help="file to write (default: stdout)")
+    load = commands.add_parser("import", help="bulk-load messages from an export")
+    load.add_argument("file")
+    load.add_argument("--room", type=int, help="put every message in this room id (default: match rooms by name)")
+    load.add_argument("--format", choices=FORMATS, help="default: from the file name")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        if args.output:
+            with open(args.output, "wb") as output:
+                _run(_export_to(output, args.room, args.format))
+        else:
+            _run(_export_to(sys.stdout.buffer, args.room, args.format))
+        return
+    format = args.format or ("csv" if ".csv" in args.file else "ndjson")
+    with open(args.file, "rb") as file:
+        result = _run(import_messages(file, format, args.room))
+    print(f"Imported {result['imported']} messages into {len(result['rooms'])} room(s), "
+          f"{result['rooms_created']} room(s) created")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,91 @@
 # app/crud.py
-from sqlalchemy.orm import Session
+from collections import Counter
+from typing import Dict, Optional, Tuple
+from datetime import datetime
+from sqlalchemy import insert, literal, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
 # Changed this line: Now importing the specific model classes directly
-from .database import User, Room, Message
-from . import schemas
-from passlib.context import CryptContext # For password hashing
+from .database import User, Room, Message, room_users
+from . import schemas, search
+from .auth_cache import auth_cache
+from .room_directory import room_directory
+from .hashing import get_pwd_context, password_hasher # For password hashing
+from .metrics import timed_crud # Per-function timings for /metrics
 
-# Password hashing context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# All CRUD functions run on an AsyncSession (see database.AsyncSessionLocal) so
+# they can be awaited from the async route handlers without blocking the loop.
+# Read-only ones may be handed a session on a read replica (see replicas.py).
+
+# --- Read Models ---
+class MessageRow:
+    # Lightweight message record for listings and history: plain columns plus the
+    # sender's username from the same query, without ORM object hydration.
+    # Attribute names match schemas.MessageResponse.
+    __slots__ = ("id", "text", "timestamp", "room_id", "sender_id", "sender_username", "seq")
+
+    def __init__(self, id, text, timestamp, room_id, sender_id, sender_username, seq=None):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.room_id = room_id
+        self.sender_id = sender_id
+        self.sender_username = sender_username
+        self.seq = seq
+
+class SearchRow(MessageRow):
+    # MessageRow plus the relevance rank of a search hit (schemas.SearchHit)
+    __slots__ = ("rank",)
+
+    def __init__(self, id, text, timestamp, room_id, sender_id, sender_username, seq, rank):
+        super().__init__(id, text, timestamp, room_id, sender_id, sender_username, seq)
+        self.rank = rank
+
+# Columns selected for MessageRow, in constructor order
+MESSAGE_ROW_COLUMNS = (Message.id, Message.text, Message.timestamp, Message.room_id, Message.sender_id, User.username,
+                       Message.seq)
+
+def message_rows_query():
+    return select(*MESSAGE_ROW_COLUMNS).outerjoin(User, Message.sender_id == User.id)
 
 # --- Password Utility ---
+# Blocking versions, for scripts. Request handlers use hashing.password_hasher,
+# which runs bcrypt in a worker pool.
 def get_password_hash(password: str):
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 def verify_password(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 # --- User CRUD Operations ---
 
-def get_user(db: Session, user_id: int):
-    return db.query(User).filter(User.id == user_id).first() # Changed from models.User
+@timed_crud
+async def get_user(db: AsyncSession, user_id: int):
+    result = await db.execute(select(User).filter(User.id == user_id))
+    return result.scalars().first()
 
-def get_user_by_username(db: Session, username: str):
-    return db.query(User).filter(User.username == username).first() # Changed from models.User
+@timed_crud
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(User).filter(User.username == username))
+    return result.scalars().first()
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(User).filter(User.email == email).first() # Changed from models.User
+@timed_crud
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(User).filter(User.email == email))
+    return result.scalars().first()
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(User).offset(skip).limit(limit).all() # Changed from models.User
+@timed_crud
+async def get_users(db: AsyncSession, after_id: Optional[int] = None, limit: int = 100):
+    # Keyset pagination by id: pass the id of the last user of the previous page
+    query = select(User)
+    if after_id is not None:
+        query = query.filter(User.id > after_id)
+    result = await db.execute(query.order_by(User.id).limit(limit))
+    return result.scalars().all()
 
-def create_user(db: Session, user: schemas.UserCreate):
-    hashed_password = get_password_hash(user.password)
-    db_user = User( # Changed from models.User
+@timed_crud
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
+    hashed_password = await password_hasher.hash(user.password)
+    db_user = User(
         username=user.username,
         email=user.email,
         hashed_password=hashed_password,
@@ -39,76 +93,233 @@ def create_user(db: Session, user: schemas.UserCreate):
         is_admin=False # New users are not admins by default
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
-def update_user_status(db: Session, user_id: int, is_active: bool):
-    return db.query(User).filter(User.id == user_id).update({"is_active": is_active}) # Changed from models.User for update optimization
-    # # Alternative for update (if you prefer refreshing the object):
-    # db_user = db.query(User).filter(User.id == user_id).first()
-    # if db_user:
-    #     db_user.is_active = is_active
-    #     db.commit()
-    #     db.refresh(db_user)
-    # return db_user
+@timed_crud
+async def update_user_status(db: AsyncSession, user_id: int, is_active: bool):
+    # Single UPDATE statement, no need to load the user first
+    result = await db.execute(update(User).where(User.id == user_id).values(is_active=is_active))
+    await db.commit()
+    auth_cache.invalidate_user(user_id)
+    return result.rowcount
 
+@timed_crud
+async def update_user_password(db: AsyncSession, user_id: int, hashed_password: str):
+    # Used to upgrade a hash made with outdated settings after a successful login
+    await db.execute(update(User).where(User.id == user_id).values(hashed_password=hashed_password))
+    await db.commit()
 
-def delete_user(db: Session, user_id: int):
-    db_user = db.query(User).filter(User.id == user_id).first() # Changed from models.User
+@timed_crud
+async def delete_user(db: AsyncSession, user_id: int):
+    db_user = await get_user(db, user_id=user_id)
     if db_user:
-        db.delete(db_user)
-        db.commit()
+        await db.delete(db_user)
+        await db.commit()
+        auth_cache.invalidate_user(user_id)
         return True
     return False
 
 # --- Room CRUD Operations ---
 
-def get_room(db: Session, room_id: int):
-    return db.query(Room).filter(Room.id == room_id).first() # Changed from models.Room
+@timed_crud
+async def get_room(db: AsyncSession, room_id: int):
+    result = await db.execute(select(Room).filter(Room.id == room_id))
+    return result.scalars().first()
 
-def get_room_by_name(db: Session, room_name: str):
-    return db.query(Room).filter(Room.name == room_name).first() # Changed from models.Room
+@timed_crud
+async def get_room_by_name(db: AsyncSession, room_name: str):
+    result = await db.execute(select(Room).filter(Room.name == room_name))
+    return result.scalars().first()
 
-def get_rooms(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(Room).offset(skip).limit(limit).all() # Changed from models.Room
+@timed_crud
+async def get_rooms(db: AsyncSession, after_id: Optional[int] = None, limit: int = 100):
+    # Keyset pagination by id, same as get_users
+    query = select(Room)
+    if after_id is not None:
+        query = query.filter(Room.id > after_id)
+    result = await db.execute(query.order_by(Room.id).limit(limit))
+    return result.scalars().all()
 
-def create_room(db: Session, room: schemas.RoomCreate):
-    db_room = Room(name=room.name) # Changed from models.Room
+@timed_crud
+async def create_room(db: AsyncSession, room: schemas.RoomCreate):
+    db_room = Room(name=room.name)
     db.add(db_room)
-    db.commit()
-    db.refresh(db_room)
+    await db.commit()
+    await db.refresh(db_room)
+    room_directory.room_created(db_room.id, db_room.name)
     return db_room
 
-def delete_room(db: Session, room_id: int):
-    db_room = db.query(Room).filter(Room.id == room_id).first() # Changed from models.Room
+@timed_crud
+async def delete_room(db: AsyncSession, room_id: int):
+    db_room = await get_room(db, room_id=room_id)
     if db_room:
-        db.delete(db_room)
-        db.commit()
+        await db.delete(db_room)
+        await db.commit()
+        room_directory.room_deleted(room_id)
         return True
     return False
 
 # --- Message CRUD Operations ---
 
-def get_messages_in_room(db: Session, room_id: int, skip: int = 0, limit: int = 50):
-    # Order by timestamp descending to get the latest messages
-    return db.query(Message)\
-             .filter(Message.room_id == room_id)\
-             .order_by(Message.timestamp.desc())\
-             .offset(skip).limit(limit).all() # Changed from models.Message
+@timed_crud
+async def get_messages_in_room(db: AsyncSession, room_id: int, limit: int = 50,
+                               before: Optional[Tuple[datetime, int]] = None):
+    # Newest first. `before` is the (timestamp, id) of the oldest message the client
+    # already has; the row-value comparison walks ix_messages_room_id_timestamp_id
+    # instead of sorting and skipping an OFFSET.
+    # Returns MessageRow records with the sender's username joined in.
+    query = message_rows_query().filter(Message.room_id == room_id)
+    if before is not None:
+        # The plain timestamp bound is implied by the row comparison, but only it
+        # lets Postgres skip newer monthly partitions (see partitions.py)
+        query = query.filter(tuple_(Message.timestamp, Message.id) < tuple_(*before), Message.timestamp <= before[0])
+    result = await db.execute(query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit))
+    return [MessageRow(*row) for row in result.tuples()]
+
+@timed_crud
+async def get_messages_since(db: AsyncSession, room_id: int, since: int, until: int, limit: int = 200):
+    # Oldest first: the messages with since < seq <= until, for reconnect replay.
+    # Walks ix_messages_room_id_seq; call again from the last seq for the next batch.
+    query = message_rows_query().filter(Message.room_id == room_id, Message.seq > since, Message.seq <= until)
+    result = await db.execute(query.order_by(Message.seq).limit(limit))
+    return [MessageRow(*row) for row in result.tuples()]
+
+@timed_crud
+async def get_room_last_seq(db: AsyncSession, room_id: int) -> Optional[int]:
+    # Every message up to this seq is committed (see allocate_seqs)
+    result = await db.execute(select(Room.last_seq).filter(Room.id == room_id))
+    return result.scalar()
 
-def create_message(db: Session, message: schemas.MessageCreate, sender_id: int):
+async def allocate_seqs(db: AsyncSession, room_id: int, count: int = 1) -> int:
+    # Reserves `count` sequence numbers in a room and returns the first one.
+    # The UPDATE locks the room's row until the transaction ends, so a room's
+    # messages commit in seq order: once last_seq = N is visible, so are 1..N.
+    # Rolled back together with the messages, so no numbers are skipped.
+    result = await db.execute(
+        update(Room).where(Room.id == room_id).values(last_seq=Room.last_seq + count)
+        .returning(Room.last_seq).execution_options(synchronize_session=False)
+    )
+    last_seq = result.scalar()
+    if last_seq is None:
+        raise ValueError(f"Room {room_id} not found")
+    return last_seq - count + 1
+
+async def allocate_seqs_for(db: AsyncSession, room_ids, skip_missing: bool = False) -> Dict[int, int]:
+    # Batch version: { room_id: first seq } for a list of room ids, one per message.
+    # Rooms are locked in id order, so concurrent batches can't deadlock. With
+    # skip_missing, rooms that don't exist (anymore) are left out instead of raising.
+    counts = Counter(room_ids)
+    next_seq = {}
+    for room_id in sorted(counts):
+        try:
+            next_seq[room_id] = await allocate_seqs(db, room_id, counts[room_id])
+        except ValueError:
+            if not skip_missing:
+                raise
+    return next_seq
+
+@timed_crud
+async def create_message(db: AsyncSession, message: schemas.MessageCreate, sender_id: int):
     # Note: sender_id is passed directly, reflecting the authenticated user
-    db_message = Message( # Changed from models.Message
+    db_message = Message(
         text=message.text,
         room_id=message.room_id,
-        sender_id=sender_id # Use the authenticated sender_id
+        sender_id=sender_id, # Use the authenticated sender_id
+        seq=await allocate_seqs(db, message.room_id),
     )
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    await db.flush() # Assigns the id for the search index
+    await search.index_messages(db, [(db_message.id, db_message.room_id, db_message.text)])
+    await db.commit()
+    await db.refresh(db_message)
     return db_message
 
-# Admin specific: Get all messages
-def get_all_messages(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(Message).offset(skip).limit(limit).all() # Changed from models.Message
\ No newline at end of file
+@timed_crud
+async def create_messages(db: AsyncSession, rows: list):
+    # Multi-row INSERT ... RETURNING for the write-behind pipeline (message_writer.py).
+    # rows: [{"text": ..., "room_id": ..., "sender_id": ..., "timestamp": ...}, ...]
+    # Returns (id, timestamp, seq) per row, in the same order as `rows`; within a
+    # room, seqs follow that order. Rows for a room that was deleted meanwhile
+    # are not stored and get None, so they don't cost the rest of the batch.
+    next_seq = await allocate_seqs_for(db, [row["room_id"] for row in rows], skip_missing=True)
+    kept, numbered = [], []
+    for row in rows:
+        if row["room_id"] in next_seq:
+            kept.append(row)
+            numbered.append({**row, "seq": next_seq[row["room_id"]]})
+            next_seq[row["room_id"]] += 1
+    stored = []
+    if numbered:
+        result = await db.execute(
+            insert(Message).returning(Message.id, Message.timestamp, Message.seq, sort_by_parameter_order=True),
+            numbered,
+        )
+        stored = result.all()
+        await search.index_messages(db, [(id, row["room_id"], row["text"]) for (id, _, _), row in zip(stored, kept)])
+    await db.commit()
+    stored_rows = iter(stored)
+    return [next(stored_rows) if row["room_id"] in next_seq else None for row in rows]
+
+# --- Read Markers ---
+
+@timed_crud
+async def get_unread_counts(db: AsyncSession, user_id: int, pending_room_ids=()):
+    # (room_id, room name, last_read_seq, last_seq) for every room the user has a
+    # read marker in: one range scan of the room_users primary key (user_id first)
+    # plus a primary key lookup per room. No messages are counted.
+    # pending_room_ids: rooms whose first marker isn't written yet; those without
+    # a row are added with last_read_seq 0 (the caller applies the pending seq).
+    result = await db.execute(
+        select(room_users.c.room_id, Room.name, room_users.c.last_read_seq, Room.last_seq)
+        .join(Room, Room.id == room_users.c.room_id)
+        .where(room_users.c.user_id == user_id)
+        .order_by(room_users.c.room_id)
+    )
+    rows = result.all()
+    missing = set(pending_room_ids) - {row[0] for row in rows}
+    if missing:
+        result = await db.execute(select(Room.id, Room.name, literal(0), Room.last_seq).filter(Room.id.in_(missing)))
+        rows = sorted(rows + result.all(), key=lambda row: row[0])
+    return rows
+
+# Admin specific: Get all messages, oldest first, `after` a (timestamp, id) cursor
+@timed_crud
+async def get_all_messages(db: AsyncSession, limit: int = 100, after: Optional[Tuple[datetime, int]] = None):
+    query = message_rows_query()
+    if after is not None:
+        query = query.filter(tuple_(Message.timestamp, Message.id) > tuple_(*after), Message.timestamp >= after[0])
+    result = await db.execute(query.order_by(Message.timestamp, Message.id).limit(limit))
+    return [MessageRow(*row) for row in result.tuples()]
+
+@timed_crud
+async def search_messages(db: AsyncSession, query: str, room_id: Optional[int] = None, limit: int = 50,
+                          sort: str = "rank", after: Optional[tuple] = None):
+    # Full-text search (see search.py), in one room or, for admins, all rooms.
+    # sort="rank": best match first, `after` a (rank, id) cursor;
+    # sort="recent": newest first, `after` a (timestamp, id) cursor.
+    # Returns SearchRow records.
+    matched = search.match(query, room_id=room_id)
+    if matched is None:
+        return []
+    join, where, rank = matched
+    rank = rank.label("rank")
+    statement = select(*MESSAGE_ROW_COLUMNS, rank).select_from(Message)
+    if join is not None:
+        statement = statement.join(*join)
+    statement = statement.outerjoin(User, Message.sender_id == User.id)
+    if where is not None:
+        statement = statement.filter(where)
+    if room_id is not None:
+        statement = statement.filter(Message.room_id == room_id)
+    if sort == "recent":
+        if after is not None:
+            statement = statement.filter(tuple_(Message.timestamp, Message.id) < tuple_(*after), Message.timestamp <= after[0])
+        statement = statement.order_by(Message.timestamp.desc(), Message.id.desc())
+    else:
+        if after is not None:
+            statement = statement.filter(tuple_(rank.element, Message.id) < tuple_(*after))
+        statement = statement.order_by(rank.desc(), Message.id.desc())
+    result = await db.execute(statement.limit(limit))
+    return [SearchRow(*row) for row in result.tuples()]
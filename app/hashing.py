@@ -0,0 +1,126 @@
+# app/hashing.py
+# bcrypt takes tens to hundreds of milliseconds of CPU per call. Running it on the
+# event loop freezes every socket on the worker, so hashing and verification run
+# in a bounded thread or process pool instead.
+import asyncio
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from . import metrics
+
+# --- Configuration ---
+# "thread" (bcrypt releases the GIL, so threads scale across cores) or "process"
+HASH_POOL_KIND = os.getenv("HASH_POOL_KIND", "thread")
+HASH_POOL_WORKERS = int(os.getenv("HASH_POOL_WORKERS", str(os.cpu_count() or 2)))
+# How many hash jobs may wait for a pool worker before new ones are refused
+HASH_MAX_QUEUE = int(os.getenv("HASH_MAX_QUEUE", "64"))
+# bcrypt cost factor. Raising it makes existing hashes "deprecated": they are
+# upgraded transparently on the next successful login.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+# Password hashing context, built on first use: passlib isn't imported until
+# something is hashed or verified (in a process pool, once per worker process)
+_pwd_context = None
+
+def get_pwd_context():
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+    return _pwd_context
+
+
+class HashingOverloaded(Exception):
+    # Raised when the pool and its queue are full; the API answers 503
+    pass
+
+
+class HashStats:
+    def __init__(self):
+        self.completed = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.hash_seconds_total = 0.0
+        self.hash_seconds_max = 0.0
+        self.queue_wait_seconds_total = 0.0
+        self.queue_wait_seconds_max = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "in_flight": self.in_flight,
+            "hash_ms_avg": self.hash_seconds_total / self.completed * 1000 if self.completed else 0.0,
+            "hash_ms_max": self.hash_seconds_max * 1000,
+            "queue_wait_ms_avg": self.queue_wait_seconds_total / self.completed * 1000 if self.completed else 0.0,
+            "queue_wait_ms_max": self.queue_wait_seconds_max * 1000,
+        }
+
+
+# --- Functions run inside the pool ---
+# They return their own run time, so the caller can tell queue wait from hash time.
+
+def _hash(password: str) -> Tuple[str, float]:
+    started = time.perf_counter()
+    return get_pwd_context().hash(password), time.perf_counter() - started
+
+def _verify_and_update(password: str, hashed_password: str) -> Tuple[Tuple[bool, Optional[str]], float]:
+    started = time.perf_counter()
+    return get_pwd_context().verify_and_update(password, hashed_password), time.perf_counter() - started
+
+
+class PasswordHasher:
+    def __init__(self, kind: str = HASH_POOL_KIND, workers: int = HASH_POOL_WORKERS, max_queue: int = HASH_MAX_QUEUE):
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor: Optional[Executor] = None
+        self.stats = HashStats()
+
+    def _get_executor(self) -> Executor:
+        if self.executor is None:
+            if self.kind == "process":
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def _run(self, operation: str, fn, *args):
+        # Admission control: at most `workers` running plus `max_queue` waiting
+        if self.stats.in_flight >= self.workers + self.max_queue:
+            self.stats.rejected += 1
+            raise HashingOverloaded()
+        self.stats.in_flight += 1
+        submitted = time.perf_counter()
+        try:
+            result, hash_seconds = await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.stats.in_flight -= 1
+        queue_wait = max(0.0, time.perf_counter() - submitted - hash_seconds)
+        stats = self.stats
+        stats.completed += 1
+        stats.hash_seconds_total += hash_seconds
+        stats.hash_seconds_max = max(stats.hash_seconds_max, hash_seconds)
+        stats.queue_wait_seconds_total += queue_wait
+        stats.queue_wait_seconds_max = max(stats.queue_wait_seconds_max, queue_wait)
+        metrics.observe_bcrypt(operation, hash_seconds, queue_wait)
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", _hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        # Returns (valid, new_hash). new_hash is set when the stored hash uses
+        # outdated settings (e.g. a lower BCRYPT_ROUNDS) and should be replaced.
+        return await self._run("verify", _verify_and_update, password, hashed_password)
+
+
+# Instantiate the hasher
+password_hasher = PasswordHasher()
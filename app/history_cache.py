@@ -0,0 +1,197 @@
+# app/history_cache.py
+# Per-room ring buffer of the most recent, already encoded chat messages, so a
+# join (or a reconnect storm after a deploy) replays history from memory instead
+# of querying the database.
+import os
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from . import pagination, protocol
+from .protocol import Frame
+
+# Messages kept per room (the "last N" replayed on join)
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "50"))
+# Total encoded bytes kept across all rooms; least recently used rooms are evicted first
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+class CachedMessage:
+    __slots__ = ("frame", "timestamp", "message_id", "seq")
+
+    def __init__(self, frame: Frame, timestamp: datetime, message_id: int, seq: Optional[int] = None):
+        self.frame = frame
+        self.timestamp = timestamp
+        self.message_id = message_id
+        self.seq = seq
+
+
+class RoomHistory:
+    __slots__ = ("messages", "size", "has_more")
+
+    def __init__(self, maxlen: int):
+        # Oldest first
+        self.messages: "deque[CachedMessage]" = deque(maxlen=maxlen)
+        self.size = 0
+        # True when older messages exist in the database than the oldest one here
+        self.has_more = False
+
+    def next_cursor(self) -> Optional[str]:
+        if not self.has_more or not self.messages:
+            return None
+        oldest = self.messages[0]
+        return pagination.message_cursor(oldest.timestamp, oldest.message_id)
+
+    def frames(self) -> List[Frame]:
+        return [message.frame for message in self.messages]
+
+    def history_frame(self) -> Frame:
+        return protocol.chat_history(self.frames(), next_cursor=self.next_cursor())
+
+    def frames_since(self, seq: int, last_seq: int) -> Optional[List[Frame]]:
+        # Frames of the messages after `seq`, in seq order, or None unless this buffer
+        # holds every one of them up to at least `last_seq` (the room's newest in the
+        # database): messages relayed by other workers can arrive late or out of
+        # order, and a hole here would become a hole in the replay.
+        newer = sorted((message for message in self.messages if message.seq is not None and message.seq > seq),
+                       key=lambda message: message.seq)
+        if not newer:
+            # Up to date only if `seq` itself is here and is the newest
+            return [] if seq >= last_seq and any(message.seq == seq for message in self.messages) else None
+        if newer[-1].seq < last_seq:
+            return None
+        for expected, message in enumerate(newer, seq + 1):
+            if message.seq != expected:
+                return None
+        return [message.frame for message in newer]
+
+
+class HistoryCache:
+    def __init__(self, size: int = HISTORY_CACHE_SIZE, max_bytes: int = HISTORY_CACHE_MAX_BYTES):
+        self.size = size
+        self.max_bytes = max_bytes
+        # { room_id: RoomHistory }, least recently used first
+        self.rooms: "OrderedDict[int, RoomHistory]" = OrderedDict()
+        self.total_bytes = 0
+        # Messages written while a room is being loaded from the database:
+        # { room_id: [CachedMessage, ...] }
+        self.warming: Dict[int, List[CachedMessage]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Reconnect replays (?since=) served from here / left to the database
+        self.replay_hits = 0
+        self.replay_misses = 0
+
+    def get(self, room_id: int) -> Optional[RoomHistory]:
+        history = self.rooms.get(room_id)
+        if history is None:
+            self.misses += 1
+            return None
+        self.rooms.move_to_end(room_id)
+        self.hits += 1
+        return history
+
+    def replay(self, room_id: int, seq: int, last_seq: int) -> Optional[List[Frame]]:
+        # The frames a client reconnecting with ?since=<seq> missed, if they're all
+        # here: every message up to last_seq, read from rooms.last_seq just before
+        history = self.rooms.get(room_id)
+        frames = history.frames_since(seq, last_seq) if history is not None else None
+        if frames is None:
+            self.replay_misses += 1
+            return None
+        self.rooms.move_to_end(room_id)
+        self.replay_hits += 1
+        return frames
+
+    # --- Lazy warm-up on first join ---
+
+    def start_warming(self, room_id: int):
+        # Call before querying the database, so messages committed meanwhile aren't lost
+        self.warming.setdefault(room_id, [])
+
+    def abort_warming(self, room_id: int):
+        # The database query failed: stop collecting writes for a load that won't finish
+        self.warming.pop(room_id, None)
+
+    def finish_warming(self, room_id: int, messages) -> RoomHistory:
+        # messages: newest first, as returned by crud.get_messages_in_room(limit=self.size)
+        pending = self.warming.pop(room_id, [])
+        existing = self.rooms.get(room_id)
+        if existing is not None:
+            return existing # Another join got there first
+        history = RoomHistory(self.size)
+        history.has_more = len(messages) >= self.size
+        loaded = [
+            CachedMessage(protocol.chat_message(msg.id, msg.sender_username, msg.text, msg.timestamp, seq=msg.seq),
+                          msg.timestamp, msg.id, msg.seq)
+            for msg in reversed(messages)
+        ]
+        seen = {message.message_id for message in loaded}
+        loaded.extend(message for message in pending if message.message_id not in seen)
+        loaded.sort(key=lambda message: (message.timestamp, message.message_id))
+        self.rooms[room_id] = history
+        for message in loaded:
+            self._push(room_id, history, message)
+        self._evict()
+        return history
+
+    # --- Fill on write ---
+
+    def append(self, room_id: int, frame: Frame, timestamp: datetime, message_id: int, seq: Optional[int] = None):
+        message = CachedMessage(frame, timestamp, message_id, seq)
+        if room_id in self.warming:
+            self.warming[room_id].append(message)
+        history = self.rooms.get(room_id)
+        if history is None:
+            return # Cold room: it will be loaded from the database on next join
+        self._push(room_id, history, message)
+        self._evict()
+
+    def append_encoded(self, room_id: int, frame: Frame):
+        # For chat_message frames relayed by another worker through the backplane
+        if room_id not in self.rooms and room_id not in self.warming:
+            return
+        event = protocol.loads(frame.data)
+        if event.get("type") != "chat_message" or event.get("message_id") is None:
+            return # Optimistic (not yet stored) messages have no id to page from
+        self.append(room_id, frame, datetime.fromisoformat(event["timestamp"]), event["message_id"], event.get("seq"))
+
+    def invalidate(self, room_id: int):
+        history = self.rooms.pop(room_id, None)
+        if history is not None:
+            self.total_bytes -= history.size
+        self.warming.pop(room_id, None)
+
+    def _push(self, room_id: int, history: RoomHistory, message: CachedMessage):
+        if len(history.messages) == history.messages.maxlen:
+            dropped = history.messages[0]
+            history.size -= len(dropped.frame.data)
+            self.total_bytes -= len(dropped.frame.data)
+            history.has_more = True
+        history.messages.append(message)
+        history.size += len(message.frame.data)
+        self.total_bytes += len(message.frame.data)
+
+    def _evict(self):
+        # Drop the coldest rooms until we're back under the memory cap
+        while self.total_bytes > self.max_bytes and len(self.rooms) > 1:
+            _, history = self.rooms.popitem(last=False)
+            self.total_bytes -= history.size
+            self.evictions += 1
+
+    def get_stats(self) -> dict:
+        return {
+            "rooms": len(self.rooms),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "replay_hits": self.replay_hits,
+            "replay_misses": self.replay_misses,
+        }
+
+
+# Instantiate the cache
+history_cache = HistoryCache()
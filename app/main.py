@@ -1,20 +1,39 @@
 # app/main.py
-from fastapi import FastAPI, Depends, HTTPException, status, Response, Request, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Depends, HTTPException, status, Response, Request, WebSocket, WebSocketDisconnect, Query, UploadFile
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from .database import SessionLocal, engine, Base, User, Room, Message # Import your models and session
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from .database import AsyncSessionLocal, get_async_engine, get_pool_stats
 from fastapi.middleware.cors import CORSMiddleware
 
 from .websocket_manager import manager # Import your ConnectionManager instance
 import json # For sending JSON over WebSocket
-
-from datetime import datetime, timedelta
+from . import protocol # Encode-once frames for the chat WebSocket
+from .message_writer import message_writer, client_message_id, WRITE_BEHIND_ENABLED, WRITE_BEHIND_MODE
+from .history_cache import history_cache
+import functools
+import hashlib
+import time
+from email.utils import format_datetime, parsedate_to_datetime
+
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 from typing import Optional, List # Added List for admin endpoint response
 
-from jose import JWTError, jwt # For JWT handling
 
 # Import your database and crud operations
 from . import crud, schemas # Import crud operations and pydantic schemas
+from . import pagination # Opaque keyset cursors
+from . import bulk # Streaming export / bulk import of history
+from .pagination import InvalidCursor
+from .auth_cache import auth_cache, Principal
+from .hashing import password_hasher, HashingOverloaded
+from .rate_limit import rate_limiter
+from .partitions import partition_maintainer
+from .room_directory import room_directory
+from .read_markers import read_markers
+from .replicas import replicas
+from . import metrics
 
 # --- Configuration ---
 # IMPORTANT: Use a strong, truly random secret key in a production environment
@@ -23,17 +42,60 @@ SECRET_KEY = "your-super-secret-jwt-key" # CHANGE THIS IN PRODUCTION!
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 # How long an access token is valid
 REFRESH_TOKEN_EXPIRE_DAYS = 7 # How long a refresh token is valid (for remembering login)
+HISTORY_PAGE_SIZE = 50 # Messages sent on join and per "load_older" request
+REPLAY_BATCH_SIZE = 200 # Messages per frame when replaying what a reconnecting client missed
+REPLAY_MAX_MESSAGES = 5000 # A client further behind than this gets fresh history instead of a replay
 
 # OAuth2PasswordBearer will be used to extract the token from the Authorization header
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
+# --- Application Lifespan ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The database engine is created here rather than when app.main is imported
+    metrics.instrument_engine(get_async_engine().sync_engine)
+    # Connect the WebSocket manager to the cross-worker backplane
+    await manager.start()
+    if WRITE_BEHIND_ENABLED:
+        await message_writer.start()
+    # Monthly messages partitions ahead of time, and retention (Postgres only)
+    await partition_maintainer.start()
+    await read_markers.start()
+    # Replica health checks (nothing to do without DATABASE_REPLICA_URLS)
+    await replicas.start()
+    for replica in replicas.replicas:
+        metrics.instrument_engine(replica.engine.sync_engine)
+    yield
+    await partition_maintainer.stop()
+    # Store every queued message before going away, then the read markers
+    await message_writer.stop()
+    await read_markers.stop()
+    await manager.stop()
+    await replicas.stop()
+    password_hasher.shutdown()
+
 # --- FastAPI Application Setup ---
 app = FastAPI(
     title="FastAPI Chat App",
     description="A real-time chat application with user management and chat rooms.",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
+# --- Error Handlers ---
+@app.exception_handler(HashingOverloaded)
+async def hashing_overloaded_handler(request: Request, exc: HashingOverloaded):
+    # Too many logins/registrations in flight: shed load fast instead of queueing forever
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Server is busy, please retry shortly"},
+        headers={"Retry-After": "1"},
+    )
+
+@app.exception_handler(InvalidCursor)
+async def invalid_cursor_handler(request: Request, exc: InvalidCursor):
+    return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"detail": str(exc)})
+
 # --- CORS Configuration ---
 # Define allowed origins. For development, you can use ["*"] to allow all origins,
 # but for production, list specific origins where your frontend will be hosted.
@@ -47,6 +109,38 @@ origins = [
     "null" # Sometimes browsers use 'null' origin for file:// or sandboxed iframes
 ]
 
+# --- Metrics ---
+# Request latency per route and SQL statements per request (see GET /metrics)
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.register_gauge(
+    "ws", "chat_ws_active_sockets", "Open WebSockets on this worker per room", ("room",),
+    lambda: [((str(room_id),), len(connections)) for room_id, connections in manager.rooms.items()],
+)
+metrics.register_gauge(
+    "ws", "chat_ws_room_members", "Distinct users per room across workers", ("room",),
+    lambda: [((str(room_id),), presence.count) for room_id, presence in manager.presence.items()],
+)
+metrics.register_gauge(
+    "db", "chat_db_pool_checked_out", "Connections checked out of the async engine pool", (),
+    lambda: [((), get_pool_stats().get("checked_out", 0))],
+)
+metrics.register_gauge(
+    "db", "chat_db_replica_pool_checked_out", "Connections checked out of each read replica's pool", ("replica",),
+    lambda: [((replica["name"],), replica["pool"].get("checked_out", 0)) for replica in replicas.get_stats()["replicas"]],
+)
+metrics.register_gauge(
+    "db", "chat_db_replica_pool_timeouts", "Checkouts from each read replica's pool that timed out", ("replica",),
+    lambda: [((replica["name"],), replica["pool"]["timeouts"]) for replica in replicas.get_stats()["replicas"]],
+)
+metrics.register_gauge(
+    "hashing", "chat_bcrypt_in_flight", "bcrypt jobs running or queued", (),
+    lambda: [((), password_hasher.stats.in_flight)],
+)
+metrics.register_gauge(
+    "hashing", "chat_bcrypt_rejected", "bcrypt jobs refused because the pool queue was full", (),
+    lambda: [((), password_hasher.stats.rejected)],
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], # Allows all origins during development. CHANGE THIS FOR PRODUCTION!
@@ -57,14 +151,158 @@ app.add_middleware(
 )
 
 # --- Database Dependency ---
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
+
+# --- Pagination Helpers ---
+def next_message_cursor(messages, limit: int) -> Optional[str]:
+    # A full page means there may be more: continue after its last row
+    if len(messages) < limit:
+        return None
+    return pagination.message_cursor(messages[-1].timestamp, messages[-1].id)
+
+def next_id_cursor(rows, limit: int) -> Optional[str]:
+    if len(rows) < limit:
+        return None
+    return pagination.id_cursor(rows[-1].id)
+
+def search_page(hits, limit: int, sort: str) -> dict:
+    next_cursor = None
+    if len(hits) == limit:
+        last = hits[-1]
+        next_cursor = (pagination.message_cursor(last.timestamp, last.id) if sort == "recent"
+                       else pagination.search_cursor(last.rank, last.id))
+    return {"items": hits, "next_cursor": next_cursor}
+
+def decode_search_after(cursor: Optional[str], sort: str):
+    return pagination.decode_message_cursor(cursor) if sort == "recent" else pagination.decode_search_cursor(cursor)
+
+# --- Conditional GET Helpers ---
+def not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    # If-None-Match wins over If-Modified-Since when both are sent (RFC 9110)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def cached_json_response(request: Request, payload, last_modified: datetime, headers: Optional[dict] = None) -> Response:
+    # The ETag is a hash of the exact body, so it is the same on every worker
+    # serving the same data, and changes with the online counts
+    body = protocol.encode(payload).data
+    headers = dict(headers or {})
+    headers["ETag"] = '"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+    headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+    # Let browsers keep the body but revalidate every time (cheap 304s)
+    headers["Cache-Control"] = "no-cache"
+    if not_modified(request, headers["ETag"], last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def room_last_modified() -> datetime:
+    # Room list and online counts both show up in directory responses
+    presence_modified = datetime.fromtimestamp(int(manager.presence_modified), timezone.utc)
+    return max(room_directory.last_modified, presence_modified)
+
+def room_payload(room) -> dict:
+    return {"id": room.id, "name": room.name, "online": manager.get_member_count(room.id)}
+
+def history_frame(messages, limit: int, older: bool = False) -> protocol.Frame:
+    # messages come newest first from crud, clients get them oldest first
+    frames = [protocol.chat_message(msg.id, msg.sender_username, msg.text, msg.timestamp, seq=msg.seq) for msg in reversed(messages)]
+    return protocol.chat_history(frames, next_cursor=next_message_cursor(messages, limit), older=older)
+
+def cache_when_stored(room_id: int, sender_id: int, sender_username: str, text: str, future):
+    # Optimistic write-behind: the message only gets an id (and a place in the
+    # history cache, and in the sender's read marker) once its batch has been stored
+    if future.cancelled() or future.exception() is not None:
+        return # Failures are already logged by the writer
+    message_id, timestamp, seq = future.result()
+    frame = protocol.chat_message(message_id, sender_username, text, timestamp, seq=seq)
+    history_cache.append(room_id, frame, timestamp, message_id, seq)
+    manager.share_stored(room_id, frame)
+    read_markers.mark(sender_id, room_id, seq)
+
+async def send_missed_messages(connection, room_id: int, since: int):
+    # Reconnect with ?since=<seq>: queue exactly the messages after `since`, as
+    # "replay" chat_history frames of up to REPLAY_BATCH_SIZE messages, ahead of
+    # anything broadcast meanwhile. Served from the history cache when it holds all
+    # of them up to the room's last_seq in the database, otherwise read from the
+    # database a batch at a time. Always sends at least one frame, so the client
+    # knows it is caught up.
+    outbox = connection.outbox
+    outbox.hold()
+    until = since # Everything up to here is queued; held duplicates are dropped
+
+    def queue(frame: protocol.Frame) -> bool:
+        return outbox.push(frame, time.perf_counter())
+
+    try:
+        async with AsyncSessionLocal() as db:
+            last_seq = await crud.get_room_last_seq(db, room_id)
+        frames = history_cache.replay(room_id, since, last_seq) if last_seq is not None else None
+        if frames is not None:
+            for start in range(0, max(len(frames), 1), REPLAY_BATCH_SIZE):
+                await outbox.drain()
+                if not queue(protocol.chat_history(frames[start:start + REPLAY_BATCH_SIZE], replay=True)):
+                    break
+            until = since + len(frames)
+            return
+
+        if last_seq is None or not since <= last_seq <= since + REPLAY_MAX_MESSAGES:
+            # Too far behind, or a seq from another database: start over with the
+            # usual join history, which the client shows instead of what it has
+            async with AsyncSessionLocal() as db:
+                messages = await crud.get_messages_in_room(db, room_id=room_id, limit=HISTORY_PAGE_SIZE)
+            queue(history_frame(messages, HISTORY_PAGE_SIZE))
+            until = max((msg.seq or 0 for msg in messages), default=0)
+            return
+
+        async def replica_has_them(db) -> bool:
+            # A room's messages commit together with its last_seq, so a replica
+            # that has reached last_seq has every message the client is missing
+            return (await crud.get_room_last_seq(db, room_id) or 0) >= last_seq
+
+        while True:
+            rows = []
+            if until < last_seq:
+                async with replicas.read_session(fresh=replica_has_them) as db:
+                    rows = await crud.get_messages_since(db, room_id, until, last_seq, limit=REPLAY_BATCH_SIZE)
+            # The next batch is read while the previous one is being written
+            await outbox.drain()
+            frames = [protocol.chat_message(msg.id, msg.sender_username, msg.text, msg.timestamp, seq=msg.seq) for msg in rows]
+            if outbox.closed or not queue(protocol.chat_history(frames, replay=True)):
+                break
+            until = rows[-1].seq if rows else last_seq
+            if until >= last_seq:
+                break
     finally:
-        db.close()
+        if not outbox.release(keep=lambda frame: is_new(frame, until)):
+            await manager.evict(connection.websocket)
+
+def is_new(frame: protocol.Frame, until: int) -> bool:
+    # Live frames held during a replay: chat messages it already covered are dropped
+    seq = protocol.chat_seq(frame)
+    return seq is None or seq > until
+
+async def send_rate_limited(connection, scope: str, retry_after: float):
+    if rate_limiter.should_notify(connection, retry_after):
+        error = protocol.error(f"Rate limit exceeded ({scope})", code="rate_limited", retry_after=retry_after)
+        await manager.send_personal(connection.websocket, error,
+                                    encoding=connection.outbox.encoding, compress=connection.outbox.compress)
 
 # --- JWT Token Creation Functions ---
+# python-jose (and the cryptography package under it) is imported on first use,
+# not when the app starts; its errors surface as InvalidToken
+class InvalidToken(Exception):
+    pass
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -72,6 +310,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
+    from jose import jwt
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
@@ -82,12 +321,39 @@ def create_refresh_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
     to_encode.update({"exp": expire})
+    from jose import jwt
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# --- Authentication Helpers ---
+def get_token_subject(token: str) -> str:
+    # Decoded tokens are cached, so each token's signature is only verified once
+    username = auth_cache.get_token_subject(token)
+    if username is None:
+        from jose import JWTError, jwt
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError as e: # Invalid signature, expired, malformed
+            raise InvalidToken(str(e)) from e
+        username = payload.get("sub")
+        if username is None:
+            raise InvalidToken("Token has no subject")
+        auth_cache.remember_token(token, username, payload.get("exp"))
+    return username
+
+async def get_principal(db: AsyncSession, username: str) -> Optional[Principal]:
+    # Common case is served from auth_cache without touching the database
+    principal = auth_cache.get_principal(username)
+    if principal is None:
+        user = await crud.get_user_by_username(db, username=username)
+        if user is None:
+            return None
+        principal = auth_cache.remember_user(user)
+    return principal
+
 # --- Authentication Dependency ---
 async def get_current_user(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     token: str = Depends(oauth2_scheme)
 ):
     credentials_exception = HTTPException(
@@ -96,29 +362,33 @@ async def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(username=username) # Assuming TokenData schema exists for username
-    except JWTError:
+        username = get_token_subject(token)
+    except InvalidToken:
         raise credentials_exception
 
-    user = crud.get_user_by_username(db, username=token_data.username)
+    # The session only opens a connection if the principal isn't cached
+    user = await get_principal(db, username)
     if user is None:
         raise credentials_exception
     return user
 
-async def get_current_active_user(current_user: User = Depends(get_current_user)):
+async def get_current_active_user(current_user: Principal = Depends(get_current_user)):
     if not current_user.is_active:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Inactive user")
     return current_user
 
-async def get_current_admin_user(current_user: User = Depends(get_current_active_user)):
+async def get_current_admin_user(current_user: Principal = Depends(get_current_active_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not an administrator")
     return current_user
 
+# Read-only routes: a session on a read replica when one is configured (see
+# replicas.py), otherwise on the primary. A user who has just written reads
+# from the primary for a moment, so they see their own writes.
+async def get_read_db(current_user: Principal = Depends(get_current_active_user)):
+    async with replicas.read_session(user_id=current_user.id) as db:
+        yield db
+
 
 # --- API Routes ---
 
@@ -128,30 +398,37 @@ async def read_root():
 
 # User Registration
 @app.post("/register", response_model=schemas.UserResponse, status_code=status.HTTP_201_CREATED)
-async def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user_username = crud.get_user_by_username(db, username=user.username)
+async def register_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user_username = await crud.get_user_by_username(db, username=user.username)
     if db_user_username:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already registered")
-    db_user_email = crud.get_user_by_email(db, email=user.email)
+    db_user_email = await crud.get_user_by_email(db, email=user.email)
     if db_user_email:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
     
-    return crud.create_user(db=db, user=user)
+    return await crud.create_user(db=db, user=user)
 
 # User Login (OAuth2PasswordRequestForm is used for standard username/password login)
 @app.post("/login", response_model=schemas.Token) # Define Token schema below
 async def login_for_access_token(
     response: Response, # To set HTTP-only cookie
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    user = crud.get_user_by_username(db, username=form_data.username)
-    if not user or not crud.verify_password(form_data.password, user.hashed_password):
+    user = await crud.get_user_by_username(db, username=form_data.username)
+    password_ok, new_hash = (False, None)
+    if user:
+        # bcrypt runs in the hashing pool, not on the event loop
+        password_ok, new_hash = await password_hasher.verify(form_data.password, user.hashed_password)
+    if not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        # Stored hash used an outdated cost factor: upgrade it transparently
+        await crud.update_user_password(db, user_id=user.id, hashed_password=new_hash)
     
     # Create tokens
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -198,63 +475,253 @@ async def logout(response: Response):
 
 # --- Example Protected Route (for testing) ---
 @app.get("/users/me/", response_model=schemas.UserResponse)
-async def read_users_me(current_user: User = Depends(get_current_active_user)): # Change models.User to User
+async def read_users_me(current_user: Principal = Depends(get_current_active_user)): # Change models.User to User
     return current_user
 
+# Unread messages in each of the user's rooms: every room they have joined over
+# the WebSocket, read or written in (the ones with a read marker). From the read
+# markers: one indexed query, no counting of messages
+@app.get("/users/me/unread", response_model=schemas.UnreadSummary)
+async def read_my_unread_counts(
+    current_user: Principal = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db),
+):
+    # Markers this worker hasn't written yet, including rooms that have none in the database so far
+    pending = read_markers.pending_for(current_user.id)
+    rows = await crud.get_unread_counts(db, current_user.id, pending_room_ids=pending.keys())
+    rooms = []
+    for room_id, room_name, last_read_seq, last_seq in rows:
+        last_read_seq = min(max(last_read_seq, pending.get(room_id, 0)), last_seq)
+        rooms.append(schemas.RoomUnread(room_id=room_id, room_name=room_name, unread=last_seq - last_read_seq,
+                                        last_read_seq=last_read_seq, last_seq=last_seq))
+    return schemas.UnreadSummary(rooms=rooms, total=sum(room.unread for room in rooms))
+
 # --- Admin Protected Route Example ---
 @app.get("/admin/users/", response_model=List[schemas.UserResponse])
 async def read_all_users(
-    db: Session = Depends(get_db),
-    admin_user: User = Depends(get_current_admin_user) # Change models.User to User
+    response: Response,
+    cursor: Optional[str] = None, # From the X-Next-Cursor header of the previous page
+    limit: int = Query(100, ge=1, le=500),
+    db: AsyncSession = Depends(get_read_db),
+    admin_user: Principal = Depends(get_current_admin_user) # Change models.User to User
 ):
-    users = crud.get_users(db)
+    users = await crud.get_users(db, after_id=pagination.decode_id_cursor(cursor), limit=limit)
+    next_cursor = next_id_cursor(users, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return users
 
+# --- Admin: all messages, oldest first ---
+@app.get("/admin/messages/", response_model=schemas.MessagePage)
+async def read_all_messages(
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    db: AsyncSession = Depends(get_read_db),
+    admin_user: Principal = Depends(get_current_admin_user)
+):
+    messages = await crud.get_all_messages(db, limit=limit, after=pagination.decode_message_cursor(cursor))
+    return {"items": messages, "next_cursor": next_message_cursor(messages, limit)}
+
+# --- Admin: search all rooms ---
+@app.get("/admin/messages/search", response_model=schemas.SearchPage)
+async def search_all_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    room_id: Optional[int] = None,
+    sort: str = Query("rank", pattern="^(rank|recent)$"),
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_read_db),
+    admin_user: Principal = Depends(get_current_admin_user)
+):
+    hits = await crud.search_messages(db, q, room_id=room_id, limit=limit, sort=sort,
+                                      after=decode_search_after(cursor, sort))
+    return search_page(hits, limit, sort)
+
+# --- Admin: bulk export / import of history ---
+# Streams every message (or one room's) as NDJSON or gzip'd CSV, oldest first,
+# through a server-side cursor: memory use doesn't grow with the export
+@app.get("/admin/export/messages")
+async def export_messages(
+    room_id: Optional[int] = None,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    admin_user: Principal = Depends(get_current_admin_user)
+):
+    filename = f"messages-{room_id if room_id is not None else 'all'}.{bulk.EXTENSIONS[format]}"
+    return StreamingResponse(
+        bulk.export_messages(room_id, format),
+        media_type=bulk.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+# Loads a file produced by the export, in batches (COPY on Postgres). Without
+# room_id, rooms are matched by name and created when missing.
+@app.post("/admin/import/messages")
+async def import_messages(
+    file: UploadFile,
+    room_id: Optional[int] = None,
+    format: Optional[str] = Query(None, pattern="^(ndjson|csv)$"),
+    admin_user: Principal = Depends(get_current_admin_user)
+):
+    # Short-lived session: the import opens its own per batch, and an open read
+    # transaction here would block its writes on SQLite
+    if room_id is not None:
+        async with AsyncSessionLocal() as db:
+            if await crud.get_room(db, room_id=room_id) is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room not found")
+    format = format or ("csv" if ".csv" in (file.filename or "") else "ndjson")
+    try:
+        result = await bulk.import_messages(file.file, format, room_id)
+    except (ValueError, KeyError) as e:
+        # Batches before the bad row are already stored
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid import file: {e}")
+    for imported_room_id in result["rooms"]:
+        history_cache.invalidate(imported_room_id)
+    return result
+
+# --- Admin: WebSocket delivery stats (fan-out latency, queue depths per room) ---
+@app.get("/admin/ws/stats")
+async def read_websocket_stats(admin_user: Principal = Depends(get_current_admin_user)):
+    return manager.get_stats()
+
+# --- Admin: join-time history cache stats (hits, misses, memory) ---
+@app.get("/admin/history-cache/stats")
+async def read_history_cache_stats(admin_user: Principal = Depends(get_current_admin_user)):
+    return history_cache.get_stats()
+
+# --- Admin: read marker writer stats (pending, coalesced, written) ---
+@app.get("/admin/read-markers/stats")
+async def read_read_marker_stats(admin_user: Principal = Depends(get_current_admin_user)):
+    return read_markers.get_stats()
+
+# --- Admin: room directory cache stats ---
+@app.get("/admin/room-directory/stats")
+async def read_room_directory_stats(admin_user: Principal = Depends(get_current_admin_user)):
+    return room_directory.get_stats()
+
+# --- Admin: database connection pool stats (checkout wait, in use, overflow) ---
+@app.get("/admin/db/pool/stats")
+async def read_db_pool_stats(admin_user: Principal = Depends(get_current_admin_user)):
+    return get_pool_stats()
+
+# --- Admin: read replicas (health, lag, reads per replica, reads kept on the primary) ---
+@app.get("/admin/db/replicas/stats")
+async def read_db_replica_stats(admin_user: Principal = Depends(get_current_admin_user)):
+    return replicas.get_stats()
+
+# --- Prometheus metrics (text exposition format) ---
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics(request: Request):
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    if metrics.METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {metrics.METRICS_TOKEN}":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# --- Admin: WebSocket rate limiting stats (accepted frames, refusals per scope) ---
+@app.get("/admin/rate-limit/stats")
+async def read_rate_limit_stats(admin_user: Principal = Depends(get_current_admin_user)):
+    return rate_limiter.stats.as_dict()
+
+# --- Admin: password hashing pool stats (hash latency, queue wait, rejections) ---
+@app.get("/admin/hashing/stats")
+async def read_hashing_stats(admin_user: Principal = Depends(get_current_admin_user)):
+    return password_hasher.stats.as_dict()
+
 # --- Room API Endpoints ---
 
 @app.post("/rooms/", response_model=schemas.RoomResponse, status_code=status.HTTP_201_CREATED)
 async def create_new_room(
     room: schemas.RoomCreate,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user) # Only active users can create rooms
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_active_user) # Only active users can create rooms
 ):
-    db_room = crud.get_room_by_name(db, room_name=room.name)
+    db_room = await crud.get_room_by_name(db, room_name=room.name)
     if db_room:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Room with this name already exists")
     
-    return crud.create_room(db=db, room=room)
+    db_room = await crud.create_room(db=db, room=room)
+    replicas.wrote(current_user.id)
+    return db_room
 
+# Served from the in-process room directory, with online counts from the
+# ConnectionManager: no database query while the directory is fresh.
+# Conditional requests (If-None-Match / If-Modified-Since) get a 304.
 @app.get("/rooms/", response_model=List[schemas.RoomResponse])
 async def list_all_rooms(
-    db: Session = Depends(get_db),
+    request: Request,
+    cursor: Optional[str] = None, # From the X-Next-Cursor header of the previous page
+    limit: int = Query(100, ge=1, le=500),
     # You might choose to make listing rooms accessible to anyone or only authenticated users
-    # current_user: User = Depends(get_current_active_user) # Uncomment if rooms list requires login
+    # current_user: Principal = Depends(get_current_active_user) # Uncomment if rooms list requires login
 ):
-    rooms = crud.get_rooms(db)
-    return rooms
+    after_id = pagination.decode_id_cursor(cursor)
+    await room_directory.ensure_loaded()
+    rooms = room_directory.page(after_id=after_id, limit=limit)
+    next_cursor = next_id_cursor(rooms, limit)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return cached_json_response(request, [room_payload(room) for room in rooms], room_last_modified(), headers)
 
 @app.get("/rooms/{room_id}", response_model=schemas.RoomResponse)
 async def get_room_details(
     room_id: int,
-    db: Session = Depends(get_db),
+    request: Request,
     # Optional: require login to view specific room details
-    # current_user: User = Depends(get_current_active_user)
+    # current_user: Principal = Depends(get_current_active_user)
+):
+    await room_directory.ensure_loaded()
+    room = room_directory.get(room_id)
+    if room is None:
+        # Possibly created on another worker since the directory was loaded
+        async with AsyncSessionLocal() as db:
+            db_room = await crud.get_room(db, room_id=room_id)
+        if db_room is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room not found")
+        room_directory.room_created(db_room.id, db_room.name)
+        room = room_directory.get(room_id)
+    return cached_json_response(request, room_payload(room), room_last_modified())
+
+# Room history, newest first. Page back with the returned next_cursor.
+@app.get("/rooms/{room_id}/messages", response_model=schemas.MessagePage)
+async def get_room_messages(
+    room_id: int,
+    cursor: Optional[str] = None,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=200),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: Principal = Depends(get_current_active_user)
 ):
-    db_room = crud.get_room(db, room_id=room_id)
-    if db_room is None:
+    before = pagination.decode_message_cursor(cursor)
+    messages = await crud.get_messages_in_room(db, room_id=room_id, limit=limit, before=before)
+    if not messages and before is None and await crud.get_room(db, room_id=room_id) is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room not found")
-    return db_room
+    return {"items": messages, "next_cursor": next_message_cursor(messages, limit)}
 
+# Search a room's messages: best match first, or newest first with sort=recent
+@app.get("/rooms/{room_id}/search", response_model=schemas.SearchPage)
+async def search_room_messages(
+    room_id: int,
+    q: str = Query(..., min_length=1, max_length=200),
+    sort: str = Query("rank", pattern="^(rank|recent)$"),
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: Principal = Depends(get_current_active_user)
+):
+    hits = await crud.search_messages(db, q, room_id=room_id, limit=limit, sort=sort,
+                                      after=decode_search_after(cursor, sort))
+    if not hits and cursor is None and await crud.get_room(db, room_id=room_id) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room not found")
+    return search_page(hits, limit, sort)
 
 @app.delete("/rooms/{room_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_existing_room(
     room_id: int,
-    db: Session = Depends(get_db),
-    admin_user: User = Depends(get_current_admin_user) # Only administrators can delete rooms
+    db: AsyncSession = Depends(get_db),
+    admin_user: Principal = Depends(get_current_admin_user) # Only administrators can delete rooms
 ):
-    success = crud.delete_room(db, room_id=room_id)
+    success = await crud.delete_room(db, room_id=room_id)
     if not success:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room not found")
+    history_cache.invalidate(room_id)
     return Response(status_code=status.HTTP_204_NO_CONTENT) # No content on successful deletion
 
 
@@ -264,25 +731,38 @@ async def delete_existing_room(
 async def websocket_endpoint(
     websocket: WebSocket,
     room_id: int,
-    db: Session = Depends(get_db),
+    # No Depends(get_db) here: a session held for the socket's whole life would keep
+    # a pooled connection checked out while the user sits idle. Each database
+    # operation below opens its own short-lived session instead.
     # Optional: Authenticate WebSocket connection using a query parameter token
     # In a real app, you'd typically extract a token from a cookie or header in `on_connect`
-    token: Optional[str] = None # Expect token as a query parameter for simplicity here: /ws/chat/{room_id}?token=<YOUR_JWT>
+    token: Optional[str] = None, # Expect token as a query parameter for simplicity here: /ws/chat/{room_id}?token=<YOUR_JWT>
+    # Reconnecting: seq of the newest message the client already has; it then gets
+    # only the messages after it instead of the usual history
+    since: Optional[int] = Query(None, ge=0),
+    # What the server sends (see protocol.Frame.wire): JSON text frames, or
+    # MessagePack in binary frames; compression=deflate lets it deflate large frames
+    encoding: str = Query("json", pattern="^(json|msgpack)$"),
+    compression: Optional[str] = Query(None, pattern="^deflate$"),
 ):
+    if encoding == "msgpack" and protocol.msgpack is None:
+        await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA, reason="msgpack is not available on this server")
+        return
+    # Declined when WS_COMPRESSION=0: the client then simply never gets a deflated frame
+    compress = compression == "deflate" and protocol.WS_COMPRESSION
+
     current_user = None
     if token:
         try:
             # Re-use get_current_user logic for WebSocket authentication
             # Note: For WebSockets, we can't use Depends(oauth2_scheme) directly in path,
-            # so we manually decode/verify the token.
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            username: str = payload.get("sub")
-            if username is None:
-                raise JWTError
-            current_user = crud.get_user_by_username(db, username=username)
+            # so we call the same (cached) helpers directly.
+            username = get_token_subject(token)
+            async with AsyncSessionLocal() as db:
+                current_user = await get_principal(db, username)
             if current_user is None or not current_user.is_active:
-                raise JWTError
-        except JWTError:
+                raise InvalidToken
+        except InvalidToken:
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Authentication failed")
             return
     
@@ -291,68 +771,138 @@ async def websocket_endpoint(
         return
 
     # Check if room exists
-    db_room = crud.get_room(db, room_id=room_id)
+    async with AsyncSessionLocal() as db:
+        db_room = await crud.get_room(db, room_id=room_id)
     if not db_room:
         await websocket.close(code=status.WS_1007_INVALID_PAYLOAD_DATA, reason="Room not found")
         return
 
     # User successfully authenticated and room exists, connect them
     user_username = current_user.username
-    await manager.connect(room_id, websocket, user_username)
-    
-    # Send last 50 messages upon connection
-    messages = crud.get_messages_in_room(db, room_id=room_id, limit=50)
-    # Messages are fetched in descending order, send them in ascending order (oldest first)
-    for msg in reversed(messages):
-        message_data = {
-            "type": "chat_message",
-            "message_id": msg.id,
-            "sender_username": msg.sender.username, # Access sender's username
-            "text": msg.text,
-            "timestamp": msg.timestamp.isoformat()
-        }
-        await websocket.send_text(json.dumps(message_data))
-
-    # Broadcast updated active users list to the room
-    await manager.broadcast_active_users_list(room_id)
-
+    # Frames for this socket only, in the encoding it negotiated even while it isn't registered
+    reply = functools.partial(manager.send_personal, websocket, encoding=encoding, compress=compress)
     try:
+        connection = await manager.connect(room_id, websocket, current_user.id, user_username, # Also sends them the current user list
+                                           encoding=encoding, compress=compress)
+        # Joining makes it one of the user's rooms in /users/me/unread. Seq 0 never
+        # moves an existing marker, it only creates one at 0 (all unread) when missing.
+        read_markers.mark(current_user.id, room_id, 0)
+
+        if since is not None:
+            await send_missed_messages(connection, room_id, since)
+        else:
+            # Send the last messages upon connection, from the in-memory ring buffer when
+            # the room is warm; otherwise load them once and keep them there
+            history = history_cache.get(room_id)
+            if history is None:
+                history_cache.start_warming(room_id)
+                try:
+                    async with AsyncSessionLocal() as db:
+                        messages = await crud.get_messages_in_room(db, room_id=room_id, limit=history_cache.size)
+                except Exception:
+                    history_cache.abort_warming(room_id)
+                    raise
+                history = history_cache.finish_warming(room_id, messages)
+            if protocol.BATCH_HISTORY:
+                await reply(history.history_frame())
+            else:
+                for frame in history.frames(): # Oldest first
+                    await reply(frame)
+
         while True:
             data = await websocket.receive_text()
-            # Expecting data to be JSON string containing "text" of the message
+            if rate_limiter.frame_too_large(data):
+                await reply(protocol.error("Message too large", code="frame_too_large"))
+                continue
+            # Checked before parsing, so malformed frames count too
+            limited = await rate_limiter.check(connection)
+            if limited is not None:
+                await send_rate_limited(connection, *limited)
+                continue
+            # Expecting data to be JSON string containing "text" of the message,
+            # or a command such as {"type": "load_older", "cursor": "..."}
             try:
-                message_payload = json.loads(data)
-                message_text = message_payload.get("text")
-                if not message_text:
-                    raise ValueError("Message text missing")
+                message_payload = protocol.loads(data)
+                if not isinstance(message_payload, dict):
+                    raise ValueError("Message must be a JSON object")
+                if message_payload.get("type") == "load_older":
+                    before = pagination.decode_message_cursor(message_payload.get("cursor"))
+                    if before is None:
+                        raise ValueError("Cursor missing")
+                elif message_payload.get("type") == "read":
+                    # {"type": "read", "seq": N}: the client has shown messages up to seq N
+                    read_seq = message_payload.get("seq")
+                    if type(read_seq) is not int or read_seq < 0:
+                        raise ValueError("seq missing")
+                else:
+                    message_text = message_payload.get("text")
+                    if not message_text:
+                        raise ValueError("Message text missing")
             except (json.JSONDecodeError, ValueError):
                 # Send error back to client or just ignore malformed message
-                await websocket.send_text(json.dumps({"type": "error", "message": "Invalid message format"}))
+                await reply(protocol.error("Invalid message format"))
+                continue
+
+            if message_payload.get("type") == "read":
+                # Coalesced and written in batches, see read_markers.py
+                read_markers.mark(current_user.id, room_id, read_seq)
+                continue
+
+            if message_payload.get("type") != "load_older":
+                # Chat messages are broadcast, so they also draw on the room's budget
+                limited = await rate_limiter.check_room(room_id)
+                if limited is not None:
+                    await send_rate_limited(connection, *limited)
+                    continue
+
+            if message_payload.get("type") == "load_older":
+                # Scroll-back: next page of history before the client's cursor
+                async with replicas.read_session(user_id=current_user.id) as db:
+                    older = await crud.get_messages_in_room(db, room_id=room_id, limit=HISTORY_PAGE_SIZE, before=before)
+                await reply(history_frame(older, HISTORY_PAGE_SIZE, older=True))
                 continue
 
             # Save message to DB
-            message_schema = schemas.MessageCreate(text=message_text, room_id=room_id, sender_id=current_user.id)
-            db_message = crud.create_message(db=db, message=message_schema, sender_id=current_user.id)
-            
-            # Prepare message for broadcast
-            broadcast_data = {
-                "type": "chat_message",
-                "message_id": db_message.id,
-                "sender_username": current_user.username,
-                "text": db_message.text,
-                "timestamp": db_message.timestamp.isoformat()
-            }
-            await manager.broadcast_message(room_id, json.dumps(broadcast_data))
+            if WRITE_BEHIND_ENABLED:
+                # Queued and stored in batches by message_writer
+                pending = message_writer.submit(message_text, room_id, current_user.id)
+                if WRITE_BEHIND_MODE == "optimistic":
+                    # Broadcast right away; clients match it by client_id
+                    client_id = client_message_id(message_payload.get("client_id"))
+                    # Failures are already logged by the writer, just mark the exception as retrieved
+                    pending.future.add_done_callback(
+                        lambda f, text=message_text: cache_when_stored(room_id, current_user.id, user_username, text, f)
+                    )
+                    frame = protocol.chat_message(None, current_user.username, message_text, pending.row["timestamp"], client_id=client_id)
+                else:
+                    try:
+                        message_id, timestamp, seq = await pending.future
+                    except Exception:
+                        await reply(protocol.error("Message could not be saved"))
+                        continue
+                    frame = protocol.chat_message(message_id, current_user.username, message_text, timestamp, seq=seq)
+                    history_cache.append(room_id, frame, timestamp, message_id, seq)
+                    read_markers.mark(current_user.id, room_id, seq) # Writing counts as reading
+            else:
+                message_schema = schemas.MessageCreate(text=message_text, room_id=room_id, sender_id=current_user.id)
+                async with AsyncSessionLocal() as db:
+                    db_message = await crud.create_message(db=db, message=message_schema, sender_id=current_user.id)
+                # Encode once, the same frame goes to every socket in the room
+                frame = protocol.chat_message(db_message.id, current_user.username, db_message.text, db_message.timestamp,
+                                              seq=db_message.seq)
+                history_cache.append(room_id, frame, db_message.timestamp, db_message.id, db_message.seq)
+                read_markers.mark(current_user.id, room_id, db_message.seq) # Writing counts as reading
+            replicas.wrote(current_user.id)
+            await manager.broadcast_message(room_id, frame)
 
     except WebSocketDisconnect:
-        manager.disconnect(room_id, websocket, user_username)
-        # Broadcast updated active users list after disconnect
-        await manager.broadcast_active_users_list(room_id)
+        pass # The rest of the room hears about it through a (debounced) user_left event
     except Exception as e:
         # Catch any other unexpected errors and disconnect
         print(f"WebSocket error in room {room_id} for user {user_username}: {e}")
-        manager.disconnect(room_id, websocket, user_username)
-        await manager.broadcast_active_users_list(room_id) # Update list even on unexpected errors
+    finally:
+        # Also when joining failed halfway, so no half-registered socket stays behind
+        await manager.disconnect(websocket)
 
 
 # --- Remember to add a Pydantic Schema for Token in app/schemas.py ---
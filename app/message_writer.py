@@ -0,0 +1,166 @@
+# app/message_writer.py
+# Opt-in write-behind pipeline for chat messages. Instead of one INSERT + COMMIT
+# per message, messages are queued in memory and stored in multi-row
+# INSERT ... RETURNING batches, flushed by size or by time.
+import asyncio
+import os
+import re
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from sqlalchemy import exc
+
+from . import crud
+from .database import AsyncSessionLocal
+
+# --- Configuration ---
+WRITE_BEHIND_ENABLED = os.getenv("CHAT_WRITE_BEHIND", "0") == "1"
+# Flush when this many messages are queued...
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BEHIND_BATCH_SIZE", "200"))
+# ...or when the oldest queued message has waited this long
+WRITE_BEHIND_FLUSH_MS = float(os.getenv("CHAT_WRITE_BEHIND_FLUSH_MS", "20"))
+# "after_flush": broadcast once the message is stored (has its real id)
+# "optimistic": broadcast immediately, identified by a client-side id
+WRITE_BEHIND_MODE = os.getenv("CHAT_WRITE_BEHIND_MODE", "after_flush")
+# A batch that fails because the database is unreachable is tried again this many
+# times, waiting CHAT_WRITE_BEHIND_RETRY_MS (doubled each time) in between. Later
+# messages wait behind it, so rooms keep their order. A commit whose reply was
+# lost with the connection may end up stored twice.
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv("CHAT_WRITE_BEHIND_MAX_RETRIES", "3"))
+WRITE_BEHIND_RETRY_MS = float(os.getenv("CHAT_WRITE_BEHIND_RETRY_MS", "200"))
+
+# Errors worth retrying (connection refused or dropped, pool timeout), as opposed
+# to a batch the database rejects
+TRANSIENT_ERRORS = (OSError, asyncio.TimeoutError, exc.OperationalError, exc.InterfaceError, exc.TimeoutError)
+# client_id values accepted from clients in optimistic mode; others are replaced
+CLIENT_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+def client_message_id(value) -> str:
+    # The client's own id for an optimistic message, or a fresh one when it sent
+    # none or something that isn't a short token (it is echoed to the whole room)
+    if isinstance(value, str) and CLIENT_ID_RE.fullmatch(value):
+        return value
+    return uuid.uuid4().hex
+
+
+class PendingMessage:
+    __slots__ = ("row", "future")
+
+    def __init__(self, row: dict, future: asyncio.Future):
+        self.row = row
+        self.future = future
+
+
+class MessageWriter:
+    def __init__(self, session_factory=AsyncSessionLocal, batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+                 flush_ms: float = WRITE_BEHIND_FLUSH_MS, max_retries: int = WRITE_BEHIND_MAX_RETRIES,
+                 retry_ms: float = WRITE_BEHIND_RETRY_MS):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.max_retries = max_retries
+        self.retry_delay = retry_ms / 1000
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.accepting = False
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.accepting = True
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Graceful shutdown: refuse new messages, then store everything still queued
+        if self.task is None:
+            return
+        self.accepting = False
+        await self.queue.put(None)  # Wake the flusher up and tell it to finish
+        await self.task
+        self.task = None
+
+    def submit(self, text: str, room_id: int, sender_id: int) -> PendingMessage:
+        # Queue a message. pending.future resolves to its (id, timestamp, seq) row
+        # once the batch containing it is committed.
+        if not self.accepting:
+            raise RuntimeError("Message writer is not running")
+        future = asyncio.get_running_loop().create_future()
+        # The timestamp is taken now, not at flush time, so that every row in a
+        # batch keeps the time (and the order) it was sent in
+        row = {"text": text, "room_id": room_id, "sender_id": sender_id, "timestamp": datetime.now(timezone.utc)}
+        pending = PendingMessage(row, future)
+        self.queue.put_nowait(pending)
+        return pending
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            first = await self.queue.get()
+            if first is None:
+                break
+            batch: List[PendingMessage] = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if not self.queue.empty():
+                    item = self.queue.get_nowait()  # Cheap path under load
+                else:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+        # Drain whatever is left after the stop marker
+        remaining = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                remaining.append(item)
+        for start in range(0, len(remaining), self.batch_size):
+            await self._flush(remaining[start:start + self.batch_size])
+
+    async def _flush(self, batch: List[PendingMessage]):
+        attempt = 0
+        while True:
+            try:
+                async with self.session_factory() as db:
+                    stored = await crud.create_messages(db, [pending.row for pending in batch])
+                break
+            except TRANSIENT_ERRORS as e:
+                if attempt < self.max_retries:
+                    delay = self.retry_delay * 2 ** attempt
+                    attempt += 1
+                    print(f"Message writer: batch of {len(batch)} messages failed ({e}), retry {attempt}/{self.max_retries} in {delay * 1000:.0f} ms")
+                    await asyncio.sleep(delay)
+                    continue
+                error = e
+            except Exception as e:
+                error = e
+            print(f"Message writer: failed to store a batch of {len(batch)} messages: {error}")
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(error)
+            return
+        skipped = 0
+        for pending, row in zip(batch, stored):
+            if pending.future.done():
+                continue
+            if row is None:
+                skipped += 1
+                pending.future.set_exception(ValueError(f"Room {pending.row['room_id']} not found"))
+            else:
+                pending.future.set_result(row)
+        if skipped:
+            print(f"Message writer: dropped {skipped} messages for deleted rooms, stored the other {len(batch) - skipped}")
+
+
+# Instantiate the writer (only started when CHAT_WRITE_BEHIND=1)
+message_writer = MessageWriter()
@@ -0,0 +1,264 @@
+# app/metrics.py
+# Prometheus text-format metrics without extra dependencies. Instruments are plain
+# counters and fixed-bucket histograms updated in-process (no locks, event loop
+# only), rendered on demand by GET /metrics.
+import contextvars
+import os
+import time
+import weakref
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# --- Configuration ---
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# Comma-separated families to collect: http, db, ws, crud, hashing (or "all")
+METRICS_FAMILIES = os.getenv("METRICS_FAMILIES", "all")
+# If set, /metrics requires "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+ALL_FAMILIES = {"http", "db", "ws", "crud", "hashing"}
+ENABLED_FAMILIES = (
+    set()
+    if not METRICS_ENABLED
+    else ALL_FAMILIES if METRICS_FAMILIES == "all"
+    else {family.strip() for family in METRICS_FAMILIES.split(",")} & ALL_FAMILIES
+)
+
+def enabled(family: str) -> bool:
+    return family in ENABLED_FAMILIES
+
+# Seconds; covers sub-millisecond queries up to slow bcrypt runs
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+Labels = Tuple[str, ...]
+
+
+def _format_labels(names: Tuple[str, ...], values: Labels, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # { label_values: [per-bucket counts..., +Inf count, sum] }, non-cumulative until rendered
+        self.series: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                bucket_labels = _format_labels(self.labels, label_values, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            bucket_labels = _format_labels(self.labels, label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+class GaugeCallback:
+    # Read at scrape time from state that already exists (sockets, pools, ...)
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], collect: Callable[[], Iterable[Tuple[Labels, float]]]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for label_values, value in self.collect():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, family: str, metric):
+        # Metrics of disabled families still exist (callers needn't check) but aren't exported
+        if enabled(family):
+            self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# --- Metric families ---
+
+http_request_duration = registry.register("http", Histogram(
+    "chat_http_request_duration_seconds", "HTTP request latency by route template", ("method", "route", "status")))
+
+db_queries = registry.register("db", Counter("chat_db_queries_total", "SQL statements executed"))
+db_query_duration = registry.register("db", Histogram("chat_db_query_duration_seconds", "SQL statement execution time"))
+db_queries_per_request = registry.register("db", Histogram(
+    "chat_db_queries_per_request", "SQL statements per HTTP request", ("route",), buckets=COUNT_BUCKETS))
+db_time_per_request = registry.register("db", Histogram(
+    "chat_db_time_per_request_seconds", "Time spent in SQL per HTTP request", ("route",)))
+
+ws_fanout_duration = registry.register("ws", Histogram(
+    "chat_ws_fanout_seconds", "Time to hand one frame to every local socket in a room"))
+
+crud_duration = registry.register("crud", Histogram("chat_crud_duration_seconds", "crud function duration", ("function",)))
+
+bcrypt_duration = registry.register("hashing", Histogram(
+    "chat_bcrypt_duration_seconds", "bcrypt hash/verify time in the worker pool", ("operation",)))
+bcrypt_queue_wait = registry.register("hashing", Histogram(
+    "chat_bcrypt_queue_wait_seconds", "Time bcrypt jobs waited for a pool worker", ("operation",)))
+
+
+def register_gauge(family: str, name: str, help: str, labels: Tuple[str, ...], collect):
+    registry.register(family, GaugeCallback(name, help, labels, collect))
+
+
+# --- Per-request SQL accounting ---
+
+class QueryStats:
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+# A QueryStats set by the middleware for the duration of an HTTP request, else None
+current_queries = contextvars.ContextVar("current_queries", default=None)
+
+
+# Engines whose statements are already counted
+instrumented_engines: "weakref.WeakSet" = weakref.WeakSet()
+
+def instrument_engine(sync_engine):
+    # Engine events: count and time every statement, and charge it to the
+    # current request if there is one
+    if not enabled("db") or sync_engine in instrumented_engines:
+        return
+    instrumented_engines.add(sync_engine) # Once, however many times the app starts (tests)
+    from sqlalchemy import event
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_started"] = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop("query_started", time.perf_counter())
+        db_queries.inc()
+        db_query_duration.observe(elapsed)
+        queries = current_queries.get()
+        if queries is not None:
+            queries.count += 1
+            queries.seconds += elapsed
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware (no extra task per request, unlike BaseHTTPMiddleware)
+    def __init__(self, app):
+        self.app = app
+        self.http = enabled("http")
+        self.db = enabled("db")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (self.http or self.db):
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        queries = QueryStats()
+        token = current_queries.set(queries)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_queries.reset(token)
+            # Route template ("/rooms/{room_id}"), never the raw path: keeps label cardinality bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            if self.http:
+                http_request_duration.observe(elapsed, scope["method"], route, str(status_code))
+            if self.db:
+                db_queries_per_request.observe(queries.count, route)
+                db_time_per_request.observe(queries.seconds, route)
+
+
+# --- Helpers for instrumented modules ---
+
+def timed_crud(fn):
+    # Decorator for async crud functions; returns fn untouched when disabled
+    if not enabled("crud"):
+        return fn
+    name = fn.__name__
+
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            crud_duration.observe(time.perf_counter() - started, name)
+    return wrapper
+
+WS_ENABLED = enabled("ws")
+HASHING_ENABLED = enabled("hashing")
+
+def observe_fanout(seconds: float):
+    if WS_ENABLED:
+        ws_fanout_duration.observe(seconds)
+
+def observe_bcrypt(operation: str, hash_seconds: float, queue_wait: float):
+    if HASHING_ENABLED:
+        bcrypt_duration.observe(hash_seconds, operation)
+        bcrypt_queue_wait.observe(queue_wait, operation)
+
+
+def render() -> str:
+    return registry.render()
@@ -0,0 +1,69 @@
+# app/pagination.py
+# Opaque keyset cursors. A cursor is the sort key of the last row a client has
+# seen, e.g. (timestamp, id) for messages or (id,) for users and rooms, so the
+# next page is a plain index range scan however far back the client scrolls.
+import base64
+from datetime import datetime
+from typing import Optional, Tuple
+
+from . import protocol
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(*values) -> str:
+    parts = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(protocol.encode(parts).data).rstrip(b"=").decode("ascii")
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = protocol.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception:
+        raise InvalidCursor("Malformed cursor")
+    if not isinstance(values, list):
+        raise InvalidCursor("Malformed cursor")
+    return values
+
+# --- Typed helpers for the cursors used by crud ---
+
+def message_cursor(timestamp: datetime, message_id: int) -> str:
+    return encode_cursor(timestamp, message_id)
+
+def decode_message_cursor(cursor: Optional[str]) -> Optional[Tuple[datetime, int]]:
+    if not cursor:
+        return None
+    values = decode_cursor(cursor)
+    try:
+        timestamp, message_id = values
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (TypeError, ValueError):
+        raise InvalidCursor("Malformed cursor")
+
+def search_cursor(rank: float, message_id: int) -> str:
+    return encode_cursor(rank, message_id)
+
+def decode_search_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    if not cursor:
+        return None
+    values = decode_cursor(cursor)
+    try:
+        rank, message_id = values
+        return float(rank), int(message_id)
+    except (TypeError, ValueError):
+        raise InvalidCursor("Malformed cursor")
+
+def id_cursor(row_id: int) -> str:
+    return encode_cursor(row_id)
+
+def decode_id_cursor(cursor: Optional[str]) -> Optional[int]:
+    if not cursor:
+        return None
+    values = decode_cursor(cursor)
+    try:
+        (row_id,) = values
+        return int(row_id)
+    except (TypeError, ValueError):
+        raise InvalidCursor("Malformed cursor")
@@ -0,0 +1,307 @@
+# app/partitions.py
+# Monthly range partitions for the messages table (Postgres only, see
+# database.MESSAGES_PARTITIONED). Each month lives in its own table, e.g.
+# messages_p2026_10, with its own small indexes:
+#   - inserts only touch the current month's indexes
+#   - queries bounded by timestamp (history pages, cursors) skip other months
+#     (partition pruning), and "newest first" reads stop after the newest ones
+#   - retention removes a whole month at once instead of a huge DELETE
+# Partitions are created ahead of time by a background job in every worker
+# (only one runs at a time, under an advisory lock), or by the CLI:
+#   python -m app.partitions status|ensure|retention|convert
+import asyncio
+import gzip
+import os
+import sys
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from sqlalchemy import text
+
+from .database import MESSAGES_PARTITIONED, Message, get_engine
+
+# --- Configuration ---
+# Months created in advance, beyond the current one
+MESSAGES_PARTITIONS_AHEAD = int(os.getenv("MESSAGES_PARTITIONS_AHEAD", "3"))
+# Months of history kept, counting the current one (0 keeps everything)
+MESSAGES_RETENTION_MONTHS = int(os.getenv("MESSAGES_RETENTION_MONTHS", "0"))
+# What happens to a month past retention:
+#   detach:  taken out of `messages` but kept as a plain table (drop it yourself)
+#   archive: exported to MESSAGES_ARCHIVE_DIR/<partition>.csv.gz, then dropped
+#   drop:    dropped
+MESSAGES_RETENTION_ACTION = os.getenv("MESSAGES_RETENTION_ACTION", "detach")
+MESSAGES_ARCHIVE_DIR = os.getenv("MESSAGES_ARCHIVE_DIR", "archive")
+# Longest wait for the lock DETACH needs on `messages`. While it waits, every other
+# query on the table queues behind it, so it gives up and retries on the next run.
+MESSAGES_DETACH_LOCK_TIMEOUT_MS = int(os.getenv("MESSAGES_DETACH_LOCK_TIMEOUT_MS", "5000"))
+# Hours between background maintenance runs (0 disables the background job)
+PARTITION_MAINTENANCE_HOURS = float(os.getenv("PARTITION_MAINTENANCE_HOURS", "6"))
+
+DEFAULT_PARTITION = "messages_default"
+# Session-level advisory lock: one maintenance run at a time across workers
+ADVISORY_LOCK_KEY = 7_301_801
+
+
+# --- Months ---
+
+def month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+def add_months(month: datetime, count: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+def partition_name(month: datetime) -> str:
+    return f"messages_p{month.year:04d}_{month.month:02d}"
+
+
+# --- Catalog ---
+
+def is_partitioned(connection) -> bool:
+    kind = connection.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('messages')")).scalar()
+    return kind == "p"
+
+def list_partitions(connection) -> Dict[str, Optional[datetime]]:
+    # { partition name: first day of its month }; None for the default partition
+    names = connection.execute(text("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass ORDER BY c.relname
+    """)).scalars()
+    partitions = {}
+    for name in names:
+        try:
+            partitions[name] = datetime.strptime(name, "messages_p%Y_%m").replace(tzinfo=timezone.utc)
+        except ValueError:
+            partitions[name] = None
+    return partitions
+
+def list_detached(connection) -> Dict[str, datetime]:
+    # Monthly tables no longer attached to messages (detached by retention)
+    names = connection.execute(text(r"""
+        SELECT relname FROM pg_class
+        WHERE relkind = 'r' AND NOT relispartition AND relname LIKE 'messages\_p%' AND pg_table_is_visible(oid)
+        ORDER BY relname
+    """)).scalars()
+    detached = {}
+    for name in names:
+        try:
+            detached[name] = datetime.strptime(name, "messages_p%Y_%m").replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return detached
+
+
+# --- Creating partitions ---
+
+def create_partition(connection, month: datetime) -> bool:
+    name = partition_name(month)
+    start, end = month.isoformat(), add_months(month, 1).isoformat()
+    if connection.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar() is not None:
+        return False
+    has_default = connection.execute(text("SELECT to_regclass(:name)"), {"name": DEFAULT_PARTITION}).scalar() is not None
+    strays = has_default and connection.execute(
+        text(f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE timestamp >= :start AND timestamp < :end LIMIT 1"),
+        {"start": start, "end": end},
+    ).first() is not None
+    if strays:
+        # Postgres refuses a new partition while the default one holds rows in its
+        # range: take the default out, create the month, move the rows over
+        connection.execute(text(f"ALTER TABLE messages DETACH PARTITION {DEFAULT_PARTITION}"))
+    connection.execute(text(
+        f"CREATE TABLE {name} PARTITION OF messages FOR VALUES FROM ('{start}') TO ('{end}')"
+    ))
+    if strays:
+        connection.execute(text(f"""
+            WITH moved AS (
+                DELETE FROM {DEFAULT_PARTITION} WHERE timestamp >= :start AND timestamp < :end RETURNING *
+            )
+            INSERT INTO messages SELECT * FROM moved
+        """), {"start": start, "end": end})
+        connection.execute(text(f"ALTER TABLE messages ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    return True
+
+def ensure_partitions(connection, now: Optional[datetime] = None, since: Optional[datetime] = None) -> List[str]:
+    # Every month from `since` (default: the current one) to MESSAGES_PARTITIONS_AHEAD
+    # months ahead, plus a default partition for anything outside them (clock skew,
+    # imported history), so an insert never fails for want of a partition.
+    current = month_start(now or datetime.now(timezone.utc))
+    month = month_start(since) if since is not None else current
+    created = []
+    while month <= add_months(current, MESSAGES_PARTITIONS_AHEAD):
+        if create_partition(connection, month):
+            created.append(partition_name(month))
+        month = add_months(month, 1)
+    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF messages DEFAULT"))
+    return created
+
+
+# --- Retention ---
+
+def archive_partition(connection, name: str) -> str:
+    # COPY the partition into a gzip'd CSV (with header), written under a temporary
+    # name so a half-written file never looks like a finished archive
+    os.makedirs(MESSAGES_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(MESSAGES_ARCHIVE_DIR, f"{name}.csv.gz")
+    columns = ", ".join(column.name for column in Message.__table__.columns)
+    with gzip.open(path + ".tmp", "wb") as archive:
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY (SELECT {columns} FROM {name} ORDER BY timestamp, id) TO STDOUT WITH CSV HEADER", archive)
+    os.replace(path + ".tmp", path)
+    return path
+
+def apply_retention(connection, now: Optional[datetime] = None) -> List[str]:
+    # connection: from engine.connect(), with no transaction open. DETACH takes an
+    # ACCESS EXCLUSIVE lock on messages (CONCURRENTLY isn't allowed next to a
+    # default partition), so each month is detached in its own short transaction.
+    # Exporting and dropping then work on the standalone table, without locking
+    # messages.
+    if MESSAGES_RETENTION_MONTHS <= 0:
+        return []
+    # Months starting before the cutoff are past retention
+    cutoff = add_months(month_start(now or datetime.now(timezone.utc)), 1 - MESSAGES_RETENTION_MONTHS)
+    expired = [name for name, month in list_partitions(connection).items() if month is not None and month < cutoff]
+    connection.commit()
+    for name in expired:
+        with connection.begin():
+            connection.execute(text(f"SET LOCAL lock_timeout = {MESSAGES_DETACH_LOCK_TIMEOUT_MS}"))
+            connection.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+        print(f"Detached partition {name}")
+    if MESSAGES_RETENTION_ACTION not in ("archive", "drop"):
+        return expired
+    # Also months an earlier run detached but didn't get to archive or drop
+    retired = [name for name, month in list_detached(connection).items() if month < cutoff]
+    connection.commit()
+    for name in retired:
+        # Export and drop together: a month whose export failed is kept for the next run
+        with connection.begin():
+            if MESSAGES_RETENTION_ACTION == "archive":
+                path = archive_partition(connection, name)
+                connection.execute(text(f"DROP TABLE {name}"))
+                print(f"Archived partition {name} to {path}")
+            else:
+                connection.execute(text(f"DROP TABLE {name}"))
+                print(f"Dropped partition {name}")
+    return retired
+
+
+# --- Maintenance ---
+
+def run_maintenance(now: Optional[datetime] = None) -> dict:
+    # Blocking (sync engine); the app runs it in a thread
+    if not MESSAGES_PARTITIONED:
+        return {}
+    with get_engine().connect() as connection:
+        # Held across the transactions below, until unlocked or the connection closes
+        locked = connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": ADVISORY_LOCK_KEY}).scalar()
+        connection.commit()
+        if not locked:
+            return {"skipped": "running in another worker"}
+        try:
+            if not is_partitioned(connection):
+                print("messages is not partitioned; run `python -m app.partitions convert` to convert it")
+                return {"skipped": "messages is not partitioned"}
+            created = ensure_partitions(connection, now)
+            connection.commit()
+            retired = apply_retention(connection, now)
+        finally:
+            connection.rollback()
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": ADVISORY_LOCK_KEY})
+            connection.commit()
+    return {"created": created, "retired": retired}
+
+
+class PartitionMaintainer:
+    # Background task: keeps partitions ahead of time and applies retention
+    def __init__(self, interval_hours: float = PARTITION_MAINTENANCE_HOURS):
+        self.interval = interval_hours * 3600
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if MESSAGES_PARTITIONED and self.interval > 0:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _run(self):
+        while True:
+            try:
+                result = await asyncio.to_thread(run_maintenance)
+                if result.get("created") or result.get("retired"):
+                    print(f"Partition maintenance: {result}")
+            except Exception as e:
+                # Try again next time; partitions are created months ahead
+                print(f"Partition maintenance failed: {e}")
+            await asyncio.sleep(self.interval)
+
+
+# Instantiate the maintainer (only started for a partitioned Postgres database)
+partition_maintainer = PartitionMaintainer()
+
+
+# --- Converting an existing table ---
+
+def convert():
+    # One-off: turn an existing plain messages table into a partitioned one, in a
+    # single transaction. The table is locked for the duration of the copy.
+    from .database import Base
+    with get_engine().begin() as connection:
+        if is_partitioned(connection):
+            print("messages is already partitioned")
+            return
+        connection.execute(text("LOCK TABLE messages IN ACCESS EXCLUSIVE MODE"))
+        # Move the old table and everything named after it out of the way
+        indexes = connection.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = 'messages'")).scalars().all()
+        connection.execute(text("ALTER TABLE messages RENAME TO messages_unpartitioned"))
+        for index in indexes:
+            connection.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index}_unpartitioned"'))
+        connection.execute(text("ALTER SEQUENCE IF EXISTS messages_id_seq RENAME TO messages_unpartitioned_id_seq"))
+
+        Base.metadata.tables["messages"].create(connection)
+        oldest = connection.execute(text("SELECT min(timestamp) FROM messages_unpartitioned")).scalar()
+        created = ensure_partitions(connection, since=oldest)
+        names = [column.name for column in Message.__table__.columns]
+        # timestamp is NOT NULL now: it's the partition key
+        values = ["coalesce(timestamp, now())" if name == "timestamp" else name for name in names]
+        copied = connection.execute(text(
+            f"INSERT INTO messages ({', '.join(names)}) SELECT {', '.join(values)} FROM messages_unpartitioned"
+        )).rowcount
+        connection.execute(text("SELECT setval('messages_id_seq', coalesce((SELECT max(id) FROM messages), 0) + 1, false)"))
+        connection.execute(text("DROP TABLE messages_unpartitioned"))
+    print(f"Converted messages: {copied} rows in {len(created)} monthly partitions")
+
+
+def print_status():
+    with get_engine().connect() as connection:
+        if not is_partitioned(connection):
+            print("messages is not partitioned")
+            return
+        for name in list_partitions(connection):
+            rows = connection.execute(text(f"SELECT count(*) FROM {name}")).scalar()
+            print(f"{name:24} {rows:>12} rows")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if not MESSAGES_PARTITIONED:
+        print("Partitioning is off (needs Postgres and MESSAGES_PARTITIONING=1)")
+    elif command == "status":
+        print_status()
+    elif command == "ensure":
+        with get_engine().begin() as connection:
+            print(ensure_partitions(connection))
+    elif command == "retention":
+        with get_engine().connect() as connection:
+            print(apply_retention(connection))
+    elif command == "convert":
+        convert()
+    else:
+        print("usage: python -m app.partitions status|ensure|retention|convert")
+        sys.exit(2)
@@ -0,0 +1,177 @@
+# app/protocol.py
+# Wire protocol for the chat WebSocket. Every outgoing event is encoded exactly
+# once into a Frame, and the same Frame is handed to every recipient.
+#
+# Clients pick what they receive when they connect (see Frame.wire):
+#   ?encoding=json (default): JSON text frames
+#   ?encoding=msgpack:        MessagePack, in binary frames
+#   &compression=deflate:     frames of at least WS_COMPRESS_MIN_BYTES are deflated
+# Binary frames start with one tag byte saying what follows (TAG_* below); text
+# frames are always plain JSON. Clients always send JSON text.
+import json
+import os
+import zlib
+from datetime import datetime
+from typing import Iterable, List, Optional, Union
+
+# Use orjson when it is installed, it is several times faster than the stdlib
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(data):
+        return orjson.loads(data)
+
+    JSON_BACKEND = "orjson"
+except ImportError:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def _dumps(obj) -> bytes:
+        return _encoder.encode(obj).encode("utf-8")
+
+    def loads(data):
+        return json.loads(data)
+
+    JSON_BACKEND = "json"
+
+# MessagePack is optional too: only needed for clients that ask for it
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Send the join-time history as a single "chat_history" frame instead of one frame per message
+BATCH_HISTORY = os.getenv("WS_BATCH_HISTORY", "1") == "1"
+# Let clients ask for compression=deflate (0 ignores the request)
+WS_COMPRESSION = os.getenv("WS_COMPRESSION", "1") == "1"
+# Smaller frames are sent as they are: deflate gains little on a short chat message
+WS_COMPRESS_MIN_BYTES = int(os.getenv("WS_COMPRESS_MIN_BYTES", "512"))
+# zlib level, 1 (fastest) to 9 (smallest)
+WS_COMPRESS_LEVEL = int(os.getenv("WS_COMPRESS_LEVEL", "1"))
+
+ENCODINGS = ("json", "msgpack")
+# First byte of a binary frame
+TAG_MSGPACK = b"\x00"         # MessagePack
+TAG_MSGPACK_DEFLATE = b"\x01" # raw DEFLATE (no zlib header) of MessagePack
+TAG_JSON_DEFLATE = b"\x02"    # raw DEFLATE of UTF-8 JSON
+
+
+class Frame:
+    # An encoded event. Holds the UTF-8 bytes and decodes them to text at most once
+    # (Starlette's send_text() needs a str).
+    __slots__ = ("_data", "_text", "_wire")
+
+    def __init__(self, data: Optional[bytes] = None, text: Optional[str] = None):
+        self._data = data
+        self._text = text
+        # { (encoding, compress): payload } for clients that don't take plain JSON
+        self._wire = None
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = self._text.encode("utf-8")
+        return self._data
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self._data.decode("utf-8")
+        return self._text
+
+    def wire(self, encoding: str = "json", compress: bool = False) -> Union[str, bytes]:
+        # What a socket with these settings is sent: a str goes out as a text frame,
+        # bytes as a binary frame. Each variant is built once per Frame, however
+        # many sockets it goes to (unlike permessage-deflate, which compresses
+        # every frame again for every connection).
+        if encoding == "json" and not compress:
+            return self.text
+        key = (encoding, compress)
+        if self._wire is None:
+            self._wire = {}
+        payload = self._wire.get(key)
+        if payload is None:
+            payload = self._wire[key] = self._build_wire(encoding, compress)
+        return payload
+
+    def _build_wire(self, encoding: str, compress: bool) -> Union[str, bytes]:
+        body = msgpack.packb(loads(self.data)) if encoding == "msgpack" else self.data
+        if compress and len(body) >= WS_COMPRESS_MIN_BYTES:
+            # No context shared between frames: the result goes to many sockets
+            compressor = zlib.compressobj(WS_COMPRESS_LEVEL, zlib.DEFLATED, -15)
+            deflated = compressor.compress(body) + compressor.flush()
+            if len(deflated) < len(body):
+                return (TAG_MSGPACK_DEFLATE if encoding == "msgpack" else TAG_JSON_DEFLATE) + deflated
+        return TAG_MSGPACK + body if encoding == "msgpack" else self.text
+
+
+def encode(event: dict) -> Frame:
+    return Frame(data=_dumps(event))
+
+def decode_wire(payload: Union[str, bytes]):
+    # Inverse of Frame.wire, for clients written in Python (tests, benchmarks, load generators)
+    if isinstance(payload, str):
+        return loads(payload)
+    tag, body = payload[:1], payload[1:]
+    if tag in (TAG_MSGPACK_DEFLATE, TAG_JSON_DEFLATE):
+        body = zlib.decompress(body, -15)
+    return msgpack.unpackb(body) if tag in (TAG_MSGPACK, TAG_MSGPACK_DEFLATE) else loads(body)
+
+
+# --- Event builders ---
+
+def chat_message(message_id: Optional[int], sender_username: str, text: str, timestamp: datetime,
+                 client_id: Optional[str] = None, seq: Optional[int] = None) -> Frame:
+    event = {
+        "type": "chat_message",
+        "message_id": message_id,
+        # Clients keep the highest seq they've seen and reconnect with ?since=<seq>
+        "seq": seq,
+        "sender_username": sender_username,
+        "text": text,
+        "timestamp": timestamp.isoformat(),
+    }
+    if client_id is not None:
+        # Optimistic write-behind broadcasts don't have a message_id yet
+        event["client_id"] = client_id
+    return encode(event)
+
+def chat_history(messages: Iterable[Frame], next_cursor: Optional[str] = None, older: bool = False,
+                 replay: bool = False) -> Frame:
+    # Splice already-encoded chat_message frames into one array, no re-encoding.
+    # next_cursor is what the client sends with "load_older" to page further back;
+    # older is set on replies to "load_older" (prepend instead of append);
+    # replay is set on the messages missed before a ?since= reconnect (append to
+    # what the client already shows, instead of replacing it).
+    header = _dumps({"type": "chat_history", "next_cursor": next_cursor, "older": older, "replay": replay})
+    return Frame(data=header[:-1] + b',"messages":[' + b",".join(m.data for m in messages) + b"]}")
+
+def chat_seq(frame: Frame) -> Optional[int]:
+    # seq of an encoded chat_message frame; None for other events and unstored messages
+    if b'"chat_message"' not in frame.data:
+        return None
+    event = loads(frame.data)
+    return event.get("seq") if event.get("type") == "chat_message" else None
+
+def active_users_update(users: List[str]) -> Frame:
+    # Full presence snapshot, only sent to a socket when it joins
+    return encode({"type": "active_users_update", "users": users})
+
+def user_joined(users: List[str], count: int) -> Frame:
+    # Presence deltas, coalesced per debounce window; count is the room's new member count
+    return encode({"type": "user_joined", "users": users, "count": count})
+
+def user_left(users: List[str], count: int) -> Frame:
+    return encode({"type": "user_left", "users": users, "count": count})
+
+def error(message: str, code: Optional[str] = None, retry_after: Optional[float] = None) -> Frame:
+    event = {"type": "error", "message": message}
+    if code is not None:
+        # Machine-readable reason, e.g. "rate_limited" or "frame_too_large"
+        event["code"] = code
+    if retry_after is not None:
+        # Seconds the client should wait before sending again
+        event["retry_after"] = round(retry_after, 3)
+    return encode(event)
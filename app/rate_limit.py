@@ -0,0 +1,203 @@
+# app/rate_limit.py
+# Token-bucket limits for incoming WebSocket frames, per connection, per user and
+# per room. Buckets use GCRA (the "generic cell rate algorithm"), which stores a
+# single float per bucket, the "theoretical arrival time" (tat), instead of a
+# token count and a refill timestamp:
+#   - every accepted frame pushes tat forward by 1/rate
+#   - a frame is accepted while tat stays within burst/rate seconds of now
+import os
+import time
+from typing import Dict, Optional
+
+from sqlalchemy import text
+
+# --- Configuration ---
+# Sustained frames per second and burst size for each scope (a rate of 0 disables it)
+WS_CONNECTION_RATE = float(os.getenv("WS_CONNECTION_RATE", "5"))
+WS_CONNECTION_BURST = int(os.getenv("WS_CONNECTION_BURST", "10"))
+WS_USER_RATE = float(os.getenv("WS_USER_RATE", "10"))
+WS_USER_BURST = int(os.getenv("WS_USER_BURST", "20"))
+WS_ROOM_RATE = float(os.getenv("WS_ROOM_RATE", "100"))
+WS_ROOM_BURST = int(os.getenv("WS_ROOM_BURST", "200"))
+# Largest text frame accepted from a client, in bytes
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", "8192"))
+# Where user and room buckets live: "memory" (per worker, the default) or
+# "postgres" (shared by all workers). Connection buckets are always in memory.
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+# Keys kept by the memory store before idle (fully refilled) buckets are pruned
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+
+class Limit:
+    __slots__ = ("rate", "burst", "interval")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        # Seconds of "credit" one frame costs
+        self.interval = 1 / rate if rate > 0 else 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+
+CONNECTION_LIMIT = Limit(WS_CONNECTION_RATE, WS_CONNECTION_BURST)
+USER_LIMIT = Limit(WS_USER_RATE, WS_USER_BURST)
+ROOM_LIMIT = Limit(WS_ROOM_RATE, WS_ROOM_BURST)
+
+
+def gcra(tat: float, now: float, limit: Limit):
+    # Returns (new_tat, retry_after). retry_after is 0 when the frame is accepted;
+    # otherwise the bucket is unchanged and new_tat is the old tat.
+    new_tat = max(tat, now) + limit.interval
+    allowed_at = new_tat - limit.interval * limit.burst
+    if allowed_at > now:
+        return tat, allowed_at - now
+    return new_tat, 0.0
+
+
+# --- Stores for user and room buckets ---
+
+class RateLimitStore:
+    # Base class / interface
+    async def take(self, key: str, limit: Limit) -> float:
+        # Spend one frame from the bucket; returns seconds to wait (0 if accepted)
+        raise NotImplementedError
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        # { key: tat }
+        self.buckets: Dict[str, float] = {}
+        self.max_keys = max_keys
+
+    async def take(self, key: str, limit: Limit) -> float:
+        now = time.monotonic()
+        tat, retry_after = gcra(self.buckets.get(key, now), now, limit)
+        self.buckets[key] = tat
+        if len(self.buckets) > self.max_keys:
+            self.prune(now)
+        return retry_after
+
+    def prune(self, now: float):
+        # A bucket whose tat is in the past is full again: same as no entry at all
+        self.buckets = {key: tat for key, tat in self.buckets.items() if tat > now}
+
+
+class PostgresRateLimitStore(RateLimitStore):
+    # Buckets in the rate_limit_buckets table, so every worker draws from the same
+    # ones. One atomic upsert per frame and scope, using the database clock so
+    # workers don't need synchronised clocks.
+    TAKE = text("""
+        INSERT INTO rate_limit_buckets AS b (key, tat)
+        VALUES (:key, extract(epoch from now()) + :interval)
+        ON CONFLICT (key) DO UPDATE
+            SET tat = GREATEST(b.tat, extract(epoch from now())) + :interval
+            WHERE GREATEST(b.tat, extract(epoch from now())) + :interval
+                  <= extract(epoch from now()) + :interval * :burst
+        RETURNING tat
+    """)
+    # Only run when a frame was refused, to tell the client how long to wait
+    RETRY_AFTER = text("""
+        SELECT tat + :interval - :interval * :burst - extract(epoch from now())
+        FROM rate_limit_buckets WHERE key = :key
+    """)
+
+    def __init__(self, engine=None):
+        # None: the app's async engine, looked up on first use
+        self.engine = engine
+
+    async def take(self, key: str, limit: Limit) -> float:
+        if self.engine is None:
+            from .database import get_async_engine
+            self.engine = get_async_engine()
+        params = {"key": key, "interval": limit.interval, "burst": limit.burst}
+        try:
+            async with self.engine.begin() as connection:
+                if (await connection.execute(self.TAKE, params)).first() is not None:
+                    return 0.0
+                retry_after = (await connection.execute(self.RETRY_AFTER, params)).scalar()
+        except Exception as e:
+            # Fail open: an unreachable limiter store must not take the chat down
+            print(f"Rate limit store error for {key}: {e}")
+            return 0.0
+        return max(float(retry_after or 0.0), limit.interval)
+
+
+def create_store() -> RateLimitStore:
+    if RATE_LIMIT_STORE == "postgres":
+        return PostgresRateLimitStore()
+    return MemoryRateLimitStore()
+
+
+class RateLimitStats:
+    def __init__(self):
+        self.accepted = 0
+        # Refusals per scope: "connection", "user", "room", "frame_size"
+        self.rejected: Dict[str, int] = {"connection": 0, "user": 0, "room": 0, "frame_size": 0}
+
+    def as_dict(self) -> dict:
+        return {"accepted": self.accepted, "rejected": dict(self.rejected)}
+
+
+class RateLimiter:
+    def __init__(self, store: Optional[RateLimitStore] = None):
+        self.store = store if store is not None else create_store()
+        self.stats = RateLimitStats()
+
+    async def check(self, connection):
+        # Charged for every frame a client sends. Returns (scope, retry_after) for
+        # the first limit the frame exceeds, or None if it may go through. A refused
+        # frame costs nothing: the connection bucket (kept on the Connection record
+        # itself, one float per socket) is only charged once the user bucket, which
+        # charges only what it accepts, has let the frame through. A socket's frames
+        # are checked one at a time, so nothing else moves its tat meanwhile.
+        tat = connection.rate_tat
+        if CONNECTION_LIMIT.enabled:
+            now = time.monotonic()
+            tat, retry_after = gcra(connection.rate_tat or now, now, CONNECTION_LIMIT)
+            if retry_after:
+                return self._rejected("connection", retry_after)
+        if USER_LIMIT.enabled:
+            retry_after = await self.store.take(f"user:{connection.user_id}", USER_LIMIT)
+            if retry_after:
+                return self._rejected("user", retry_after)
+        connection.rate_tat = tat
+        self.stats.accepted += 1
+        return None
+
+    async def check_room(self, room_id: int):
+        # Charged only for frames that are broadcast to the whole room
+        if ROOM_LIMIT.enabled:
+            retry_after = await self.store.take(f"room:{room_id}", ROOM_LIMIT)
+            if retry_after:
+                return self._rejected("room", retry_after)
+        return None
+
+    def should_notify(self, connection, retry_after: float) -> bool:
+        # One error event per back-off period. Frames sent while the client was
+        # already told to wait are dropped without another reply, so a flood
+        # doesn't get a flood of errors back.
+        now = time.monotonic()
+        if now < connection.rate_limited_until:
+            return False
+        connection.rate_limited_until = now + retry_after
+        return True
+
+    def frame_too_large(self, data: str) -> bool:
+        # Cheap pre-check on characters first; only encode when it could matter
+        if len(data) * 4 <= WS_MAX_FRAME_BYTES:
+            return False
+        if len(data.encode("utf-8")) <= WS_MAX_FRAME_BYTES:
+            return False
+        self.stats.rejected["frame_size"] += 1
+        return True
+
+    def _rejected(self, scope: str, retry_after: float):
+        self.stats.rejected[scope] += 1
+        return scope, retry_after
+
+
+# Instantiate the limiter
+rate_limiter = RateLimiter()
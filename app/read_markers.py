@@ -0,0 +1,104 @@
+# app/read_markers.py
+# Per-user, per-room read markers: room_users.last_read_seq is the seq (see
+# crud.allocate_seqs) of the newest message the user has read in the room.
+# The unread count is rooms.last_seq - last_read_seq, so it needs no scan of
+# messages and no per-member counter to update on every message.
+#
+# Clients report what they've read with a WebSocket {"type": "read", "seq": N}
+# event. Markers only move forward, so they are coalesced in memory (the highest
+# seq per user and room) and stored in one batch every READ_MARKER_FLUSH_MS.
+import asyncio
+import os
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import text
+
+from .database import AsyncSessionLocal
+
+# --- Configuration ---
+# How long read events are collected before they are written
+READ_MARKER_FLUSH_MS = float(os.getenv("READ_MARKER_FLUSH_MS", "1000"))
+
+# Upsert that never moves a marker back, and never past the room's newest message
+# (which also skips rooms deleted meanwhile). Works on Postgres and SQLite.
+UPSERT = text("""
+    INSERT INTO room_users (user_id, room_id, last_read_seq)
+    SELECT CAST(:user_id AS INTEGER), id, CASE WHEN last_seq < :seq THEN last_seq ELSE :seq END
+    FROM rooms WHERE id = :room_id
+    ON CONFLICT (user_id, room_id) DO UPDATE SET last_read_seq = excluded.last_read_seq
+    WHERE excluded.last_read_seq > room_users.last_read_seq
+""")
+
+
+class ReadMarkerWriter:
+    def __init__(self, session_factory=AsyncSessionLocal, flush_ms: float = READ_MARKER_FLUSH_MS):
+        self.session_factory = session_factory
+        self.flush_interval = flush_ms / 1000
+        # { (user_id, room_id): highest seq read } waiting to be written
+        self.pending: Dict[Tuple[int, int], int] = {}
+        self.task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.written = 0
+        self.coalesced = 0
+
+    async def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Write whatever is still pending before going away
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        await self.flush()
+
+    def mark(self, user_id: int, room_id: int, seq: int):
+        key = (user_id, room_id)
+        current = self.pending.get(key)
+        if current is not None:
+            self.coalesced += 1
+            if seq <= current:
+                return
+        self.pending[key] = seq
+
+    def pending_for(self, user_id: int) -> Dict[int, int]:
+        # { room_id: seq } not written yet, so reads on this worker see them right away
+        return {room_id: seq for (pending_user, room_id), seq in self.pending.items() if pending_user == user_id}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        try:
+            async with self.session_factory() as db:
+                await db.execute(UPSERT, [
+                    {"user_id": user_id, "room_id": room_id, "seq": seq}
+                    for (user_id, room_id), seq in sorted(batch.items()) # Same lock order everywhere
+                ])
+                await db.commit()
+        except Exception as e:
+            print(f"Read markers: failed to store {len(batch)} markers: {e}")
+            # Try again with the next flush, unless newer markers came in meanwhile
+            for key, seq in batch.items():
+                if self.pending.get(key, -1) < seq:
+                    self.pending[key] = seq
+            return
+        self.flushes += 1
+        self.written += len(batch)
+
+    def get_stats(self) -> dict:
+        return {"pending": len(self.pending), "flushes": self.flushes, "written": self.written,
+                "coalesced": self.coalesced}
+
+
+# Instantiate the writer (started with the app)
+read_markers = ReadMarkerWriter()
@@ -0,0 +1,229 @@
+# app/replicas.py
+# Read replicas: read-only queries that can tolerate a little replication lag
+# (history pages, search, the room directory, exports, admin listings) go to
+# one of DATABASE_REPLICA_URLS, round robin. Writes, and reads that must see
+# what was just written, keep using database.AsyncSessionLocal (the primary).
+#
+#   async with replicas.read_session() as db:          # a replica, or the primary
+#   async with replicas.read_session(user_id=7) as db: # primary for a while after user 7 wrote
+#
+# A replica is left out while it fails its health check (SELECT 1, and on
+# Postgres its replay lag) or when a connection to it fails; reads then go to
+# the other replicas, or to the primary when none is left. With no replicas
+# configured, every read goes to the primary.
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import exc, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from .database import AsyncSessionLocal, PoolStats, describe_pool, pool_options, to_async_url
+
+# --- Configuration ---
+# Comma-separated replica URLs, same form as DATABASE_URL (empty: no replicas)
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# Seconds between health checks of every replica
+REPLICA_HEALTH_INTERVAL_SECONDS = float(os.getenv("REPLICA_HEALTH_INTERVAL_SECONDS", "5"))
+# A replica that doesn't answer the check within this many seconds is left out
+REPLICA_HEALTH_TIMEOUT_SECONDS = float(os.getenv("REPLICA_HEALTH_TIMEOUT_SECONDS", "2"))
+# ...and so is one further behind the primary than this (Postgres streaming replicas)
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "10"))
+# After a user writes, their own reads go to the primary for this long, so they
+# see their writes even on a lagging replica (0 disables)
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
+# Seconds the replica is behind its primary. 0 when it has replayed everything
+# it received (an idle primary sends nothing new), and on a server that isn't
+# a standby at all (e.g. a second local database used for testing).
+LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+# Errors that mean the replica can't be used right now: connection refused or
+# dropped, pool or check timed out, and any other database error a broken
+# replica raises (bad credentials, a standby missing a table or a role, ...).
+# Reads then fall back to the other replicas or the primary.
+UNAVAILABLE_ERRORS = (OSError, asyncio.TimeoutError, exc.DBAPIError, exc.TimeoutError)
+
+
+class Replica:
+    __slots__ = ("name", "engine", "sessions", "healthy", "lag_seconds", "reads", "failures", "last_error", "pool_stats")
+
+    def __init__(self, url: str):
+        # Password hidden: the name shows up in stats and logs
+        self.name = make_url(url).render_as_string(hide_password=True)
+        # Checkout waits of this replica's pool, apart from the primary's
+        self.pool_stats = PoolStats()
+        self.engine = create_async_engine(to_async_url(url), **pool_options(url, self.pool_stats))
+        self.sessions = async_sessionmaker(self.engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+        self.healthy = True # Until the first check says otherwise
+        self.lag_seconds = 0.0
+        self.reads = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+
+class ReplicaRouter:
+    def __init__(self, urls: List[str] = DATABASE_REPLICA_URLS, primary_sessions=AsyncSessionLocal,
+                 sticky_seconds: float = REPLICA_STICKY_SECONDS):
+        self.urls = urls
+        # Engines are created by start(), not at import
+        self.replicas: List[Replica] = []
+        self.primary_sessions = primary_sessions
+        self.sticky_seconds = sticky_seconds
+        # { user_id: monotonic time until which their reads stay on the primary }
+        self.sticky: Dict[int, float] = {}
+        self.next_index = 0
+        self.task: Optional[asyncio.Task] = None
+        self.primary_reads = 0 # Reads that could have used a replica but didn't
+        self.stale_reads = 0   # ...of which because the replica was behind (see read_session)
+
+    async def start(self):
+        if not self.replicas:
+            self.replicas = [Replica(url) for url in self.urls]
+        if self.replicas:
+            await self.check()
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    def wrote(self, user_id: int):
+        # Called after a user's write: keeps their reads on the primary for a while
+        if self.replicas and self.sticky_seconds > 0:
+            self.sticky[user_id] = time.monotonic() + self.sticky_seconds
+
+    def _is_sticky(self, user_id: Optional[int]) -> bool:
+        if user_id is None:
+            return False
+        until = self.sticky.get(user_id)
+        if until is None:
+            return False
+        if until <= time.monotonic():
+            del self.sticky[user_id]
+            return False
+        return True
+
+    def _candidates(self) -> List[Replica]:
+        # Healthy replicas, starting with the next one in turn
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return []
+        start = self.next_index % len(healthy)
+        self.next_index += 1
+        return healthy[start:] + healthy[:start]
+
+    @asynccontextmanager
+    async def read_session(self, user_id: Optional[int] = None,
+                           fresh: Optional[Callable[[AsyncSession], Awaitable[bool]]] = None):
+        # fresh: optional check run on the replica session first; when it returns
+        # False (the replica hasn't got the data yet) the primary is used instead
+        db = await self._replica_session(user_id, fresh) if self.replicas else None
+        if db is None:
+            db = self.primary_sessions()
+        try:
+            yield db
+        finally:
+            await db.close()
+
+    async def _replica_session(self, user_id: Optional[int], fresh) -> Optional[AsyncSession]:
+        if self._is_sticky(user_id):
+            self.primary_reads += 1
+            return None
+        for replica in self._candidates():
+            db = replica.sessions()
+            try:
+                # Check a connection out now (pre-ping included), so a replica that
+                # is down is noticed here and not halfway through the caller's query
+                await db.connection()
+                if fresh is not None and not await fresh(db):
+                    await db.close()
+                    self.stale_reads += 1
+                    break
+            except UNAVAILABLE_ERRORS as e:
+                await db.close()
+                self._mark_down(replica, e)
+                continue
+            except BaseException:
+                await db.close()
+                raise
+            replica.reads += 1
+            return db
+        self.primary_reads += 1
+        return None
+
+    def _mark_down(self, replica: Replica, error: BaseException):
+        replica.failures += 1
+        replica.last_error = f"{type(error).__name__}: {error}"
+        if replica.healthy:
+            replica.healthy = False
+            print(f"Replicas: {replica.name} is unavailable, reading from the others ({replica.last_error})")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(REPLICA_HEALTH_INTERVAL_SECONDS)
+            try:
+                await self.check()
+            except Exception as e:
+                # _check already handles each replica; never let the loop die
+                print(f"Replicas: health check failed: {e}")
+            # Users whose stickiness ran out without them reading again
+            now = time.monotonic()
+            self.sticky = {user_id: until for user_id, until in self.sticky.items() if until > now}
+
+    async def check(self):
+        # One replica's failure must not affect the others, nor abort startup
+        await asyncio.gather(*(self._check(replica) for replica in self.replicas), return_exceptions=True)
+
+    async def _check(self, replica: Replica):
+        try:
+            replica.lag_seconds = await asyncio.wait_for(self._measure_lag(replica), REPLICA_HEALTH_TIMEOUT_SECONDS)
+        except Exception as e:
+            # Anything that keeps the check from passing, expected or not
+            if not isinstance(e, UNAVAILABLE_ERRORS):
+                print(f"Replicas: unexpected error checking {replica.name}: {type(e).__name__}: {e}")
+            self._mark_down(replica, e)
+            return
+        if replica.lag_seconds > REPLICA_MAX_LAG_SECONDS:
+            self._mark_down(replica, RuntimeError(f"{replica.lag_seconds:.1f}s behind the primary"))
+        elif not replica.healthy:
+            replica.healthy = True
+            print(f"Replicas: {replica.name} is back")
+
+    async def _measure_lag(self, replica: Replica) -> float:
+        async with replica.engine.connect() as connection:
+            if connection.dialect.name == "postgresql":
+                return float((await connection.execute(LAG_SQL)).scalar() or 0)
+            await connection.execute(text("SELECT 1"))
+            return 0.0
+
+    def get_stats(self) -> dict:
+        return {
+            "replicas": [
+                {"name": replica.name, "healthy": replica.healthy, "lag_seconds": replica.lag_seconds,
+                 "reads": replica.reads, "failures": replica.failures, "last_error": replica.last_error,
+                 "pool": describe_pool(replica.pool_stats, replica.engine.pool)}
+                for replica in self.replicas
+            ],
+            "primary_reads": self.primary_reads,
+            "stale_reads": self.stale_reads,
+            "sticky_users": len(self.sticky),
+        }
+
+
+# Instantiate the router (health checks start with the app)
+replicas = ReplicaRouter()
@@ -0,0 +1,115 @@
+# app/room_directory.py
+# In-process copy of the room list (id and name of every room), so GET /rooms/
+# and GET /rooms/{room_id} don't query the database on every poll. Rooms
+# created or deleted through crud update it immediately on this worker; other
+# workers reload it within ROOM_DIRECTORY_TTL_SECONDS.
+import asyncio
+import os
+import time
+from bisect import bisect_right, insort
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from sqlalchemy import select
+
+from .database import Room
+from .replicas import replicas
+
+# How long the directory is trusted before it is reloaded from the database
+ROOM_DIRECTORY_TTL_SECONDS = float(os.getenv("ROOM_DIRECTORY_TTL_SECONDS", "30"))
+
+
+class RoomEntry:
+    # Same attribute names as the Room columns, for schemas.RoomResponse
+    __slots__ = ("id", "name")
+
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+
+
+class RoomDirectory:
+    def __init__(self, ttl: float = ROOM_DIRECTORY_TTL_SECONDS):
+        self.ttl = ttl
+        # { room_id: RoomEntry } plus the ids in order, for keyset pages
+        self.rooms: Dict[int, RoomEntry] = {}
+        self.ids: List[int] = []
+        self.expires_at = 0.0 # monotonic; 0 = not loaded
+        # When the list last changed (HTTP Last-Modified has whole seconds)
+        self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+        # Concurrent requests on an expired directory share one reload
+        self.reloading: Optional[asyncio.Task] = None
+        # Bumped by every local write, to spot writes racing with a reload
+        self.generation = 0
+        self.hits = 0
+        self.loads = 0
+
+    async def ensure_loaded(self):
+        if time.monotonic() < self.expires_at:
+            self.hits += 1
+            return
+        if self.reloading is None:
+            self.reloading = asyncio.create_task(self._reload())
+        reloading = self.reloading
+        try:
+            await asyncio.shield(reloading)
+        finally:
+            if self.reloading is reloading and reloading.done():
+                self.reloading = None
+
+    async def _reload(self):
+        generation = self.generation
+        # From a replica when there is one: a room created on another worker may show
+        # up a little later, as it already does with the TTL
+        async with replicas.read_session() as db:
+            rows = (await db.execute(select(Room.id, Room.name).order_by(Room.id))).all()
+        self.loads += 1
+        rooms = {room_id: RoomEntry(room_id, name) for room_id, name in rows}
+        if [(room.id, room.name) for room in rooms.values()] != [(room.id, room.name) for room in self.rooms.values()]:
+            self._touch()
+        self.rooms = rooms
+        self.ids = list(rooms)
+        # A room created or deleted meanwhile may be missing from what was read:
+        # serve this, but reload again on the next read
+        self.expires_at = time.monotonic() + self.ttl if generation == self.generation else 0.0
+
+    def _touch(self):
+        self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+
+    # --- Reads (call ensure_loaded() first) ---
+
+    def page(self, after_id: Optional[int] = None, limit: int = 100) -> List[RoomEntry]:
+        start = bisect_right(self.ids, after_id) if after_id is not None else 0
+        return [self.rooms[room_id] for room_id in self.ids[start:start + limit]]
+
+    def get(self, room_id: int) -> Optional[RoomEntry]:
+        return self.rooms.get(room_id)
+
+    # --- Writes, called by crud ---
+
+    def room_created(self, room_id: int, name: str):
+        if room_id not in self.rooms:
+            insort(self.ids, room_id)
+        self.rooms[room_id] = RoomEntry(room_id, name)
+        self.generation += 1
+        self._touch()
+
+    def room_deleted(self, room_id: int):
+        if self.rooms.pop(room_id, None) is not None:
+            self.ids.remove(room_id)
+        self.generation += 1
+        self._touch()
+
+    def invalidate(self):
+        # For changes made outside crud (e.g. bulk import): reload on next read
+        self.expires_at = 0.0
+        self.generation += 1
+        self._touch()
+
+    def get_stats(self) -> dict:
+        return {"rooms": len(self.rooms), "hits": self.hits, "loads": self.loads,
+                "last_modified": self.last_modified.isoformat()}
+
+
+# Instantiate the directory
+room_directory = RoomDirectory()
@@ -29,11 +29,23 @@ class RoomCreate(RoomBase):
 
 class RoomResponse(RoomBase):
     id: int
+    online: int = 0 # Users connected to the room right now (this worker's view, see README)
     # users: List[UserResponse] # Optional: if you want to embed users in room response
 
     class Config:
         from_attributes = True
 
+class RoomUnread(BaseModel):
+    room_id: int
+    room_name: str
+    unread: int # Messages after the user's read marker
+    last_read_seq: int # Send this as ?since= to pick up where the user left off
+    last_seq: int
+
+class UnreadSummary(BaseModel):
+    rooms: List[RoomUnread]
+    total: int
+
 # --- Message Schemas ---
 class MessageBase(BaseModel):
     text: str
@@ -46,11 +58,22 @@ class MessageResponse(MessageBase):
     id: int
     timestamp: datetime
     room_id: int
-    sender_id: int
-    sender_username: str # To display sender's username directly
+    sender_id: Optional[int] # None once the sender's account has been deleted
+    sender_username: Optional[str] # To display sender's username directly
+    seq: Optional[int] = None # Position in the room (WebSocket ?since=); None if not numbered yet
 
     class Config:
         from_attributes = True
+
+class MessagePage(BaseModel):
+    items: List[MessageResponse]
+    next_cursor: Optional[str] = None # Pass back as `cursor` to get the next page; None on the last page
+class SearchHit(MessageResponse):
+    rank: float # Higher is a better match; only comparable within one query
+
+class SearchPage(BaseModel):
+    items: List[SearchHit]
+    next_cursor: Optional[str] = None # Pass back as `cursor` with the same q and sort
 class Token(BaseModel):
     access_token: str
     token_type: str
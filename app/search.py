@@ -0,0 +1,113 @@
+# app/search.py
+# Message search. Two backends behind the same crud.search_messages():
+#   - Postgres: a GIN expression index over to_tsvector(text) (see database.py),
+#     queried with websearch_to_tsquery ("quoted phrases", -exclusions, or) and
+#     ranked with ts_rank_cd.
+#   - Anything else (SQLite in development): the message_search_tokens inverted
+#     index, filled by the crud write paths. Every query word must match; the rank
+#     is how often the words occur in the message.
+import re
+import sys
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.engine import make_url
+
+from .database import DATABASE_URL, Message, message_search_tokens, message_search_vector, search_config
+
+# --- Configuration ---
+SEARCH_BACKEND = "postgres" if make_url(DATABASE_URL).get_backend_name() == "postgresql" else "tokens"
+# Longer tokens are cut to this length, both when indexing and when searching
+MAX_TOKEN_LENGTH = 64
+# Words of a query beyond this are ignored by the token index
+MAX_QUERY_TOKENS = 8
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> Counter:
+    # { token: occurrences }; lowercased words, no stemming
+    return Counter(token[:MAX_TOKEN_LENGTH] for token in TOKEN_RE.findall((text or "").lower()))
+
+
+def match(query: str, room_id: Optional[int] = None):
+    # Returns (from_clause_join, where_clause, rank) to apply to a Message query,
+    # or None if the query has nothing to search for.
+    # from_clause_join is (selectable, onclause) or None.
+    if SEARCH_BACKEND == "postgres":
+        tsquery = func.websearch_to_tsquery(search_config(), query)
+        vector = message_search_vector()
+        return None, vector.op("@@")(tsquery), func.ts_rank_cd(vector, tsquery)
+
+    tokens = list(tokenize(query))[:MAX_QUERY_TOKENS]
+    if not tokens:
+        return None
+    t = message_search_tokens.c
+    # Messages that contain every token: one posting per token, so count == len(tokens)
+    postings = select(t.message_id, func.sum(t.hits).label("rank")).where(t.token.in_(tokens))
+    if room_id is not None:
+        # (token, room_id, message_id) is the primary key: a range scan per token
+        postings = postings.where(t.room_id == room_id)
+    matches = (
+        postings
+        .group_by(t.message_id)
+        .having(func.count() == len(tokens))
+        .subquery("search_matches")
+    )
+    return (matches, matches.c.message_id == Message.id), None, matches.c.rank
+
+
+# --- Token index maintenance (non-Postgres backends only) ---
+
+def token_rows(messages: Iterable[Tuple[int, int, str]]) -> List[dict]:
+    # messages: (message_id, room_id, text)
+    return [
+        {"token": token, "room_id": room_id, "message_id": message_id, "hits": hits}
+        for message_id, room_id, text in messages
+        for token, hits in tokenize(text).items()
+    ]
+
+
+async def index_messages(db, messages: Iterable[Tuple[int, int, str]]):
+    # Called by crud in the same transaction as the INSERT of the messages
+    if SEARCH_BACKEND == "postgres":
+        return
+    rows = token_rows(messages)
+    if rows:
+        await db.execute(insert(message_search_tokens), rows)
+
+
+def reindex(batch_size: int = 1000):
+    # Rebuilds message_search_tokens from the messages table, e.g. for a database
+    # that already had messages before search existed. Blocking; for scripts.
+    from .database import get_engine
+    with get_engine().begin() as connection:
+        connection.execute(delete(message_search_tokens))
+        last_id, indexed = 0, 0
+        while True:
+            batch = connection.execute(
+                select(Message.id, Message.room_id, Message.text)
+                .where(Message.id > last_id)
+                .order_by(Message.id)
+                .limit(batch_size)
+            ).all()
+            if not batch:
+                break
+            rows = token_rows(batch)
+            if rows:
+                connection.execute(insert(message_search_tokens), rows)
+            last_id = batch[-1].id
+            indexed += len(batch)
+    return indexed
+
+
+# python -m app.search reindex
+if __name__ == "__main__":
+    if sys.argv[1:] != ["reindex"]:
+        print("usage: python -m app.search reindex")
+        sys.exit(2)
+    if SEARCH_BACKEND == "postgres":
+        print("Postgres maintains ix_messages_text_search itself; nothing to do.")
+    else:
+        print(f"Indexed {reindex()} messages.")
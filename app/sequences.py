@@ -0,0 +1,63 @@
+# app/sequences.py
+# Per-room message sequence numbers (messages.seq, rooms.last_seq) for databases
+# created before they existed. crud numbers every new message itself (see
+# crud.allocate_seqs); this only brings older data up to date:
+#   python -m app.sequences upgrade    # add the columns and index, then backfill
+#                                      # (also room_users.last_read_seq, see read_markers.py)
+#   python -m app.sequences backfill   # number messages that have no seq yet
+# Run it before starting the new version of the app. Blocking; for scripts.
+import sys
+
+from sqlalchemy import inspect, text
+
+from .database import get_engine
+
+# Numbered after the room's current last_seq, oldest first (timestamp, then id)
+BACKFILL_SQL = """
+    UPDATE messages SET seq = numbered.seq
+    FROM (
+        SELECT m.id, coalesce(r.last_seq, 0) + row_number() OVER (PARTITION BY m.room_id ORDER BY m.timestamp, m.id) AS seq
+        FROM messages m JOIN rooms r ON r.id = m.room_id
+        WHERE m.seq IS NULL
+    ) AS numbered
+    WHERE messages.id = numbered.id
+"""
+# Never lowered, so numbers of deleted messages aren't handed out again
+LAST_SEQ_SQL = """
+    UPDATE rooms SET last_seq = (SELECT max(seq) FROM messages WHERE messages.room_id = rooms.id)
+    WHERE last_seq < (SELECT coalesce(max(seq), 0) FROM messages WHERE messages.room_id = rooms.id)
+"""
+
+
+def upgrade(connection):
+    # Adds whatever is missing; safe to run again
+    columns = {column["name"] for column in inspect(connection).get_columns("rooms")}
+    if "last_seq" not in columns:
+        connection.execute(text("ALTER TABLE rooms ADD COLUMN last_seq INTEGER NOT NULL DEFAULT 0"))
+    columns = {column["name"] for column in inspect(connection).get_columns("messages")}
+    if "seq" not in columns:
+        connection.execute(text("ALTER TABLE messages ADD COLUMN seq INTEGER"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_room_id_seq ON messages (room_id, seq)"))
+    columns = {column["name"] for column in inspect(connection).get_columns("room_users")}
+    if "last_read_seq" not in columns:
+        connection.execute(text("ALTER TABLE room_users ADD COLUMN last_read_seq INTEGER NOT NULL DEFAULT 0"))
+
+
+def backfill(connection) -> int:
+    if connection.dialect.name == "postgresql":
+        # New messages update their room's row first, so none can take a seq meanwhile
+        connection.execute(text("LOCK TABLE rooms IN SHARE ROW EXCLUSIVE MODE"))
+    numbered = connection.execute(text(BACKFILL_SQL)).rowcount
+    connection.execute(text(LAST_SEQ_SQL))
+    return numbered
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command not in ("upgrade", "backfill"):
+        print("usage: python -m app.sequences upgrade|backfill")
+        sys.exit(2)
+    with get_engine().begin() as connection:
+        if command == "upgrade":
+            upgrade(connection)
+        print(f"Numbered {backfill(connection)} messages.")
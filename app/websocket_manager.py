@@ -1,62 +1,565 @@
 # app/websocket_manager.py
-from typing import List, Dict
-from fastapi import WebSocket, WebSocketDisconnect
-import json 
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Iterable, List, Dict, Optional, Set
+from fastapi import WebSocket, status
+import json
 
-class ConnectionManager:
+from . import metrics, protocol
+from .backplane import Backplane, create_backplane
+from .history_cache import history_cache
+from .protocol import Frame
+
+# --- Outbound Queue Configuration ---
+# How many frames may wait for a single socket before it counts as a slow consumer
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# What to do with a slow consumer: "disconnect" it, or "drop_oldest" queued frames
+SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "disconnect")
+# How many recent delivery latencies are kept per room for the stats endpoint
+LATENCY_SAMPLES = int(os.getenv("WS_LATENCY_SAMPLES", "1024"))
+# How long presence changes are collected before user_joined / user_left go out,
+# so a reconnect wave becomes one event instead of one per socket
+PRESENCE_DEBOUNCE_MS = float(os.getenv("WS_PRESENCE_DEBOUNCE_MS", "50"))
+# With several workers, each one re-announces its users in every room it follows
+# this often, and forgets another worker's users when it hasn't heard from that
+# worker for PRESENCE_TTL_SECONDS (e.g. the worker was killed before it could
+# say goodbye). 0 disables both.
+PRESENCE_HEARTBEAT_SECONDS = float(os.getenv("WS_PRESENCE_HEARTBEAT_SECONDS", "30"))
+PRESENCE_TTL_SECONDS = float(os.getenv("WS_PRESENCE_TTL_SECONDS", str(PRESENCE_HEARTBEAT_SECONDS * 3)))
+
+
+class RoomStats:
     def __init__(self):
-        # Dictionary to store active connections per room:
-        # { room_id: [websocket1, websocket2, ...], ... }
-        self.active_connections: Dict[int, List[WebSocket]] = {}
-        # Dictionary to store active users per room (username only for simplicity for now):
-        # { room_id: { username1: websocket1, username2: websocket2, ... }, ... }
-        self.active_users_in_rooms: Dict[int, Dict[str, WebSocket]] = {}
-
-    async def connect(self, room_id: int, websocket: WebSocket, username: str):
-        await websocket.accept()
-        if room_id not in self.active_connections:
-            self.active_connections[room_id] = []
-        if room_id not in self.active_users_in_rooms:
-            self.active_users_in_rooms[room_id] = {}
-
-        self.active_connections[room_id].append(websocket)
-        self.active_users_in_rooms[room_id][username] = websocket # Store websocket by username
-
-    def disconnect(self, room_id: int, websocket: WebSocket, username: str):
-        if room_id in self.active_connections and websocket in self.active_connections[room_id]:
-            self.active_connections[room_id].remove(websocket)
-        
-        if room_id in self.active_users_in_rooms and username in self.active_users_in_rooms[room_id]:
-            del self.active_users_in_rooms[room_id][username]
-
-        # Clean up empty room entries
-        if not self.active_connections[room_id]:
-            del self.active_connections[room_id]
-        if not self.active_users_in_rooms[room_id]:
-            del self.active_users_in_rooms[room_id]
-
-
-    async def broadcast_message(self, room_id: int, message: str):
-        if room_id in self.active_connections:
-            for connection in self.active_connections[room_id]:
-                await connection.send_text(message)
-
-    async def broadcast_active_users_list(self, room_id: int):
-        if room_id in self.active_users_in_rooms:
-            users_list = list(self.active_users_in_rooms[room_id].keys())
-            message_data = {
-                "type": "active_users_update",
-                "users": users_list
-            }
-            # Send as JSON string to be parsed by client
-            await self.broadcast_message(room_id, json.dumps(message_data))
+        # Seconds between broadcast and the frame actually being written, per delivery
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.delivered = 0
+        self.dropped = 0
+        self.evicted = 0
+        # Payload bytes written, after each socket's encoding and compression
+        self.bytes_sent = 0
+
+    def percentile(self, fraction: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Outbox:
+    # Bounded queue of frames for one socket, drained by its own writer task,
+    # so a slow client never holds up the rest of the room.
+    # A plain deque plus a single wake-up future: an idle asyncio.Queue (three
+    # deques and an Event) costs several KB per socket.
+    __slots__ = ("websocket", "stats", "maxsize", "policy", "frames", "waiter", "closed", "writer", "held", "drained",
+                 "encoding", "compress")
+
+    def __init__(self, websocket: WebSocket, stats: RoomStats, maxsize: int = SEND_QUEUE_SIZE,
+                 policy: str = SLOW_CONSUMER_POLICY, encoding: str = "json", compress: bool = False):
+        self.websocket = websocket
+        self.stats = stats
+        self.maxsize = maxsize
+        self.policy = policy
+        # What this client asked for at connect time (see protocol.Frame.wire)
+        self.encoding = encoding
+        self.compress = compress
+        # (frame, enqueued_at) tuples, oldest first
+        self.frames: "deque[tuple]" = deque()
+        # Set while the writer is waiting for frames
+        self.waiter: Optional[asyncio.Future] = None
+        self.closed = False
+        # While a reconnect replay is queued (see hold()): frames that arrive meanwhile
+        self.held: Optional[list] = None
+        # Set while someone waits in drain()
+        self.drained: Optional[asyncio.Future] = None
+        self.writer = asyncio.create_task(self._run())
+
+    def put(self, frame: Frame, enqueued_at: float) -> bool:
+        # Returns False when the client can't keep up and has to be evicted
+        if self.closed:
+            return True
+        if self.held is not None:
+            # Same bound as the queue: a replay can't make a slow client use more memory
+            if len(self.held) >= self.maxsize:
+                if self.policy != "drop_oldest":
+                    return False
+                self.held.pop(0)
+                self.stats.dropped += 1
+            self.held.append((frame, enqueued_at))
+            return True
+        return self.push(frame, enqueued_at)
+
+    def push(self, frame: Frame, enqueued_at: float) -> bool:
+        # Queues a frame even while held
+        if self.closed:
+            return True
+        if len(self.frames) >= self.maxsize:
+            if self.policy != "drop_oldest":
+                return False
+            self.frames.popleft()
+            self.stats.dropped += 1
+        self.frames.append((frame, enqueued_at))
+        if self.waiter is not None:
+            if not self.waiter.done():
+                self.waiter.set_result(None)
+            self.waiter = None
+        return True
+
+    # --- Reconnect replay ---
+
+    def hold(self):
+        # Keep frames sent to this socket aside, so that replayed history (queued
+        # with push()) goes out ahead of live messages that arrive while it's read
+        self.held = []
+
+    def release(self, keep=None) -> bool:
+        # Queue the held frames after the replay; keep(frame) filters out duplicates.
+        # Returns False if the client has to be evicted.
+        held, self.held = self.held or [], None
+        for frame, enqueued_at in held:
+            if (keep is None or keep(frame)) and not self.push(frame, enqueued_at):
+                return False
+        return True
+
+    async def drain(self):
+        # Wait until everything queued has been written, before queueing the next
+        # replay batch: a long replay goes out a batch at a time at the client's pace
+        if self.frames and not self.closed and not self.writer.done():
+            if self.drained is None:
+                self.drained = asyncio.get_running_loop().create_future()
+            await self.drained
+
+    def _wake_drained(self):
+        if self.drained is not None:
+            if not self.drained.done():
+                self.drained.set_result(None)
+            self.drained = None
+
+    async def _run(self):
+        try:
+            while True:
+                if not self.frames:
+                    self._wake_drained()
+                    self.waiter = asyncio.get_running_loop().create_future()
+                    await self.waiter
+                    continue
+                frame, enqueued_at = self.frames.popleft()
+                payload = frame.wire(self.encoding, self.compress)
+                if type(payload) is str:
+                    await self.websocket.send_text(payload)
+                    self.stats.bytes_sent += len(frame.data)
+                else:
+                    await self.websocket.send_bytes(payload)
+                    self.stats.bytes_sent += len(payload)
+                self.stats.latencies.append(time.perf_counter() - enqueued_at)
+                self.stats.delivered += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # Socket is gone; the receive loop in main.py will notice and disconnect it
+            pass
+        self._wake_drained()
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self.held = None
+        self.writer.cancel()
+        self._wake_drained()
+
+
+class RoomPresence:
+    # Who is in a room across all workers, maintained incrementally. A user is
+    # present while at least one "source" has them: this worker (any number of
+    # local sockets) or another worker that announced them.
+    def __init__(self):
+        # { username: number of local sockets }
+        self.local: Dict[str, int] = {}
+        # Users connected to other workers: { worker_id: {username, ...} }
+        self.remote: Dict[str, Set[str]] = {}
+        # When each of those workers was last heard from (monotonic seconds)
+        self.remote_seen: Dict[str, float] = {}
+        # { username: number of sources }; its length is the room's member count
+        self.sources: Dict[str, int] = {}
+        # Users changed in the current debounce window, with their state when
+        # the window opened: { username: was_present }
+        self.changed: Dict[str, bool] = {}
+        # Same for this worker's own users, which are announced to the others
+        self.local_changed: Dict[str, bool] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+
+    @property
+    def count(self) -> int:
+        return len(self.sources)
+
+    def _add_source(self, username: str):
+        sources = self.sources.get(username, 0)
+        if sources == 0:
+            self.changed.setdefault(username, False)
+        self.sources[username] = sources + 1
+
+    def _remove_source(self, username: str):
+        sources = self.sources.get(username, 0)
+        if sources > 1:
+            self.sources[username] = sources - 1
+        elif sources == 1:
+            del self.sources[username]
+            self.changed.setdefault(username, True)
+
+    def add_local(self, username: str):
+        sockets = self.local.get(username, 0)
+        self.local[username] = sockets + 1
+        if sockets == 0:
+            self.local_changed.setdefault(username, False)
+            self._add_source(username)
+
+    def remove_local(self, username: str):
+        sockets = self.local.get(username, 0)
+        if sockets > 1:
+            self.local[username] = sockets - 1
+        elif sockets == 1:
+            del self.local[username]
+            self.local_changed.setdefault(username, True)
+            self._remove_source(username)
+
+    def set_remote(self, worker_id: str, usernames: Iterable[str]):
+        # Full list from a worker (answer to presence_sync, or [] when it stops)
+        new = set(usernames)
+        old = self.remote.get(worker_id, set())
+        for username in new - old:
+            self._add_source(username)
+        for username in old - new:
+            self._remove_source(username)
+        if new:
+            self.remote[worker_id] = new
+            self.remote_seen[worker_id] = time.monotonic()
+        else:
+            self.remote.pop(worker_id, None)
+            self.remote_seen.pop(worker_id, None)
+
+    def apply_remote_delta(self, worker_id: str, joined: Iterable[str], left: Iterable[str]):
+        users = self.remote.setdefault(worker_id, set())
+        for username in joined:
+            if username not in users:
+                users.add(username)
+                self._add_source(username)
+        for username in left:
+            if username in users:
+                users.discard(username)
+                self._remove_source(username)
+        if users:
+            self.remote_seen[worker_id] = time.monotonic()
         else:
-            # If room is empty, broadcast an empty list
-            message_data = {
-                "type": "active_users_update",
-                "users": []
+            del self.remote[worker_id]
+            self.remote_seen.pop(worker_id, None)
+
+    def expire_remote(self, older_than: float) -> bool:
+        # Drops the users of workers not heard from since older_than; True if any
+        expired = [worker_id for worker_id, seen in self.remote_seen.items() if seen < older_than]
+        for worker_id in expired:
+            self.set_remote(worker_id, [])
+        return bool(expired)
+
+    def take_changes(self):
+        # Net effect of the window: someone who left and came back is no change
+        joined = [u for u, was_present in self.changed.items() if not was_present and u in self.sources]
+        left = [u for u, was_present in self.changed.items() if was_present and u not in self.sources]
+        local_joined = [u for u, was_local in self.local_changed.items() if not was_local and u in self.local]
+        local_left = [u for u, was_local in self.local_changed.items() if was_local and u not in self.local]
+        self.changed = {}
+        self.local_changed = {}
+        return joined, left, local_joined, local_left
+
+
+class Connection:
+    # One open socket: who it belongs to, which room it is in, and its outbound queue
+    __slots__ = ("websocket", "user_id", "username", "room_id", "outbox", "rate_tat", "rate_limited_until")
+
+    def __init__(self, websocket: WebSocket, user_id: int, username: str, room_id: int, outbox: Outbox):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.username = username
+        self.room_id = room_id
+        self.outbox = outbox
+        # Incoming frame rate limit state (see rate_limit.py)
+        self.rate_tat = 0.0
+        self.rate_limited_until = 0.0
+
+
+class ConnectionManager:
+    def __init__(self, backplane: Optional[Backplane] = None):
+        # Every local socket: { websocket: Connection }
+        self.connections: Dict[WebSocket, Connection] = {}
+        # Sockets per room, O(1) add/remove: { room_id: {Connection, ...} }
+        self.rooms: Dict[int, Set[Connection]] = {}
+        # Sockets per user, across rooms and tabs: { user_id: {Connection, ...} }
+        self.user_connections: Dict[int, Set[Connection]] = {}
+        # Pub/sub used to reach sockets held by other workers (in-process by default)
+        self.backplane = backplane if backplane is not None else create_backplane()
+        # Merged presence (local and other workers) per room: { room_id: RoomPresence }
+        self.presence: Dict[int, RoomPresence] = {}
+        # Delivery statistics per room: { room_id: RoomStats }
+        self.room_stats: Dict[int, RoomStats] = {}
+        # Wall-clock time member counts last changed, for the room directory's Last-Modified
+        self.presence_modified = time.time()
+        self.heartbeat_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self.backplane.start(self.handle_backplane_event)
+        if self.backplane.cross_worker and PRESENCE_HEARTBEAT_SECONDS > 0:
+            self.heartbeat_task = asyncio.create_task(self._presence_heartbeat())
+
+    async def stop(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        # Tell the other workers our users are gone before we disappear
+        for room_id, presence in list(self.presence.items()):
+            if presence.flush_task is not None:
+                presence.flush_task.cancel()
+            await self.backplane.publish(room_id, "presence", "[]")
+        await self.backplane.stop()
+
+    async def connect(self, room_id: int, websocket: WebSocket, user_id: int, username: str,
+                      encoding: str = "json", compress: bool = False) -> Connection:
+        await websocket.accept()
+        # All the bookkeeping is done before the first await below: a disconnect
+        # from the same room may run during it, and must find the room complete
+        new_room = room_id not in self.rooms
+        if new_room:
+            self.rooms[room_id] = set()
+            self.room_stats[room_id] = RoomStats()
+            self.presence[room_id] = RoomPresence()
+
+        outbox = Outbox(websocket, self.room_stats[room_id], encoding=encoding, compress=compress)
+        connection = Connection(websocket, user_id, username, room_id, outbox)
+        self.connections[websocket] = connection
+        self.rooms[room_id].add(connection)
+        self.user_connections.setdefault(user_id, set()).add(connection)
+        presence = self.presence[room_id]
+        presence.add_local(username)
+
+        if new_room:
+            # First local socket in this room: start listening to it and ask the
+            # other workers who they have in there
+            await self.backplane.subscribe(room_id)
+            await self.backplane.publish(room_id, "presence_sync", "")
+        # Only the new socket gets the full list; everyone else hears user_joined
+        await self.send_personal(websocket, protocol.active_users_update(list(presence.sources)))
+        self.schedule_presence(room_id)
+        return connection
+
+    async def disconnect(self, websocket: WebSocket):
+        connection = self.connections.pop(websocket, None)
+        if connection is None:
+            return # Already gone
+        connection.outbox.close()
+        room_id = connection.room_id
+        room = self.rooms.get(room_id)
+        if room is not None:
+            room.discard(connection)
+        user_connections = self.user_connections.get(connection.user_id)
+        if user_connections is not None:
+            user_connections.discard(connection)
+            if not user_connections:
+                del self.user_connections[connection.user_id]
+
+        presence = self.presence.get(room_id)
+        if presence is not None:
+            # The user only leaves the room with their last tab
+            presence.remove_local(connection.username)
+            self.schedule_presence(room_id)
+
+        # Clean up empty room entries. Like in connect(), everything is removed
+        # before the first await: a join during the awaits starts the room afresh.
+        if room is not None and not room:
+            del self.rooms[room_id]
+            self.room_stats.pop(room_id, None)
+            presence = self.presence.pop(room_id, None)
+            if presence is not None and presence.flush_task is not None:
+                presence.flush_task.cancel()
+            self.presence_modified = time.time()
+            # Announce our last users' departure now, there is no one left to debounce
+            # for: this worker has nobody in the room anymore
+            await self.backplane.publish(room_id, "presence", "[]")
+            # No local sockets left, unless someone joined meanwhile: stop following this room
+            if room_id not in self.rooms:
+                # Messages other workers write from now on won't reach this worker's
+                # history cache, so it can't be trusted for the next join
+                if self.backplane.cross_worker:
+                    history_cache.invalidate(room_id)
+                await self.backplane.unsubscribe(room_id)
+
+    def get_user_connections(self, user_id: int) -> List[Connection]:
+        # All of a user's sockets on this worker, in any room
+        return list(self.user_connections.get(user_id, ()))
+
+    # --- Cross-worker plumbing ---
+
+    async def publish_presence(self, room_id: int):
+        # Full list of this worker's users in the room, for workers that just joined it
+        presence = self.presence.get(room_id)
+        local_users = list(presence.local) if presence is not None else []
+        await self.backplane.publish(room_id, "presence", json.dumps(local_users))
+
+    async def handle_backplane_event(self, room_id: int, origin: str, kind: str, body: str):
+        presence = self.presence.get(room_id)
+        if presence is None:
+            return # Nobody here cares about this room (anymore)
+        if kind == "message":
+            frame = Frame(text=body)
+            await self.send_local(room_id, frame)
+            # Keep this worker's join-time history in step with the other workers
+            history_cache.append_encoded(room_id, frame)
+        elif kind == "stored":
+            # An optimistic message another worker has now stored: history only,
+            # its sockets already got the message when it was sent
+            history_cache.append_encoded(room_id, Frame(text=body))
+        elif kind == "presence":
+            presence.set_remote(origin, json.loads(body))
+            self.schedule_presence(room_id)
+        elif kind == "presence_delta":
+            delta = json.loads(body)
+            presence.apply_remote_delta(origin, delta["joined"], delta["left"])
+            self.schedule_presence(room_id)
+        elif kind == "presence_sync":
+            await self.publish_presence(room_id)
+
+    async def _presence_heartbeat(self):
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT_SECONDS)
+            cutoff = time.monotonic() - PRESENCE_TTL_SECONDS
+            for room_id, presence in list(self.presence.items()):
+                if self.presence.get(room_id) is not presence:
+                    continue # Left during an earlier publish
+                if presence.expire_remote(cutoff):
+                    self.schedule_presence(room_id)
+                try:
+                    await self.publish_presence(room_id)
+                except Exception as e:
+                    print(f"Presence heartbeat failed for room {room_id}: {e}")
+
+    def share_stored(self, room_id: int, frame: Frame):
+        # Optimistic write-behind: the frame with the stored id and seq, for the
+        # other workers' history caches (the broadcast one had neither)
+        if self.backplane.cross_worker:
+            asyncio.create_task(self._publish_stored(room_id, frame))
+
+    async def _publish_stored(self, room_id: int, frame: Frame):
+        try:
+            await self.backplane.publish(room_id, "stored", frame.text)
+        except Exception as e:
+            print(f"Backplane: could not share stored message for room {room_id}: {e}")
+
+    def get_active_users(self, room_id: int) -> List[str]:
+        presence = self.presence.get(room_id)
+        return list(presence.sources) if presence is not None else []
+
+    def get_member_count(self, room_id: int) -> int:
+        presence = self.presence.get(room_id)
+        return presence.count if presence is not None else 0
+
+    # --- Presence deltas ---
+
+    def schedule_presence(self, room_id: int):
+        # Opens a debounce window unless one is already open for the room
+        presence = self.presence.get(room_id)
+        if presence is not None and presence.flush_task is None:
+            presence.flush_task = asyncio.create_task(self._flush_presence_later(room_id, presence))
+
+    async def _flush_presence_later(self, room_id: int, presence: RoomPresence):
+        await asyncio.sleep(PRESENCE_DEBOUNCE_MS / 1000)
+        if self.presence.get(room_id) is presence:
+            presence.flush_task = None
+            await self.flush_presence(room_id)
+
+    async def flush_presence(self, room_id: int):
+        presence = self.presence.get(room_id)
+        if presence is None:
+            return
+        if presence.flush_task is not None and presence.flush_task is not asyncio.current_task():
+            presence.flush_task.cancel()
+        presence.flush_task = None
+        joined, left, local_joined, local_left = presence.take_changes()
+        if joined or left:
+            self.presence_modified = time.time()
+        # Encoded once per window, whatever the number of sockets or changes
+        if left:
+            await self.send_local(room_id, protocol.user_left(left, presence.count))
+        if joined:
+            await self.send_local(room_id, protocol.user_joined(joined, presence.count))
+        if local_joined or local_left:
+            await self.backplane.publish(room_id, "presence_delta", json.dumps({"joined": local_joined, "left": local_left}))
+
+    # --- Broadcasting ---
+
+    async def send_personal(self, websocket: WebSocket, frame: Frame, encoding: str = "json", compress: bool = False):
+        # Goes through the socket's queue so it stays ordered with broadcasts. A socket
+        # that isn't registered (not joined yet, or already evicted) is written to
+        # directly, in the encoding it asked for: pass it, the manager doesn't know it.
+        connection = self.connections.get(websocket)
+        if connection is None:
+            payload = frame.wire(encoding, compress)
+            if type(payload) is str:
+                await websocket.send_text(payload)
+            else:
+                await websocket.send_bytes(payload)
+        elif not connection.outbox.put(frame, time.perf_counter()):
+            await self.evict(websocket)
+
+    async def send_local(self, room_id: int, frame: Frame):
+        # Only enqueues; each socket's writer task does the actual sending
+        room = self.rooms.get(room_id)
+        if room:
+            enqueued_at = time.perf_counter()
+            slow_consumers = [connection for connection in room if not connection.outbox.put(frame, enqueued_at)]
+            metrics.observe_fanout(time.perf_counter() - enqueued_at)
+            for connection in slow_consumers:
+                await self.evict(connection.websocket)
+
+    async def evict(self, websocket: WebSocket):
+        connection = self.connections.get(websocket)
+        if connection is None or connection.outbox.closed:
+            return
+        outbox = connection.outbox
+        outbox.close()
+        outbox.stats.evicted += 1
+        # Closing makes receive_text() in the endpoint raise WebSocketDisconnect,
+        # which runs the normal disconnect path. Don't wait on a stalled client.
+        asyncio.create_task(self._close_quietly(websocket))
+
+    async def _close_quietly(self, websocket: WebSocket):
+        try:
+            await asyncio.wait_for(
+                websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="Too slow to keep up"), timeout=5
+            )
+        except Exception:
+            pass
+
+    def get_stats(self) -> Dict[int, dict]:
+        stats = {}
+        for room_id, connections in self.rooms.items():
+            room_stats = self.room_stats[room_id]
+            depths = [len(connection.outbox.frames) for connection in connections]
+            stats[room_id] = {
+                "connections": len(connections),
+                "members": self.get_member_count(room_id),
+                "queue_depth_total": sum(depths),
+                "queue_depth_max": max(depths, default=0),
+                "delivered": room_stats.delivered,
+                "dropped": room_stats.dropped,
+                "evicted": room_stats.evicted,
+                "bytes_sent": room_stats.bytes_sent,
+                "latency_p50_ms": room_stats.percentile(0.50) * 1000,
+                "latency_p99_ms": room_stats.percentile(0.99) * 1000,
+                "latency_max_ms": max(room_stats.latencies, default=0.0) * 1000,
             }
-            await self.broadcast_message(room_id, json.dumps(message_data))
+        return stats
+
+    async def broadcast_message(self, room_id: int, frame: Frame):
+        await self.send_local(room_id, frame)
+        await self.backplane.publish(room_id, "message", frame.text)
 
 # Instantiate the manager
-manager = ConnectionManager()
\ No newline at end of file
+manager = ConnectionManager()
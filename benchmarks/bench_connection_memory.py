@@ -0,0 +1,66 @@
+# benchmarks/bench_connection_memory.py
+# Memory held by ConnectionManager per idle WebSocket: the Connection record, the
+# registry entries (room set, user multimap, presence counts) and the socket's
+# Outbox (bounded queue + writer task). The sockets themselves are stubs and are
+# allocated before measuring, so they don't count.
+#
+#   python -m benchmarks.bench_connection_memory [--connections 10000] [--rooms 100] [--tabs 1]
+import argparse
+import asyncio
+import gc
+import tracemalloc
+
+from app.backplane import InProcessBackplane
+from app.websocket_manager import ConnectionManager
+
+
+class StubWebSocket:
+    __slots__ = ()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        pass
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        pass
+
+
+async def main(connections: int, rooms: int, tabs: int):
+    manager = ConnectionManager(InProcessBackplane(hub={}, worker_id="bench"))
+    await manager.start()
+    sockets = [StubWebSocket() for _ in range(connections)]
+    usernames = [f"user{i // tabs}" for i in range(connections)]
+    await asyncio.sleep(0.2)
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i, websocket in enumerate(sockets):
+        await manager.connect(i % rooms, websocket, i // tabs, usernames[i])
+    # Let the writer tasks drain the join snapshots and presence events
+    await asyncio.sleep(0.5)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, "filename")
+    total = sum(stat.size_diff for stat in stats)
+    print(f"{connections} idle connections in {rooms} rooms, {tabs} tab(s) per user")
+    print(f"  total {total / 1024 / 1024:8.2f} MiB   per connection {total / connections:8.0f} bytes")
+    for stat in stats[:6]:
+        print(f"  {stat.size_diff / connections:8.0f} bytes/conn  {stat.traceback[0].filename}")
+
+    for websocket in sockets:
+        await manager.disconnect(websocket)
+    await manager.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--tabs", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(main(args.connections, args.rooms, args.tabs))
@@ -0,0 +1,113 @@
+# benchmarks/bench_encodings.py
+# Bytes on the wire and CPU per frame for each WebSocket encoding a client can pick
+# (see protocol.Frame.wire), plus transport-level permessage-deflate for reference.
+#
+#   python -m benchmarks.bench_encodings [--recipients 100]
+#
+# "build" is the CPU to produce one variant of a frame. The app builds it once per
+# broadcast, whatever the number of recipients. permessage-deflate (what uvicorn
+# negotiates by default) compresses every frame again for every connection, with
+# that connection's own zlib context, so its cost is per recipient.
+import argparse
+import random
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from app import protocol
+
+USERS = 500
+STREAM = 500 # Chat messages in the permessage-deflate stream
+
+now = datetime.now(timezone.utc)
+WORDS = ("the a to and is it we deploy logs worker fix lunch config tomorrow meeting ok sure thanks "
+         "restarted twice last night rate limiter room message database query slow fast works broken "
+         "push merge review test release users online why how what when yes no maybe later").split()
+# Same pseudo-random texts on every run: 1 to 25 words each
+_random = random.Random(42)
+texts = [" ".join(_random.choice(WORDS) for _ in range(_random.randint(1, 25))) for _ in range(1000)]
+
+
+def message(i: int) -> protocol.Frame:
+    return protocol.chat_message(1000 + i, f"user{i % 20}", texts[i % len(texts)], now + timedelta(seconds=i), seq=i + 1)
+
+def history(count: int) -> protocol.Frame:
+    return protocol.chat_history([message(i) for i in range(count)], next_cursor="MjAyNi0xMC0xN1QwMDowMDowMHwxMjM0")
+
+WORKLOADS = [
+    ("chat_message", lambda: message(3)),
+    ("history (50 messages)", lambda: history(50)),
+    ("replay (200 messages)", lambda: history(200)),
+    (f"active_users_update ({USERS} users)", lambda: protocol.active_users_update([f"user{i}" for i in range(USERS)])),
+]
+VARIANTS = [("json", False), ("json", True), ("msgpack", False), ("msgpack", True)]
+
+
+def wire_size(payload) -> int:
+    return len(payload.encode("utf-8")) if isinstance(payload, str) else len(payload)
+
+def time_build(make, encoding: str, compress: bool, number: int) -> float:
+    # Fresh Frames each time: the cached variant would otherwise cost nothing
+    frames = [make() for _ in range(number)]
+    for frame in frames:
+        frame.data
+    start = time.perf_counter()
+    for frame in frames:
+        frame.wire(encoding, compress)
+    return (time.perf_counter() - start) / number
+
+
+class PerMessageDeflate:
+    # What websockets does per connection when permessage-deflate is negotiated
+    # with uvicorn's defaults: window bits 15, context kept between messages
+    def __init__(self):
+        self.encoder = zlib.compressobj(wbits=-15)
+
+    def compress(self, data: bytes) -> bytes:
+        return (self.encoder.compress(data) + self.encoder.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+
+def bench_permessage_deflate(recipients: int):
+    frames = [message(i).data for i in range(STREAM)]
+    # Bytes: one connection receiving the whole stream (the context helps later frames)
+    connection = PerMessageDeflate()
+    compressed = sum(len(connection.compress(data)) for data in frames)
+    plain = sum(len(data) for data in frames)
+    # CPU: every broadcast is compressed once per recipient
+    connections = [PerMessageDeflate() for _ in range(recipients)]
+    start = time.perf_counter()
+    for data in frames:
+        for connection in connections:
+            connection.compress(data)
+    per_frame = (time.perf_counter() - start) / STREAM
+    return plain / STREAM, compressed / STREAM, per_frame
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_encodings")
+    parser.add_argument("--recipients", type=int, default=100, help="sockets per broadcast, for the per-broadcast CPU column")
+    parser.add_argument("--number", type=int, default=200, help="frames built per measurement")
+    args = parser.parse_args(argv)
+    if protocol.msgpack is None:
+        raise SystemExit("msgpack is not installed (pip install msgpack)")
+
+    print(f"JSON backend: {protocol.JSON_BACKEND}, compress from {protocol.WS_COMPRESS_MIN_BYTES} bytes "
+          f"at level {protocol.WS_COMPRESS_LEVEL}, {args.recipients} recipients per broadcast")
+    for name, make in WORKLOADS:
+        print(name)
+        json_size = wire_size(make().wire())
+        for encoding, compress in VARIANTS:
+            size = wire_size(make().wire(encoding, compress))
+            build = time_build(make, encoding, compress, args.number)
+            label = encoding + ("+deflate" if compress else "")
+            print(f"  {label:<16} {size:>8} bytes {size / json_size:6.1%}   build {build * 1e6:9.2f} us/broadcast")
+
+    plain, compressed, per_frame = bench_permessage_deflate(args.recipients)
+    print(f"chat_message stream, permessage-deflate ({STREAM} messages, context takeover)")
+    print(f"  {'json':<16} {plain:>8.0f} bytes")
+    print(f"  {'permessage':<16} {compressed:>8.0f} bytes {compressed / plain:6.1%}   "
+          f"deflate {per_frame / args.recipients * 1e6:9.2f} us/recipient, {per_frame * 1e6:9.2f} us/broadcast")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# benchmarks/bench_message_rows.py
+# Read path cost of a page of room history, for three ways of loading it:
+#   lazy sender  - Message objects, sender loaded per message (the old N+1 pattern)
+#   joinedload   - Message objects with the sender joined in (ORM hydration)
+#   lean rows    - crud.get_messages_in_room: plain columns into MessageRow records
+#
+#   python -m benchmarks.bench_message_rows [--url postgresql://...] [--senders 20]
+#
+# Seeds one room with 5000 messages per run and reports the median time and the
+# number of SQL statements per page.
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+# app.database picks the messages table layout (partitioned on Postgres) from
+# DATABASE_URL when it is imported, so point it at this run's database first
+DEFAULT_URL = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+url_parser = argparse.ArgumentParser(add_help=False)
+url_parser.add_argument("--url", default=DEFAULT_URL)
+os.environ["DATABASE_URL"] = url_parser.parse_known_args()[0].url
+
+from sqlalchemy import create_engine, event, insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, joinedload
+
+from app import crud, protocol
+from app.database import Base, Message, Room, User, to_async_url
+
+PAGE_SIZES = (50, 500, 5000)
+REPEAT = 7
+
+
+def seed(url: str, senders: int, messages: int):
+    sync_engine = create_engine(url)
+    Base.metadata.create_all(sync_engine)
+    tag = uuid.uuid4().hex[:8]
+    with Session(sync_engine, expire_on_commit=False) as db:
+        room = Room(name=f"bench-{tag}")
+        users = [User(username=f"bench-{tag}-{i}", email=f"bench-{tag}-{i}@example.com", hashed_password="x") for i in range(senders)]
+        db.add_all([room, *users])
+        db.commit()
+        start = datetime.now(timezone.utc) - timedelta(seconds=messages)
+        db.execute(insert(Message), [
+            {"text": f"message number {i} with some text in it", "room_id": room.id,
+             "sender_id": users[i % senders].id, "timestamp": start + timedelta(seconds=i)}
+            for i in range(messages)
+        ])
+        db.commit()
+    sync_engine.dispose()
+    return room.id
+
+
+def history_query(room_id: int, limit: int):
+    return select(Message).filter(Message.room_id == room_id).order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit)
+
+
+async def lazy_sender(db, room_id, limit):
+    # Lazy loading only works on the sync side of an AsyncSession
+    def load(session):
+        messages = session.execute(history_query(room_id, limit)).scalars().all()
+        return [protocol.chat_message(m.id, m.sender.username, m.text, m.timestamp) for m in messages]
+    return await db.run_sync(load)
+
+async def joined_sender(db, room_id, limit):
+    result = await db.execute(history_query(room_id, limit).options(joinedload(Message.sender)))
+    messages = result.scalars().all()
+    return [protocol.chat_message(m.id, m.sender.username, m.text, m.timestamp) for m in messages]
+
+async def lean_rows(db, room_id, limit):
+    messages = await crud.get_messages_in_room(db, room_id, limit=limit)
+    return [protocol.chat_message(m.id, m.sender_username, m.text, m.timestamp) for m in messages]
+
+
+async def main(url: str, senders: int):
+    room_id = seed(url, senders, max(PAGE_SIZES))
+    engine = create_async_engine(to_async_url(url))
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    statements = 0
+
+    def count(*args):
+        nonlocal statements
+        statements += 1
+    event.listen(engine.sync_engine, "before_cursor_execute", count)
+
+    print(f"Room history pages on {engine.url.get_backend_name()}, {senders} distinct senders")
+    for limit in PAGE_SIZES:
+        print(f"{limit} messages")
+        for name, load in [("lazy sender", lazy_sender), ("joinedload", joined_sender), ("lean rows", lean_rows)]:
+            timings = []
+            for _ in range(REPEAT):
+                # A fresh session each time, like a request: nothing is in the identity map
+                async with session_factory() as db:
+                    statements = 0
+                    started = time.perf_counter()
+                    frames = await load(db, room_id, limit)
+                    timings.append(time.perf_counter() - started)
+            assert len(frames) == limit
+            print(f"  {name:<12} {statistics.median(timings) * 1000:9.2f} ms   {statements:4d} statements")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--senders", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.url, args.senders))
@@ -0,0 +1,58 @@
+# benchmarks/bench_protocol.py
+# Microbenchmark: CPU spent encoding chat frames, old per-event json.dumps vs app.protocol.
+#
+#   python -m benchmarks.bench_protocol
+import json
+import timeit
+from datetime import datetime, timezone
+
+from app import protocol
+
+HISTORY = 50
+USERS = 500
+
+now = datetime.now(timezone.utc)
+history_rows = [(i, f"user{i % 20}", f"message number {i} with some text in it", now) for i in range(HISTORY)]
+users = [f"user{i}" for i in range(USERS)]
+
+
+def old_history():
+    # One json.dumps (and one send) per history message
+    return [
+        json.dumps({"type": "chat_message", "message_id": i, "sender_username": u, "text": t, "timestamp": ts.isoformat()})
+        for i, u, t, ts in history_rows
+    ]
+
+def new_history():
+    return protocol.chat_history(protocol.chat_message(*row) for row in history_rows).text
+
+def old_message():
+    return json.dumps({"type": "chat_message", "message_id": 1, "sender_username": "alice", "text": "hello there", "timestamp": now.isoformat()})
+
+def new_message():
+    return protocol.chat_message(1, "alice", "hello there", now).text
+
+def old_active_users():
+    return json.dumps({"type": "active_users_update", "users": users})
+
+def new_active_users():
+    return protocol.active_users_update(users).text
+
+
+def bench(label, fn, number):
+    seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    print(f"  {label:<34} {seconds * 1e6:9.2f} us")
+    return seconds
+
+
+if __name__ == "__main__":
+    print(f"JSON backend: {protocol.JSON_BACKEND}")
+    for name, old, new, number in [
+        ("chat_message", old_message, new_message, 20000),
+        (f"history replay ({HISTORY} messages)", old_history, new_history, 2000),
+        (f"active_users_update ({USERS} users)", old_active_users, new_active_users, 2000),
+    ]:
+        print(name)
+        before = bench("json.dumps", old, number)
+        after = bench("protocol", new, number)
+        print(f"  speedup {before / after:.1f}x")
@@ -0,0 +1,85 @@
+# benchmarks/bench_startup.py
+# Cold import time of app.main, from `python -X importtime`, in fresh interpreters.
+# Also a regression check: modules that should only load on first use (see
+# DEFERRED) must not be imported by `import app.main`.
+#
+#   python -m benchmarks.bench_startup [--runs 7] [--top 15] [--max-ms 1500]
+#
+# Exits with status 1 if a deferred module is imported, or if the median import
+# time is over --max-ms. Nothing connects to the database.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+# Loaded on first use instead of at import: JWT handling, password hashing,
+# and the database drivers (loaded when the engines are created)
+DEFERRED = ("jose", "cryptography", "passlib", "bcrypt", "psycopg2", "asyncpg", "aiosqlite")
+
+
+def import_once() -> Tuple[float, List[Tuple[str, int, int]]]:
+    # (wall seconds, [(module, self us, cumulative us)]) for one fresh interpreter
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app.main"],
+                            capture_output=True, text=True, env=os.environ.copy())
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise SystemExit(f"import app.main failed:\n{result.stderr[-2000:]}")
+    modules = []
+    for line in result.stderr.splitlines():
+        # "import time:       267 |      37653 |   jose.jwt"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return elapsed, modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_startup")
+    parser.add_argument("--runs", type=int, default=7, help="fresh interpreters to measure")
+    parser.add_argument("--top", type=int, default=15, help="top-level packages to list")
+    parser.add_argument("--max-ms", type=float, default=0, help="fail if the median import of app.main takes longer (0: no limit)")
+    args = parser.parse_args(argv)
+
+    import_once() # Warm the filesystem cache and .pyc files
+    walls, app_main, per_package = [], [], defaultdict(list)
+    imported = set()
+    for _ in range(args.runs):
+        wall, modules = import_once()
+        walls.append(wall)
+        totals: Dict[str, int] = defaultdict(int)
+        for name, self_us, cumulative_us in modules:
+            totals[name.split(".")[0]] += self_us
+            imported.add(name.split(".")[0])
+            if name == "app.main":
+                app_main.append(cumulative_us / 1000)
+        for package, self_us in totals.items():
+            per_package[package].append(self_us / 1000)
+
+    median = statistics.median(app_main)
+    print(f"import app.main: median {median:.0f} ms, min {min(app_main):.0f} ms ({args.runs} runs); "
+          f"interpreter wall time median {statistics.median(walls) * 1000:.0f} ms")
+    print("Self time by top-level package (median ms):")
+    ranked = sorted(per_package.items(), key=lambda item: -statistics.median(item[1]))
+    for package, times in ranked[:args.top]:
+        print(f"  {package:<24} {statistics.median(times):8.1f}")
+
+    failed = False
+    eager = [name for name in DEFERRED if name in imported]
+    if eager:
+        print(f"FAIL: imported at startup, should load on first use: {', '.join(eager)}")
+        failed = True
+    if args.max_ms and median > args.max_ms:
+        print(f"FAIL: median {median:.0f} ms is over --max-ms {args.max_ms:.0f}")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
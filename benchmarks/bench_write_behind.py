@@ -0,0 +1,101 @@
+# benchmarks/bench_write_behind.py
+# Throughput vs latency of chat message storage: one INSERT + COMMIT per message
+# (crud.create_message) against the write-behind pipeline (message_writer.py).
+#
+#   python -m benchmarks.bench_write_behind [--url postgresql://...] [--messages 5000] [--senders 50]
+#
+# Creates the tables if missing and a fresh room/users per run. SQLite is the default,
+# but it only allows one writer at a time: use PostgreSQL for meaningful numbers.
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+
+# app.database picks the messages table layout (partitioned on Postgres) from
+# DATABASE_URL when it is imported, so point it at this run's database first
+DEFAULT_URL = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+url_parser = argparse.ArgumentParser(add_help=False)
+url_parser.add_argument("--url", default=DEFAULT_URL)
+os.environ["DATABASE_URL"] = url_parser.parse_known_args()[0].url
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+
+from app import crud, schemas
+from app.database import Base, Room, User, to_async_url
+from app.message_writer import MessageWriter
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run_senders(senders: int, per_sender: int, send_one):
+    latencies = []
+
+    async def sender(sender: int):
+        for i in range(per_sender):
+            started = time.perf_counter()
+            await send_one(sender, f"sender {sender} message {i}")
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(s) for s in range(senders)))
+    return time.perf_counter() - started, latencies
+
+
+def seed(url: str, senders: int):
+    # A fresh room and one user per sender, so runs never collide
+    sync_engine = create_engine(url)
+    Base.metadata.create_all(sync_engine)
+    tag = uuid.uuid4().hex[:8]
+    with Session(sync_engine, expire_on_commit=False) as db:
+        room = Room(name=f"bench-{tag}")
+        users = [User(username=f"bench-{tag}-{i}", email=f"bench-{tag}-{i}@example.com", hashed_password="x") for i in range(senders)]
+        db.add_all([room, *users])
+        db.commit()
+    sync_engine.dispose()
+    return room.id, [user.id for user in users]
+
+
+async def main(url: str, messages: int, senders: int, batch_size: int, flush_ms: float):
+    room_id, sender_ids = seed(url, senders)
+    engine = create_async_engine(to_async_url(url), pool_size=senders, max_overflow=0)
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    per_sender = messages // senders
+    results = {}
+
+    async def direct(sender, text):
+        async with session_factory() as db:
+            message = schemas.MessageCreate(text=text, room_id=room_id, sender_id=sender_ids[sender])
+            await crud.create_message(db, message, sender_id=sender_ids[sender])
+    results["per-message commit"] = await run_senders(senders, per_sender, direct)
+
+    writer = MessageWriter(session_factory, batch_size=batch_size, flush_ms=flush_ms)
+    await writer.start()
+
+    async def batched(sender, text):
+        await writer.submit(text, room_id, sender_ids[sender]).future
+    results[f"write-behind ({batch_size} rows / {flush_ms:g} ms)"] = await run_senders(senders, per_sender, batched)
+    await writer.stop()
+    await engine.dispose()
+
+    print(f"{per_sender * senders} messages from {senders} concurrent senders on {engine.url.get_backend_name()}")
+    for name, (elapsed, latencies) in results.items():
+        print(f"  {name:<36} {len(latencies) / elapsed:9.0f} msg/s   "
+              f"p50 {percentile(latencies, 0.5) * 1000:6.1f} ms   p99 {percentile(latencies, 0.99) * 1000:6.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--flush-ms", type=float, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.url, args.messages, args.senders, args.batch_size, args.flush_ms))
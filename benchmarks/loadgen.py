@@ -0,0 +1,375 @@
+# benchmarks/loadgen.py
+# End-to-end load generator: starts the app under uvicorn against SQLite (default)
+# or PostgreSQL, opens many /ws/chat/{room_id} clients and reports, as JSON:
+#   - join time: connect + auth + presence snapshot + history replay
+#   - send-to-receive latency percentiles over every delivery
+#   - messages sent and delivered per second
+#   - /login throughput and latency
+#
+#   python -m benchmarks.loadgen --list
+#   python -m benchmarks.loadgen --scenario one_big_room [--url postgresql://...] [--output result.json]
+#   python -m benchmarks.loadgen --scenario smoke --set clients=50 --env CHAT_WRITE_BEHIND=1
+#
+# Users, rooms and pre-seeded history are created with a fresh tag on every run.
+# All clients run in this one process: with many thousands of sockets the
+# generator itself can become the bottleneck, so watch its CPU usage too.
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+# app.database picks the messages table layout (partitioned on Postgres) from
+# DATABASE_URL when it is imported, so point it at this run's database first
+DEFAULT_URL = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'loadgen.db')}"
+url_parser = argparse.ArgumentParser(add_help=False)
+url_parser.add_argument("--url", default=DEFAULT_URL)
+os.environ["DATABASE_URL"] = url_parser.parse_known_args()[0].url
+
+import httpx
+import websockets
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+
+from app.database import Base, Message, Room, User
+from app.hashing import get_pwd_context
+
+PASSWORD = "loadgen-password"
+
+# --- Scenarios ---
+# rooms/clients: sockets are spread round-robin over the rooms
+# users: distinct accounts; clients beyond that are extra tabs of the same users
+# senders: clients that send, spread over the rooms; each sends `messages`
+#   messages, one every `interval` seconds
+# history: messages pre-seeded per room (replayed on join)
+# logins/login_concurrency: /login requests after the chat phase
+SCENARIOS = {
+    "smoke": dict(rooms=2, clients=20, users=10, senders=4, messages=20, interval=0.01, history=20,
+                  logins=20, login_concurrency=4),
+    "one_big_room": dict(rooms=1, clients=2000, users=200, senders=20, messages=50, interval=0.05, history=50,
+                         logins=0, login_concurrency=0),
+    "many_small_rooms": dict(rooms=200, clients=2000, users=200, senders=200, messages=20, interval=0.05,
+                             history=50, logins=0, login_concurrency=0),
+    "join_storm": dict(rooms=10, clients=3000, users=300, senders=0, messages=0, interval=0, history=50,
+                       logins=0, login_concurrency=0),
+    "login": dict(rooms=1, clients=0, users=50, senders=0, messages=0, interval=0, history=0,
+                  logins=200, login_concurrency=16),
+}
+
+# The generator sends from few accounts at a high rate: don't measure the limiter
+DEFAULT_SERVER_ENV = {
+    "WS_CONNECTION_RATE": "0",
+    "WS_USER_RATE": "0",
+    "WS_ROOM_RATE": "0",
+}
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    pick = lambda fraction: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+    return {
+        "count": len(ordered),
+        "p50_ms": pick(0.50),
+        "p90_ms": pick(0.90),
+        "p99_ms": pick(0.99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def raise_file_limit():
+    # Every socket needs a descriptor on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+# --- Setup ---
+
+def seed(url: str, rooms: int, users: int, history: int):
+    sync_engine = create_engine(url)
+    Base.metadata.create_all(sync_engine)
+    tag = uuid.uuid4().hex[:8]
+    hashed_password = get_pwd_context().hash(PASSWORD) # Once: every account shares it
+    with Session(sync_engine, expire_on_commit=False) as db:
+        room_rows = [Room(name=f"loadgen-{tag}-{i}", last_seq=history) for i in range(rooms)]
+        user_rows = [User(username=f"loadgen-{tag}-{i}", email=f"loadgen-{tag}-{i}@example.com",
+                          hashed_password=hashed_password) for i in range(users)]
+        db.add_all([*room_rows, *user_rows])
+        db.commit()
+        if history:
+            start = datetime.now(timezone.utc) - timedelta(seconds=history)
+            db.execute(insert(Message), [
+                {"text": f"history message {i}", "room_id": room.id, "sender_id": user_rows[i % users].id,
+                 "timestamp": start + timedelta(seconds=i), "seq": i + 1}
+                for room in room_rows for i in range(history)
+            ])
+            db.commit()
+    sync_engine.dispose()
+    return [room.id for room in room_rows], [user.username for user in user_rows]
+
+
+def start_server(url: str, port: int, workers: int, env: dict, log_path: str) -> subprocess.Popen:
+    server_env = {**os.environ, **DEFAULT_SERVER_ENV, **env, "DATABASE_URL": url}
+    command = [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(workers), "--log-level", "warning", "--no-access-log"]
+    log = open(log_path, "w")
+    return subprocess.Popen(command, env=server_env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_until_up(base_url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("Server exited during startup, see its log")
+            try:
+                if (await client.get(f"{base_url}/openapi.json")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not start in time")
+
+
+async def login_all(base_url: str, usernames, concurrency: int = 8) -> dict:
+    tokens = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        async def login(username):
+            async with semaphore:
+                response = await client.post("/login", data={"username": username, "password": PASSWORD})
+                response.raise_for_status()
+                tokens[username] = response.json()["access_token"]
+        await asyncio.gather(*(login(username) for username in usernames))
+    return tokens
+
+
+# --- Chat clients ---
+
+class Results:
+    def __init__(self):
+        self.join_times = []
+        self.latencies = []
+        self.sent = 0
+        self.delivered = 0
+        self.errors = {}
+        self.failed_connects = 0
+
+    def error(self, code: str):
+        self.errors[code] = self.errors.get(code, 0) + 1
+
+
+class ChatClient:
+    def __init__(self, ws_url: str, room_id: int, results: Results):
+        self.ws_url = ws_url
+        self.room_id = room_id
+        self.results = results
+        self.websocket = None
+        self.reader = None
+
+    async def join(self):
+        started = time.perf_counter()
+        self.websocket = await websockets.connect(self.ws_url, max_size=None, open_timeout=120)
+        # Joined once the history replay has arrived
+        while True:
+            event = json.loads(await self.websocket.recv())
+            if event.get("type") == "chat_history":
+                break
+        self.results.join_times.append(time.perf_counter() - started)
+        self.reader = asyncio.create_task(self.read())
+
+    async def read(self):
+        results = self.results
+        try:
+            async for raw in self.websocket:
+                event = json.loads(raw)
+                kind = event.get("type")
+                if kind == "chat_message":
+                    text = event.get("text") or ""
+                    if text.startswith("lg|"):
+                        results.latencies.append(time.perf_counter() - float(text.split("|", 2)[1]))
+                        results.delivered += 1
+                elif kind == "error":
+                    results.error(event.get("code") or event.get("message", "error"))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send(self, count: int, interval: float):
+        for i in range(count):
+            await self.websocket.send(json.dumps({"text": f"lg|{time.perf_counter():.6f}|{i}"}))
+            self.results.sent += 1
+            if interval:
+                await asyncio.sleep(interval)
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.reader is not None:
+            await self.reader
+
+
+async def run_chat(ws_base: str, params: dict, room_ids, tokens, connect_concurrency: int, drain_timeout: float) -> dict:
+    results = Results()
+    token_list = list(tokens.values())
+    clients = [
+        ChatClient(f"{ws_base}/ws/chat/{room_ids[i % len(room_ids)]}?token={token_list[i % len(token_list)]}",
+                   room_ids[i % len(room_ids)], results)
+        for i in range(params["clients"])
+    ]
+
+    # Join phase, a bounded number of handshakes at a time
+    semaphore = asyncio.Semaphore(connect_concurrency)
+    async def join(client):
+        async with semaphore:
+            try:
+                await client.join()
+            except Exception:
+                results.failed_connects += 1
+                client.websocket = None
+    join_started = time.perf_counter()
+    await asyncio.gather(*(join(client) for client in clients))
+    join_seconds = time.perf_counter() - join_started
+    connected = [client for client in clients if client.websocket is not None]
+    await asyncio.sleep(0.5) # Let presence events settle
+
+    # Send phase: senders spread over the rooms, every room member should get every message
+    members = {}
+    for client in connected:
+        members[client.room_id] = members.get(client.room_id, 0) + 1
+    by_room = {}
+    for client in connected:
+        by_room.setdefault(client.room_id, []).append(client)
+    senders = []
+    while len(senders) < params["senders"] and any(by_room.values()):
+        for room_clients in by_room.values():
+            if room_clients and len(senders) < params["senders"]:
+                senders.append(room_clients.pop())
+    expected = sum(members[sender.room_id] for sender in senders) * params["messages"]
+
+    send_started = time.perf_counter()
+    await asyncio.gather(*(sender.send(params["messages"], params["interval"]) for sender in senders))
+    send_seconds = time.perf_counter() - send_started
+    deadline = time.monotonic() + drain_timeout
+    while results.delivered < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    delivery_seconds = time.perf_counter() - send_started
+
+    await asyncio.gather(*(client.close() for client in connected), return_exceptions=True)
+    return {
+        "connected": len(connected),
+        "failed_connects": results.failed_connects,
+        "join": {**percentiles(results.join_times), "total_seconds": join_seconds,
+                 "joins_per_second": len(connected) / join_seconds if join_seconds else 0.0},
+        "messages": {
+            "sent": results.sent,
+            "sent_per_second": results.sent / send_seconds if send_seconds else 0.0,
+            "expected_deliveries": expected,
+            "delivered": results.delivered,
+            "delivered_per_second": results.delivered / delivery_seconds if delivery_seconds else 0.0,
+            "latency": percentiles(results.latencies),
+        },
+        "errors": results.errors,
+    }
+
+
+async def run_logins(base_url: str, usernames, count: int, concurrency: int) -> dict:
+    latencies = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+        async def login(i):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post("/login", data={"username": usernames[i % len(usernames)], "password": PASSWORD})
+                latencies.append(time.perf_counter() - started)
+                statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+        started = time.perf_counter()
+        await asyncio.gather(*(login(i) for i in range(count)))
+        elapsed = time.perf_counter() - started
+    return {"requests": count, "per_second": count / elapsed, "latency": percentiles(latencies), "status": statuses}
+
+
+async def main(args):
+    params = dict(SCENARIOS[args.scenario])
+    for override in args.set:
+        key, value = override.split("=", 1)
+        params[key] = type(params[key])(value) if key in params else value
+    server_env = dict(pair.split("=", 1) for pair in args.env)
+    raise_file_limit()
+
+    room_ids, usernames = seed(args.url, params["rooms"], params["users"], params["history"])
+    port = args.port or free_port()
+    log_path = os.path.join(tempfile.mkdtemp(), "server.log")
+    process = start_server(args.url, port, args.workers, server_env, log_path)
+    base_url = f"http://127.0.0.1:{port}"
+    result = {
+        "scenario": args.scenario,
+        "params": params,
+        "database": args.url.split(":", 1)[0],
+        "workers": args.workers,
+        "server_env": {**DEFAULT_SERVER_ENV, **server_env},
+        "commit": git_commit(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "server_log": log_path,
+    }
+    try:
+        await wait_until_up(base_url, process)
+        if params["clients"]:
+            tokens = await login_all(base_url, usernames)
+            result["chat"] = await run_chat(f"ws://127.0.0.1:{port}", params, room_ids, tokens,
+                                            args.connect_concurrency, args.drain_timeout)
+        if params["logins"]:
+            result["login"] = await run_logins(base_url, usernames, params["logins"], params["login_concurrency"])
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", default="smoke", choices=sorted(SCENARIOS))
+    parser.add_argument("--list", action="store_true", help="print the scenarios and exit")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="override a scenario parameter")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra server environment")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--drain-timeout", type=float, default=30)
+    parser.add_argument("--output", help="also write the JSON result to this file")
+    args = parser.parse_args()
+    if args.list:
+        print(json.dumps(SCENARIOS, indent=2))
+    else:
+        asyncio.run(main(args))